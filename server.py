@@ -9,7 +9,16 @@ import sys
 import uuid
 import httpx
 import html
-from hashlib import md5
+import http.cookiejar
+import hmac
+import threading
+import importlib.util
+from hashlib import md5, sha1, sha256
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import urllib.parse
 from PIL import Image, ImageOps
 
@@ -27,52 +36,329 @@ except ImportError:
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, Response, FileResponse
-from serpapi import GoogleSearch
+from fastapi.responses import HTMLResponse, Response, FileResponse, StreamingResponse
 
+# rembg sadece tespit edilir; ONNX modeli ilk remove_bg çağrısında, onu çalıştıran process'te yüklenir
+# (bkz. get_rembg_session) → web ve CPU pool worker'ları modelin RAM'ini ve cold-start süresini ödemez.
 try:
-    from rembg import remove as rembg_remove, new_session
-    try:
-        rembg_session = new_session("u2net_cloth_seg")  # Clothing-specific model
-        print("✅ rembg loaded (u2net_cloth_seg)")
-    except Exception:
-        rembg_session = new_session("u2net")  # Fallback to general model
-        print("✅ rembg loaded (u2net fallback)")
-    HAS_REMBG = True
-except ImportError:
-    rembg_session = None
+    HAS_REMBG = importlib.util.find_spec("rembg") is not None
+except ValueError:
     HAS_REMBG = False
-    print("⚠️ rembg not installed")
+print("✅ rembg available (lazy load)" if HAS_REMBG else "⚠️ rembg not installed")
 
 app = FastAPI(title="Fitchy API")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
-API_SEM = asyncio.Semaphore(6)  # v40: 3 Lens calls + Shopping + Google Organic
-REMBG_SEM = asyncio.Semaphore(2)  # 8GB RAM → 2 paralel rembg güvenli
 
-_CACHE = {}
 CACHE_TTL = 3600
 
-def cache_get(key):
-    if key in _CACHE:
-        val, ts = _CACHE[key]
-        if time.time() - ts < CACHE_TTL: return val
-        del _CACHE[key]
-    return None
-
-def cache_set(key, val):
-    _CACHE[key] = (val, time.time())
-    if len(_CACHE) > 500:
+class TTLCache:
+    """O(1) get/set TTL + LRU cache. Key prefix'i ("shop:", "gorg:", "lens:", "claude:", "trend:")
+    namespace'i belirler; her namespace'in kendi byte bütçesi, LRU sırası ve istatistikleri var."""
+
+    def __init__(self, budgets, default_budget, ttl=CACHE_TTL):
+        self.budgets = budgets  # namespace → max byte
+        self.default_budget = default_budget
+        self.ttl = ttl
+        self._data = {}  # namespace → OrderedDict(key → (val, expires_at, size)), sona eklenen = en yeni
+        self._bytes = {}
+        self.stats = {}
+
+    @staticmethod
+    def _ns(key):
+        return key.split(":", 1)[0] if ":" in key else "default"
+
+    @staticmethod
+    def _sizeof(val):
+        # Yaklaşık bellek: JSON boyutu (değerler dict/list/str — pickle'dan ucuz)
+        if isinstance(val, (bytes, bytearray)): return len(val)
+        if isinstance(val, tuple): return sum(TTLCache._sizeof(v) for v in val)
+        try: return len(json.dumps(val, default=str, ensure_ascii=False))
+        except Exception: return sys.getsizeof(val)
+
+    def _bucket(self, ns):
+        if ns not in self._data:
+            self._data[ns] = OrderedDict()
+            self._bytes[ns] = 0
+            self.stats[ns] = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0}
+        return self._data[ns]
+
+    def _drop(self, ns, key):
+        _, _, size = self._data[ns].pop(key)
+        self._bytes[ns] -= size
+
+    def get(self, key):
+        ns = self._ns(key)
+        d = self._bucket(ns)
+        entry = d.get(key)
+        if entry is None:
+            self.stats[ns]["misses"] += 1
+            return None
+        if entry[1] <= time.time():
+            self._drop(ns, key)
+            self.stats[ns]["expired"] += 1
+            self.stats[ns]["misses"] += 1
+            return None
+        d.move_to_end(key)
+        self.stats[ns]["hits"] += 1
+        return entry[0]
+
+    def set(self, key, val, ttl=None):
+        ns = self._ns(key)
+        d = self._bucket(ns)
+        if key in d: self._drop(ns, key)
+        size = self._sizeof(val)
+        budget = self.budgets.get(ns, self.default_budget)
+        if size > budget: return  # Tek başına bütçeyi aşan değeri hiç saklama
         now = time.time()
-        expired = [k for k, (_, ts) in _CACHE.items() if now - ts > CACHE_TTL]
-        for k in expired: del _CACHE[k]
-        if len(_CACHE) > 500:
-            oldest = sorted(_CACHE.keys(), key=lambda k: _CACHE[k][1])[:50]
-            for k in oldest: del _CACHE[k]
+        d[key] = (val, now + (ttl if ttl is not None else self.ttl), size)
+        self._bytes[ns] += size
+        self.stats[ns]["sets"] += 1
+        # En eski (LRU) uçtan: önce süresi dolmuşlar, sonra bütçe aşımı — giriş başına amortize O(1)
+        while d:
+            k, (_, exp, _) = next(iter(d.items()))
+            if exp <= now:
+                self._drop(ns, k); self.stats[ns]["expired"] += 1
+            elif self._bytes[ns] > budget:
+                self._drop(ns, k); self.stats[ns]["evictions"] += 1
+            else:
+                break
+
+    def purge(self):
+        """Süresi dolmuş girişleri sil (periyodik sweeper — get/set'teki tembel temizliği tamamlar)."""
+        now, n = time.time(), 0
+        for ns, d in self._data.items():
+            for k in [k for k, (_, exp, _) in d.items() if exp <= now]:
+                self._drop(ns, k)
+                self.stats[ns]["expired"] += 1
+                n += 1
+        return n
+
+    def snapshot(self):
+        out = {}
+        for ns, st in self.stats.items():
+            total = st["hits"] + st["misses"]
+            out[ns] = {**st, "entries": len(self._data[ns]), "bytes": self._bytes[ns],
+                       "budget": self.budgets.get(ns, self.default_budget),
+                       "hit_rate": round(st["hits"] / total, 3) if total else 0.0}
+        return out
+
+CACHE_BUDGETS = {  # namespace → byte (JSON boyutu)
+    "shop": 4 * 1024 * 1024,
+    "gorg": 2 * 1024 * 1024,
+    "lens": 8 * 1024 * 1024,
+    "claude": 2 * 1024 * 1024,
+    "trend": 1 * 1024 * 1024,
+}
+_CACHE = TTLCache(CACHE_BUDGETS, default_budget=2 * 1024 * 1024)
+
+def cache_get(key): return _CACHE.get(key)
+
+def cache_set(key, val, ttl=None): _CACHE.set(key, val, ttl)
+
+_BG_TASKS = set()  # Referans tut — yoksa task GC'de kaybolabilir
+
+def spawn(coro):
+    """Fire-and-forget background task (request'i bekletmeden)."""
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+# ─── SINGLE-FLIGHT: aynı cache key için uçuştaki çağrıyı paylaş (viral foto → tek SerpAPI/Claude isteği) ───
+# Cache ancak çağrı dönünce doluyor; o arada gelen eş istekler aynı task'ı bekler.
+_INFLIGHT = {}  # cache key → asyncio.Task
+SF_STATS = {"leaders": 0, "shared": 0}
+
+async def single_flight(key, factory):
+    """key için uçuşta bir çağrı varsa sonucunu bekle, yoksa factory() coroutine'ini başlat.
+    shield: bekleyenlerden biri iptal olsa da paylaşılan çağrı diğerleri için sürer."""
+    task = _INFLIGHT.get(key)
+    if task is None:
+        SF_STATS["leaders"] += 1
+        task = spawn(factory())
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _INFLIGHT.pop(key, None) if _INFLIGHT.get(key) is t else None)
+    else:
+        SF_STATS["shared"] += 1
+        print(f"  🔗 Single-flight join: {key[:60]}")
+    return await asyncio.shield(task)
+
+# ─── SHARED HTTP CLIENTS: app-lifetime keep-alive havuzu (her çağrıda yeni TCP+TLS yok) ───
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+try:
+    import h2  # noqa: F401 — httpx HTTP/2 desteği için gerekli
+    HAS_HTTP2 = os.environ.get("HTTP2", "1") != "0"
+except ImportError:
+    HAS_HTTP2 = False
+
+# ─── ADAPTIVE LIMITS: upstream başına AIMD eşzamanlılık (eski global API_SEM(6) yerine) ───
+# Lens patlaması ucuz Shopping çağrılarını aç bırakmasın. Limit doluyken başarılı yanıt → +1/limit (additive increase);
+# 429/503/529/timeout → ×0.7 (saniyede en fazla bir kez); gecikme taban (p10) değerin LIMIT_LATENCY_TOLERANCE katını aşarsa ×0.95.
+LIMIT_LATENCY_TOLERANCE = float(os.environ.get("LIMIT_LATENCY_TOLERANCE", "3"))
+OVERLOAD_STATUS = {429, 503, 529}  # 529 = Anthropic overloaded
+
+class AIMDLimiter:
+    def __init__(self, name, initial, max_limit=16, min_limit=1):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit, self.max_limit = min_limit, max_limit
+        self.inflight = 0
+        self._waiters = deque()  # slot bekleyen future'lar (FIFO)
+        self._rtts = deque(maxlen=100)
+        self._last_drop = 0.0
+        self.stats = {"requests": 0, "overloads": 0, "slow": 0, "max_queue": 0}
+
+    async def acquire(self):
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        self.stats["max_queue"] = max(self.stats["max_queue"], len(self._waiters))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(None)  # Slot verilmişti, iptal geldi → geri ver
+            elif fut in self._waiters:
+                self._waiters.remove(fut)
+            raise
+
+    def base_latency(self):
+        if not self._rtts: return None
+        return sorted(self._rtts)[len(self._rtts) // 10]
+
+    def release(self, latency, overloaded=False):
+        """latency None → ölçüm yok (iptal edilen istek), sadece slot geri verilir."""
+        saturated = self.inflight >= int(self.limit)
+        self.inflight -= 1
+        if overloaded:
+            self.stats["requests"] += 1
+            self.stats["overloads"] += 1
+            now = time.time()
+            if now - self._last_drop > 1.0:
+                self.limit = max(self.min_limit, self.limit * 0.7)
+                self._last_drop = now
+                print(f"  🚦 {self.name} overloaded → limit {self.limit:.1f}")
+        elif latency is not None:
+            self.stats["requests"] += 1
+            self._rtts.append(latency)
+            base = self.base_latency()
+            if len(self._rtts) >= 10 and latency > base * LIMIT_LATENCY_TOLERANCE:
+                self.stats["slow"] += 1
+                self.limit = max(self.min_limit, self.limit * 0.95)
+            elif saturated:  # Sadece limit doluyken büyüt — boşta şişmesin
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        while self._waiters and self.inflight < int(self.limit):
+            fut = self._waiters.popleft()
+            if fut.done(): continue
+            self.inflight += 1
+            fut.set_result(True)
+
+    def snapshot(self):
+        base = self.base_latency()
+        return {"limit": round(self.limit, 2), "inflight": self.inflight, "queued": len(self._waiters),
+                "base_latency": round(base, 3) if base is not None else None,
+                "min": self.min_limit, "max": self.max_limit, **self.stats}
+
+def _limiter_cfg(name, initial, max_limit):
+    """LIMIT_<NAME>=başlangıç:max env ile override (ör. LIMIT_SERPAPI_LENS=4:24)."""
+    v = os.environ.get(f"LIMIT_{name.upper()}", "")
+    if ":" in v:
+        initial, max_limit = (int(x) for x in v.split(":", 1))
+    return AIMDLimiter(name, initial, max_limit)
+
+LIMITERS = {
+    "serpapi_lens": _limiter_cfg("serpapi_lens", 3, 16),
+    "serpapi_shopping": _limiter_cfg("serpapi_shopping", 3, 16),
+    "serpapi_search": _limiter_cfg("serpapi_search", 2, 8),  # google organic / sponsored / trending
+    "anthropic": _limiter_cfg("anthropic", 4, 16),
+    "image_hosts": _limiter_cfg("image_hosts", 4, 16),  # imgur / catbox / tmpfiles / remove.bg
+}
+SERPAPI_ENGINE_LIMITER = {"google_lens": "serpapi_lens", "google_shopping": "serpapi_shopping"}
+
+class LimitedTransport(httpx.AsyncBaseTransport):
+    """httpx transport sarmalayıcı — her istek upstream limiter'ından slot alır, gecikme/429'u bildirir.
+    Slot beklemesi isteğin pool timeout'u ile sınırlı (connection pool'u gibi) → aşılırsa httpx.PoolTimeout."""
+
+    def __init__(self, inner, pick):
+        self.inner, self.pick = inner, pick
+
+    async def handle_async_request(self, request):
+        lim = self.pick(request)
+        pool_timeout = request.extensions.get("timeout", {}).get("pool")
+        try:
+            await asyncio.wait_for(lim.acquire(), pool_timeout)
+        except asyncio.TimeoutError:
+            raise httpx.PoolTimeout(f"{lim.name} limiter: no slot within {pool_timeout}s", request=request) from None
+        t, latency, overloaded = time.time(), None, False
+        try:
+            resp = await self.inner.handle_async_request(request)
+            latency, overloaded = time.time() - t, resp.status_code in OVERLOAD_STATUS
+            return resp
+        except httpx.TimeoutException:
+            overloaded = True
+            raise
+        except Exception:
+            latency = time.time() - t
+            raise
+        finally:
+            lim.release(latency, overloaded)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+# Upstream başına bir client: anthropic = api.anthropic.com, upload = imgur/catbox/tmpfiles/remove.bg, serpapi = serpapi.com,
+# fetch = rastgele mağaza/CDN görselleri ve sayfaları (HTTP/1.1 — bazı CDN'ler h2'de sorunlu, limiter yok)
+HTTP_CLIENT_OPTS = {
+    "anthropic": {"http2": True, "limiter": lambda req: LIMITERS["anthropic"]},
+    "upload": {"http2": True, "limiter": lambda req: LIMITERS["image_hosts"]},
+    "serpapi": {"http2": True, "limiter": lambda req: LIMITERS[SERPAPI_ENGINE_LIMITER.get(req.url.params.get("engine", ""), "serpapi_search")]},
+    "fetch": {"http2": False},
+}
+_HTTP_CLIENTS = {}  # name → httpx.AsyncClient
+
+def _no_cookie_jar():
+    """Hiç cookie saklamayan jar: client'lar app ömrü boyunca yaşıyor, proxy_img / url_thumbnail'in gezdiği
+    rastgele sitelerin Set-Cookie'leri birikip başka isteklere gönderilmesin."""
+    return http.cookiejar.CookieJar(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+def http_client(name="fetch"):
+    """Paylaşılan httpx.AsyncClient döndür (yoksa oluştur). Timeout'lar çağrı başına verilir."""
+    c = _HTTP_CLIENTS.get(name)
+    if c is None or c.is_closed:
+        opts = HTTP_CLIENT_OPTS.get(name, {})
+        transport = httpx.AsyncHTTPTransport(
+            http2=HAS_HTTP2 and opts.get("http2", False),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY))
+        if opts.get("limiter"):
+            transport = LimitedTransport(transport, opts["limiter"])
+        c = httpx.AsyncClient(timeout=30, transport=transport, cookies=_no_cookie_jar())
+        _HTTP_CLIENTS[name] = c
+    return c
+
+@app.on_event("startup")
+async def open_http_clients():
+    for name in HTTP_CLIENT_OPTS: http_client(name)
+    print(f"✅ HTTP pools ready ({', '.join(HTTP_CLIENT_OPTS)}) http2={HAS_HTTP2} max_conn={HTTP_MAX_CONNECTIONS}")
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    clients = list(_HTTP_CLIENTS.values())
+    _HTTP_CLIENTS.clear()
+    await asyncio.gather(*[c.aclose() for c in clients], return_exceptions=True)
 
 SERPAPI_KEY = os.environ.get("SERPAPI_KEY", "")
+SERPAPI_BASE_URL = os.environ.get("SERPAPI_BASE_URL", "https://serpapi.com")  # test/benchmark için yerel stub'a yönlendirilebilir
+SERPAPI_TIMEOUT = float(os.environ.get("SERPAPI_TIMEOUT", "60"))
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 IMGUR_CLIENT_ID = os.environ.get("IMGUR_CLIENT_ID", "")
+ANTHROPIC_API_URL = os.environ.get("ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages")  # yerel stub / proxy için override
 
 # ✅ FIX #1: Correct model name (verified from Anthropic API docs Feb 2026)
 # claude-3-7-sonnet-20250219 was RETIRED in July 2025
@@ -227,10 +513,7 @@ PIECE_KEYWORDS = {
 }
 
 def get_brand(link, src):
-    c = (link + " " + src).lower()
-    for d, b in BRAND_MAP.items():
-        if d in c: return b
-    return src if src else ""
+    return link_class(link, src).brand or (src if src else "")
 
 def is_local(link, src, country_config): return any(d in (link + " " + src).lower() for d in country_config.get("local_stores", []))
 # Non-fashion domains that should NEVER appear (even in exact matches)
@@ -238,30 +521,37 @@ NON_FASHION_DOMAINS = ["butor", "furniture", "hotel", "booking", "travel", "real
 
 def is_non_fashion_domain(link, title, source):
     """Quick check if URL/title contains obviously non-fashion keywords."""
-    c = (link + " " + title + " " + source).lower()
-    return any(nf in c for nf in NON_FASHION_DOMAINS)
+    # Kalıplarda boşluk yok → link+source ve title ayrı taranınca birleşik metinle aynı sonuç
+    return link_class(link, source).non_fashion or NON_FASHION_INDEX.search(title.lower())
 
-def is_blocked(link): return any(d in link.lower() for d in BLOCKED)
+def is_blocked(link, src=""):
+    """Sadece link'e bakar; src verilirse aynı sonuç, ama is_spam_domain/get_brand ile aynı link_class cache'ini paylaşır."""
+    return link_class(link, src).blocked
 
 # 🛡️ v42: YABANCI YAZI FİLTRESİ — Kiril, Arapça, Farsça başlıkları çöpe at
 import unicodedata
+def _latin_alpha_ranges(limit=0x20000):
+    """Adında LATIN/TURKISH geçen harflerin codepoint aralıkları (import'ta bir kez, ~20ms).
+    Latin harfler BMP + SMP'de (Latin Extended-F/G); 0x20000 üstü harfler CJK vb."""
+    ranges = []
+    for cp in range(limit):
+        ch = chr(cp)
+        if not ch.isalpha(): continue
+        name = unicodedata.name(ch, "")
+        if "LATIN" not in name and "TURKISH" not in name: continue
+        if ranges and ranges[-1][1] == cp - 1: ranges[-1][1] = cp
+        else: ranges.append([cp, cp])
+    return ranges
+
+_LATIN_ALPHA_RE = re.compile("[" + "".join(re.escape(chr(a)) + ("-" + re.escape(chr(b)) if b > a else "")
+                                        for a, b in _latin_alpha_ranges()) + "]")
+
 def has_foreign_script(text, threshold=0.3):
     """TR modunda Latin-dışı karakter oranı threshold'u geçerse True."""
-    if not text: return False
-    non_latin = 0
-    total = 0
-    for ch in text:
-        if ch.isalpha():
-            total += 1
-            cat = unicodedata.category(ch)
-            # Latin harfler: Lu/Ll with name containing LATIN
-            try:
-                name = unicodedata.name(ch, "")
-                if "LATIN" not in name and "TURKISH" not in name:
-                    non_latin += 1
-            except ValueError:
-                non_latin += 1
+    if not text or text.isascii(): return False  # ASCII harflerin hepsi Latin
+    total = sum(map(str.isalpha, text))
     if total < 3: return False
+    non_latin = total - len(_LATIN_ALPHA_RE.findall(text))
     return (non_latin / total) > threshold
 
 # 🛡️ v42: KATEGORİ TERS EŞLEŞME — "bag" aramasında "cup" gelirse çöpe at
@@ -272,17 +562,8 @@ def is_category_mismatch(title, category):
     Mantık: "bej çanta" arıyorsun → sonuçta "ceket" kelimesi var → FARKLI KATEGORİ → ⛔
     """
     if not category or not title: return False
-    tl = title.lower()
-    
-    # Her kategoriden kaç keyword eşleşiyor?
-    cat_scores = {}
-    for cat, keywords in PIECE_KEYWORDS.items():
-        score = 0
-        for kw in keywords:
-            if len(kw) >= 3 and kw in tl:
-                score += 1
-        if score > 0:
-            cat_scores[cat] = score
+    # Her kategoriden kaç keyword eşleşiyor? (title_features: başlık başına bir kez)
+    cat_scores = title_features(title).cats
     
     # Aranan kategori tespit edilenler arasındaysa → geçir
     if category in cat_scores:
@@ -295,17 +576,7 @@ def is_category_mismatch(title, category):
     # Hiçbir kategori tespit edilmedi — genel başlık
     # Aksesuar kategorileri (watch, bag, sunglasses, hat, scarf) için
     # "giyim/dış giyim/outfit" gibi genel ifadeler → muhtemelen kıyafet, aksesuar değil
-    SPECIFIC_CATS = {"watch", "bag", "sunglasses", "hat", "scarf", "accessory"}
-    if category in SPECIFIC_CATS:
-        # Genel giyim kelimeleri varsa → aksesuar aramada uyumsuz
-        clothing_generics = ["giyim", "giysi", "clothing", "outfit", "kıyafet", "dış giyim",
-                             "iç giyim", "modelleri", "koleksiyon", "collection", "fashion",
-                             "sezon", "yeni sezon", "oversize", "regular fit", "slim fit",
-                             "erkek", "kadın", "unisex"]
-        if any(cg in tl for cg in clothing_generics):
-            return True
-    
-    return False
+    return category in ACCESSORY_CATS and title_features(title).generic
 NON_CLOTHING_PRODUCTS = [
     "cup", "mug", "bardak", "tumbler", "thermos", "bottle", "şişe", "matara",
     "starbucks", "coffee", "kahve", "tea", "çay", "fincan",
@@ -384,8 +655,7 @@ FOREIGN_CLOTHING_WORDS = [
 
 def is_spam_domain(link, source):
     """Dropshipping / scam site mi?"""
-    c = (link + " " + source).lower()
-    return any(sd in c for sd in SPAM_DOMAINS)
+    return link_class(link, source).spam
 
 def has_foreign_clothing_word(title):
     """Başlıkta yabancı dilde giyim kelimesi var mı? (broek, jurk, Kleid vs.)"""
@@ -407,9 +677,76 @@ def is_non_clothing_product(title):
     return any(ncp in tl for ncp in NON_CLOTHING_PRODUCTS)
 
 def is_fashion(link, title, src):
+    if link_class(link, src).fashion_domain: return True
+    return FASHION_KW_INDEX.search((title + " " + src).lower())
+
+# ─── LINK CLASSIFIER: BLOCKED / SPAM / FASHION_DOMAINS / NON_FASHION / BRAND_MAP tek taramada ───
+# Her sonuç için listeler üzerinde ayrı ayrı any(d in c ...) yerine tüm kalıplar tek trie-regex'te;
+# link + source bir kez taranır, tüm sınıflar birlikte döner. Semantik aynı: lower() metinde düz alt-dize.
+def _trie_regex(words):
+    """Kelimeler → trie şeklinde regex: her konumda tek karakter dallanması, en uzun eşleşme önce."""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[""] = None
+    def build(node):
+        alts = [re.escape(ch) + build(sub) for ch, sub in sorted((k, v) for k, v in node.items() if k)]
+        if not alts: return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return build(trie)
+
+class SubstringIndex:
+    """Sabit alt-dize listesi → derlenmiş trie-regex. search(): herhangi biri var mı;
+    find(): örtüşenler dahil tüm eşleşmeler [(konum, kelime)], tek geçişte."""
+
+    def __init__(self, words):
+        words = sorted({w for w in words if w})
+        pattern = _trie_regex(words)
+        self._any = re.compile(pattern)
+        self._all = re.compile(f"(?=({pattern}))")
+        # Regex bir konumda en uzun kelimeyi verir; onun önekleri olan kelimeler de aynı konumda eşleşmiştir
+        wset = set(words)
+        self._prefixes = {w: [w[:k] for k in range(1, len(w)) if w[:k] in wset] for w in words}
+
+    def search(self, text):
+        return self._any.search(text) is not None
+
+    def find(self, text):
+        hits = []
+        for m in self._all.finditer(text):
+            w = m.group(1)
+            hits.append((m.start(), w))
+            hits.extend((m.start(), p) for p in self._prefixes[w])
+        return hits
+
+LinkClass = namedtuple("LinkClass", "blocked spam fashion_domain non_fashion brand")
+_LINK_LISTS = {"blocked": BLOCKED, "spam": SPAM_DOMAINS, "fashion_domain": FASHION_DOMAINS,
+               "non_fashion": NON_FASHION_DOMAINS, "brand": list(BRAND_MAP)}
+_LINK_WORD_CLASSES = {}  # kalıp → {sınıf}
+for _cls, _words in _LINK_LISTS.items():
+    for _w in _words: _LINK_WORD_CLASSES.setdefault(_w, set()).add(_cls)
+LINK_INDEX = SubstringIndex(_LINK_WORD_CLASSES)
+NON_FASHION_INDEX = SubstringIndex(NON_FASHION_DOMAINS)
+FASHION_KW_INDEX = SubstringIndex(FASHION_KW)
+_BRAND_ORDER = {d: i for i, d in enumerate(BRAND_MAP)}  # get_brand: birden fazla eşleşmede dict sırası
+
+@lru_cache(maxsize=16384)
+def link_class(link, src=""):
+    """link + source → LinkClass(blocked, spam, fashion_domain, non_fashion, brand). Aynı link'ler
+    parçalar ve istekler arasında tekrar ettiği için memoize edilir. blocked sadece link kısmına bakar."""
     c = (link + " " + src).lower()
-    if any(d in c for d in FASHION_DOMAINS): return True
-    return any(k in (title + " " + src).lower() for k in FASHION_KW)
+    link_end = len(link.lower())
+    found, brand = set(), None
+    for i, w in LINK_INDEX.find(c):
+        for cls in _LINK_WORD_CLASSES[w]:
+            if cls == "brand":
+                if brand is None or _BRAND_ORDER[w] < _BRAND_ORDER[brand]: brand = w
+            elif cls != "blocked" or i + len(w) <= link_end:
+                found.add(cls)
+    return LinkClass("blocked" in found, "spam" in found, "fashion_domain" in found, "non_fashion" in found,
+                     BRAND_MAP[brand] if brand else "")
 
 RIVAL_BRANDS = ["nike", "adidas", "puma", "zara", "hm", "bershka", "mango", "gucci", "prada", "balenciaga", "converse", "vans", "defacto", "koton", "lcw", "mavi", "colins", "levi", "tommy", "lacoste", "calvin klein", "massimo dutti", "pull&bear", "stradivarius"]
 
@@ -465,50 +802,105 @@ SUB_TYPE_GROUPS = {
     },
 }
 
+# Aksesuar aramalarında genel giyim ifadeleri → muhtemelen kıyafet, aksesuar değil
+ACCESSORY_CATS = {"watch", "bag", "sunglasses", "hat", "scarf", "accessory"}
+CLOTHING_GENERICS = ["giyim", "giysi", "clothing", "outfit", "kıyafet", "dış giyim",
+                     "iç giyim", "modelleri", "koleksiyon", "collection", "fashion",
+                     "sezon", "yeni sezon", "oversize", "regular fit", "slim fit",
+                     "erkek", "kadın", "unisex"]
+
+# ─── TITLE FEATURES: kategori / alt-tip / renk keyword'leri için ters indeks ───
+# Başlık bir kez taranır (SubstringIndex, düz alt-dize semantiği) → is_category_mismatch,
+# detect_subtype_conflict, detect_color_conflict ve score_result aynı kaydı okur.
+TitleFeatures = namedtuple("TitleFeatures", "cats generic subtypes colors")
+_TITLE_SIGNALS = {}  # keyword → [("cat", cat) | ("generic",) | ("sub", category, sıra, grup) | ("color",)]
+for _cat, _kws in PIECE_KEYWORDS.items():
+    for _kw in _kws:
+        if len(_kw) >= 3: _TITLE_SIGNALS.setdefault(_kw, []).append(("cat", _cat))  # Listede tekrar → iki sayılır
+for _kw in CLOTHING_GENERICS: _TITLE_SIGNALS.setdefault(_kw, []).append(("generic",))
+for _cat, _groups in SUB_TYPE_GROUPS.items():
+    for _order, (_group, _kws) in enumerate(_groups.items()):
+        for _kw in set(_kws): _TITLE_SIGNALS.setdefault(_kw, []).append(("sub", _cat, _order, _group))
+for _kw in {c for _v in COLOR_CONFLICTS.values() for c in _v}: _TITLE_SIGNALS.setdefault(_kw, []).append(("color",))
+TITLE_INDEX = SubstringIndex(_TITLE_SIGNALS)
+
+@lru_cache(maxsize=16384)
+def title_features(text):
+    """lower(text) → TitleFeatures(cats: {kategori: eşleşen keyword sayısı (len>=3)}, generic: genel giyim
+    ifadesi var mı, subtypes: {kategori: ilk eşleşen alt-tip grubu (dict sırası)}, colors: geçen renk kelimeleri)."""
+    cats, subtypes, colors, generic = {}, {}, set(), False
+    for w in {w for _, w in TITLE_INDEX.find(text.lower())}:
+        for sig in _TITLE_SIGNALS[w]:
+            if sig[0] == "cat":
+                cats[sig[1]] = cats.get(sig[1], 0) + 1
+            elif sig[0] == "sub":
+                if sig[1] not in subtypes or sig[2] < subtypes[sig[1]][0]: subtypes[sig[1]] = (sig[2], sig[3])
+            elif sig[0] == "color":
+                colors.add(w)
+            else:
+                generic = True
+    return TitleFeatures(cats, generic, {c: g for c, (_, g) in subtypes.items()}, frozenset(colors))
+
 def detect_color_conflict(piece_color, result_title):
     """Parça rengi ile sonuç başlığındaki renk çelişiyor mu?"""
     if not piece_color or piece_color in ["?", "none", ""]: return False
-    pc = piece_color.lower().strip()
-    rt = result_title.lower()
-    conflicts = COLOR_CONFLICTS.get(pc, [])
-    return any(c in rt for c in conflicts)
+    conflicts = COLOR_CONFLICTS.get(piece_color.lower().strip(), [])
+    return not title_features(result_title).colors.isdisjoint(conflicts)
 
 def detect_subtype_conflict(piece_style, result_title, category):
     """Aynı kategori içinde alt-tip çelişiyor mu? (gömlek vs süveter)"""
     if not piece_style or not category: return False
-    groups = SUB_TYPE_GROUPS.get(category, {})
-    if not groups: return False
-    ps = piece_style.lower()
-    rt = result_title.lower()
+    if not SUB_TYPE_GROUPS.get(category, {}): return False
     # Parçanın hangi alt-grubunda olduğunu bul
-    piece_group = None
-    for group_name, keywords in groups.items():
-        if any(kw in ps for kw in keywords):
-            piece_group = group_name
-            break
+    piece_group = title_features(piece_style).subtypes.get(category)
     if not piece_group: return False
     # Sonucun hangi alt-grubunda olduğunu bul
-    result_group = None
-    for group_name, keywords in groups.items():
-        if any(kw in rt for kw in keywords):
-            result_group = group_name
-            break
+    result_group = title_features(result_title).subtypes.get(category)
     if not result_group: return False
     # Farklı gruplardaysa → çelişki
     return piece_group != result_group
 
-def filter_rival_brands(results, piece_brand):
-    if not piece_brand or piece_brand == "?" or len(piece_brand) < 3: return results
+# Rakip markalar: RIVAL_BRANDS + BRAND_MAP'teki tek-marka mağazalar. Pazaryerleri / çok markalı mağazalar hariç —
+# yoksa source'u "Trendyol" olan her sonuç rakip sayılırdı.
+MULTI_BRAND_STORES = {"Trendyol", "Hepsiburada", "Boyner", "Beymen", "ASOS"}
+RIVAL_BRAND_TERMS = list(dict.fromkeys(RIVAL_BRANDS + [b.lower() for b in BRAND_MAP.values() if b not in MULTI_BRAND_STORES]))
+
+@lru_cache(maxsize=1024)
+def rival_pattern(brand_lower, extended=True):
+    """Hedef marka için tüm rakiplerin tek word-boundary regex'i (marka başına bir kez derlenir) | None.
+    extended=False → sadece çekirdek RIVAL_BRANDS listesi."""
+    rivals = [rb for rb in (RIVAL_BRAND_TERMS if extended else RIVAL_BRANDS) if rb not in brand_lower and brand_lower not in rb]
+    if not rivals: return None
+    return re.compile(r"\b(?:" + "|".join(re.escape(rb) for rb in sorted(rivals, key=len, reverse=True)) + r")\b")
+
+def rival_patterns(piece_brand):
+    """Sırayla denenecek rakip regex'leri: genişletilmiş, sonra çekirdek liste (ilk None'da kesilir)."""
+    if not piece_brand or piece_brand == "?" or len(piece_brand) < 3: return []
     brand_lower = piece_brand.lower().strip()
-    filtered = []
-    for r in results:
-        combined = (r.get("title", "") + " " + r.get("source", "")).lower()
-        is_rival = False
-        for rb in RIVAL_BRANDS:
-            if re.search(rf'\b{re.escape(rb)}\b', combined) and rb not in brand_lower and brand_lower not in rb:
-                is_rival = True; break
-        if not is_rival: filtered.append(r)
-    return filtered if filtered else results
+    pats = []
+    for extended in (True, False):
+        rivals = rival_pattern(brand_lower, extended)
+        if rivals is None: break
+        pats.append(rivals)
+    return pats
+
+def rival_flags(r, pats):
+    """Sonuç her rakip regex'ine takılıyor mu — varışta bir kez hesaplanır (PieceRanker)."""
+    text = (r.get("title", "") + " " + r.get("source", "")).lower()
+    return tuple(p.search(text) is not None for p in pats)
+
+def select_non_rivals(items, flags):
+    """flags[j] = items[j]'nin rival_flags'i → ilk boş olmayan hedef-dışı alt küme, hiçbiri yoksa hepsi."""
+    for m in range(len(flags[0]) if flags else 0):
+        kept = [it for it, f in zip(items, flags) if not f[m]]
+        if kept: return kept
+    return items
+
+def filter_rival_brands(results, piece_brand):
+    """Rakip marka sonuçlarını ele. Hepsi rakipse: çekirdek listeyle en iyi hedef-dışı alt küme
+    (ör. "Mavi" için LC Waikiki / H&M'i tut, Nike / Zara'yı at); o da boşsa sonuçların tamamı."""
+    pats = rival_patterns(piece_brand)
+    return select_non_rivals(results, [rival_flags(r, pats) for r in results])
 
 # 🛡️ KALKAN BUG FIX: Claude "Watch" (büyük W) dönerse → "watch" olarak map'e
 def get_category_key(cat):
@@ -666,138 +1058,648 @@ def build_ocr_query(brand, visible_text, color, category, lang_cfg):
     query = " ".join(parts).strip()
     return query if len(query) > 4 else ""
 
+# ─── IMAGE HOST RACE: tercihli host başlar, UPLOAD_STAGGER sn içinde dönmezse (veya hata verirse) sıradaki ───
+# eklenir; ilk geçerli URL kazanır, kalanlar iptal. Host sırası başarı oranı + gecikmeye göre kendiliğinden değişir.
+UPLOAD_RACE = os.environ.get("UPLOAD_RACE", "1") != "0"  # 0 → sadece hata olunca sıradakine geç (eski davranış)
+UPLOAD_STAGGER = float(os.environ.get("UPLOAD_STAGGER", "1.5"))
+UPLOAD_HOST_STATS = {}  # host → {"ok", "fail", "cancelled", "latency" (EWMA sn)}
+
+async def _upload_imgur(c, img_bytes):
+    r = await c.post("https://api.imgur.com/3/image", headers={"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}, files={"image": ("i.jpg", img_bytes, "image/jpeg")}, timeout=30)
+    if r.status_code == 200: return r.json().get("data", {}).get("link", "")
+
+async def _upload_catbox(c, img_bytes):
+    r = await c.post("https://litterbox.catbox.moe/resources/internals/api.php", data={"reqtype": "fileupload", "time": "1h"}, files={"fileToUpload": ("i.jpg", img_bytes, "image/jpeg")}, timeout=30)
+    if r.status_code == 200 and r.text.startswith("http"): return r.text.strip()
+
+async def _upload_tmpfiles(c, img_bytes):
+    r = await c.post("https://tmpfiles.org/api/v1/upload", files={"file": ("i.jpg", img_bytes, "image/jpeg")}, timeout=30)
+    if r.status_code == 200:
+        u = r.json().get("data", {}).get("url", "")
+        if u: return u.replace("tmpfiles.org/", "tmpfiles.org/dl/")
+
+UPLOAD_HOSTS = {"imgur": _upload_imgur, "catbox": _upload_catbox, "tmpfiles": _upload_tmpfiles}  # varsayılan tercih sırası
+
+def _host_stat(name):
+    return UPLOAD_HOST_STATS.setdefault(name, {"ok": 0, "fail": 0, "cancelled": 0, "latency": None})
+
+def _record_host(name, latency, ok=None):
+    """ok=None → iptal edilen yarış kaybedeni: gecikme sadece alt sınır, başarı sayılmaz. Gerçek süre
+    ≥ geçen süre olduğundan tahmini yalnızca yukarı çekebilir — yavaş host'un EWMA'sı aşağı inmez."""
+    st = _host_stat(name)
+    if ok is None:
+        st["cancelled"] += 1
+        cur = st["latency"] if st["latency"] is not None else UPLOAD_STAGGER
+        if latency > cur: st["latency"] = 0.7 * cur + 0.3 * latency
+        return
+    st["ok" if ok else "fail"] += 1
+    st["latency"] = latency if st["latency"] is None else 0.7 * st["latency"] + 0.3 * latency
+
+def upload_host_order():
+    """Beklenen süre ≈ gecikme / başarı oranı (Laplace). Veri yokken varsayılan sıra korunur (stable sort)."""
+    def expected(name):
+        st = _host_stat(name)
+        rate = (st["ok"] + 1) / (st["ok"] + st["fail"] + 2)
+        return (st["latency"] if st["latency"] is not None else UPLOAD_STAGGER) / rate
+    hosts = [h for h in UPLOAD_HOSTS if h != "imgur" or IMGUR_CLIENT_ID]
+    return sorted(hosts, key=expected)
+
 async def upload_img(img_bytes):
-    async with httpx.AsyncClient(timeout=30) as c:
-        if IMGUR_CLIENT_ID:
-            try:
-                r = await c.post("https://api.imgur.com/3/image", headers={"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}, files={"image": ("i.jpg", img_bytes, "image/jpeg")})
-                if r.status_code == 200: return r.json().get("data", {}).get("link", "")
-            except Exception: pass
-        try:
-            r = await c.post("https://litterbox.catbox.moe/resources/internals/api.php", data={"reqtype": "fileupload", "time": "1h"}, files={"fileToUpload": ("i.jpg", img_bytes, "image/jpeg")})
-            if r.status_code == 200 and r.text.startswith("http"): return r.text.strip()
-        except Exception: pass
+    c = http_client("upload")
+
+    async def attempt(name):
+        t = time.time()
         try:
-            r = await c.post("https://tmpfiles.org/api/v1/upload", files={"file": ("i.jpg", img_bytes, "image/jpeg")})
-            if r.status_code == 200:
-                u = r.json().get("data", {}).get("url", "")
-                if u: return u.replace("tmpfiles.org/", "tmpfiles.org/dl/")
-        except Exception: pass
-    return None
+            url = await UPLOAD_HOSTS[name](c, img_bytes)
+        except asyncio.CancelledError:
+            _record_host(name, time.time() - t)
+            raise
+        except Exception:
+            url = None
+        _record_host(name, time.time() - t, bool(url))
+        return url
+
+    queue, racing = upload_host_order(), set()
+    try:
+        while queue or racing:
+            if queue:
+                racing.add(asyncio.ensure_future(attempt(queue.pop(0))))
+            # Stagger dolunca ya da bir host hata verince sıradaki host yarışa girer
+            done, racing = await asyncio.wait(racing, timeout=UPLOAD_STAGGER if (queue and UPLOAD_RACE) else None,
+                                              return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.result(): return t.result()
+        return None
+    finally:
+        for t in racing: t.cancel()
+
+# ─── SELF-HOSTED TMPIMG: Lens görselini 3. parti host'a yüklemek yerine kendi kısa ömürlü store'umuzdan ver ───
+# İçerik adresli (md5), HMAC imzalı + süreli URL → SerpAPI görseli /api/tmpimg/{digest}'ten çeker (upload round-trip'i yok).
+# SADECE TEK INSTANCE: store bu process'in belleğinde. Birden fazla worker / replica varsa SerpAPI'nin isteği başka
+# instance'a düşer (404/403) — bu yüzden opt-in: açık PUBLIC_BASE_URL verilmedikçe kapalı, upload_img kullanılır.
+# Lens boş döndü ve görsel bu instance'tan hiç çekilmediyse upload_img ile bir kez daha denenir (tmpimg_missed);
+# TMPIMG_MAX_MISSES ardışık ıskada tmpimg bu process için kapatılır.
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "")
+TMPIMG_TTL = int(os.environ.get("TMPIMG_TTL", "900"))  # ≥ SESSION_TTL: session'daki img_url search-piece'e kadar geçerli kalsın
+TMPIMG_MAX_MB = int(os.environ.get("TMPIMG_MAX_MB", "64"))
+TMPIMG_SWEEP_INTERVAL = 60
+TMPIMG_MAX_MISSES = int(os.environ.get("TMPIMG_MAX_MISSES", "3"))
+# Restart'ta eski URL'ler geçersiz olur — zaten kısa ömürlü
+TMPIMG_SECRET = (os.environ.get("TMPIMG_SECRET", "") or os.urandom(16).hex()).encode()
+# Bytes objesi DETECT_SESSIONS crop_data / img_bytes ile aynı referans — ikinci kopya tutulmaz
+TMPIMG_STORE = TTLCache({"tmpimg": TMPIMG_MAX_MB * 1024 * 1024}, default_budget=0, ttl=TMPIMG_TTL)
+TMPIMG = {"enabled": bool(PUBLIC_BASE_URL), "served": {}, "misses": 0}  # served: digest → SerpAPI'nin çektiği an
+
+def _tmpimg_sig(digest, exp):
+    return hmac.new(TMPIMG_SECRET, f"{digest}.{exp}".encode(), sha256).hexdigest()[:32]
+
+def tmpimg_put(img_bytes):
+    """Görseli store'a koy → imzalı public URL (kapalıysa / bütçeye sığmazsa None)."""
+    if not TMPIMG["enabled"] or len(img_bytes) > TMPIMG_STORE.budgets["tmpimg"]: return None
+    digest = img_digest(img_bytes)
+    TMPIMG_STORE.set(f"tmpimg:{digest}", img_bytes)
+    exp = int(time.time()) + TMPIMG_TTL
+    return f"{PUBLIC_BASE_URL.rstrip('/')}/api/tmpimg/{digest}?exp={exp}&sig={_tmpimg_sig(digest, exp)}"
+
+async def publish_img(img_bytes):
+    """Lens'e verilecek public URL: önce kendi tmpimg store'umuz, olmazsa 3. parti host yarışı."""
+    return tmpimg_put(img_bytes) or await upload_img(img_bytes)
+
+def tmpimg_missed(url, empty):
+    """Lens çağrısı bitti: url bizim tmpimg URL'imizse ve sonuç boşken SerpAPI görseli bu instance'tan hiç
+    çekmediyse True (istek başka replica'ya düştü / erişilemedi) → çağıran upload_img ile tekrar dener."""
+    prefix = f"{PUBLIC_BASE_URL.rstrip('/')}/api/tmpimg/"
+    if not PUBLIC_BASE_URL or not url.startswith(prefix): return False
+    served = TMPIMG["served"].pop(url[len(prefix):].split("?", 1)[0], None) is not None
+    if served or not empty:
+        TMPIMG["misses"] = 0
+        return False
+    TMPIMG["misses"] += 1
+    if TMPIMG["enabled"] and TMPIMG["misses"] >= TMPIMG_MAX_MISSES:
+        TMPIMG["enabled"] = False
+        print(f"⚠️ tmpimg: {TMPIMG['misses']} Lens isteği görseli bu instance'tan çekmedi (çok instance?) → kapatıldı, upload_img")
+    return True
+
+@app.get("/api/tmpimg/{digest}")
+async def tmpimg(digest: str, exp: int = 0, sig: str = ""):
+    if exp < time.time() or not hmac.compare_digest(sig, _tmpimg_sig(digest, exp)):
+        raise HTTPException(403, "Expired or invalid signature")
+    data = TMPIMG_STORE.get(f"tmpimg:{digest}")
+    if data is None: raise HTTPException(404, "Not found")
+    TMPIMG["served"][digest] = time.time()
+    return Response(content=data, media_type="image/png" if data[:4] == b"\x89PNG" else "image/jpeg",
+                    headers={"Cache-Control": f"private, max-age={max(0, exp - int(time.time()))}"})
+
+@app.on_event("startup")
+async def start_tmpimg_sweeper():
+    async def sweep():
+        while True:
+            await asyncio.sleep(TMPIMG_SWEEP_INTERVAL)
+            n = TMPIMG_STORE.purge()
+            old = [d for d, ts in TMPIMG["served"].items() if time.time() - ts > TMPIMG_TTL]
+            for d in old: del TMPIMG["served"][d]
+            if n: print(f"🧹 tmpimg sweep: {n} expired")
+    if PUBLIC_BASE_URL:
+        spawn(sweep())
+        print(f"✅ tmpimg store → {PUBLIC_BASE_URL}/api/tmpimg (ttl={TMPIMG_TTL}s, {TMPIMG_MAX_MB}MB, tek instance)")
 
 REMOVEBG_KEY = os.environ.get("REMOVEBG_KEY", "")
 
+# ─── REMBG: lazy session (process başına bir kez) ───
+# Clothing-specific model, general fallback. Batched çıkarım: REMBG_BATCH_SPECS (bkz. remove_bg_batch)
+REMBG_MODELS = tuple(m.strip() for m in os.environ.get("REMBG_MODELS", "u2net_cloth_seg,u2net").split(",") if m.strip())
+_REMBG = {"session": None, "state": "cold", "model": None, "load_s": None, "error": None, "batch": None}
+_REMBG_LOCK = threading.Lock()
+
+def get_rembg_session():
+    """İlk çağrıda modeli yükler (thread-safe); yüklenemezse None ve state=failed (tekrar denenmez)."""
+    if _REMBG["session"] is not None or not HAS_REMBG: return _REMBG["session"]
+    with _REMBG_LOCK:
+        if _REMBG["session"] is None and _REMBG["state"] != "failed":
+            _REMBG["state"] = "loading"
+            t = time.time()
+            from rembg import new_session
+            for model in REMBG_MODELS:
+                try:
+                    _REMBG["session"] = new_session(model)
+                    _REMBG.update(state="ready", model=model, load_s=round(time.time() - t, 2), error=None)
+                    print(f"✅ rembg loaded ({model}, {_REMBG['load_s']}s, pid={os.getpid()})")
+                    break
+                except Exception as e:
+                    _REMBG["error"] = str(e)[:200]
+            else:
+                _REMBG["state"] = "failed"
+                print(f"⚠️ rembg load failed: {_REMBG['error']}")
+    return _REMBG["session"]
+
+def rembg_state():
+    return {k: v for k, v in _REMBG.items() if k != "session"}
+
 def remove_bg(img_bytes):
     """Local rembg — manual mode fallback."""
     if not HAS_REMBG: return img_bytes
     try:
-        result = rembg_remove(img_bytes, session=rembg_session)
-        img = Image.open(io.BytesIO(result)).convert("RGBA")
-        bbox = img.getbbox()
-        if bbox: img = img.crop(bbox)
-        bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
-        bg.paste(img, mask=img.split()[3])
-        bg = ImageOps.expand(bg, border=int(max(bg.size) * 0.05), fill='white')
-        buf = io.BytesIO()
-        bg.convert("RGB").save(buf, format="JPEG", quality=95)
-        return buf.getvalue()
+        session = get_rembg_session()
+        if session is None: return img_bytes
+        from rembg import remove as rembg_remove
+        result = rembg_remove(img_bytes, session=session)
+        return _white_bg_jpeg(Image.open(io.BytesIO(result)).convert("RGBA"))
     except Exception: return img_bytes
 
+def _white_bg_jpeg(img):
+    """RGBA cutout → ürüne kırp, beyaz zemin + %5 kenar boşluğu → JPEG."""
+    bbox = img.getbbox()
+    if bbox: img = img.crop(bbox)
+    bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
+    bg.paste(img, mask=img.split()[3])
+    bg = ImageOps.expand(bg, border=int(max(bg.size) * 0.05), fill='white')
+    return encode_jpeg(bg.convert("RGB"), 95)
+
+def _u2net_masks(pred, size):
+    """rembg u2net predict() ile aynı: (1, H, W) çıktı → görsel başına min-max → tek L maske."""
+    pred = pred[0]
+    lo, hi = pred.min(), pred.max()
+    mask = Image.fromarray(((pred - lo) / max(hi - lo, 1e-6) * 255).astype("uint8"), "L")
+    return [mask.resize(size, Image.LANCZOS)]
+
+def _cloth_masks(pred, size):
+    """rembg u2net_cloth_seg predict() ile aynı: (4, H, W) sınıf logit'leri → argmax (log_softmax sırayı
+    değiştirmez) → LANCZOS → upper / lower / full maskeleri (palette dönüşümü = sınıf eşitliği)."""
+    cls = Image.fromarray(pred.argmax(0).astype("uint8"), "L").resize(size, Image.LANCZOS)
+    return [cls.point([255 if v == k else 0 for v in range(256)]) for k in (1, 2, 3)]
+
+# Batched çıkarım yapılabilen session'lar → (girdi boyutu, maske fonksiyonu). Her batch tek boyutta birleşir.
+REMBG_BATCH_SPECS = {
+    "U2netSession": ((320, 320), _u2net_masks),
+    "U2netpSession": ((320, 320), _u2net_masks),
+    "U2netHumanSegSession": ((320, 320), _u2net_masks),
+    "SiluetaSession": ((320, 320), _u2net_masks),
+    "Unet2ClothSession": ((768, 768), _cloth_masks),
+}
+
+def _cutout(im, masks):
+    """rembg remove() ile aynı: maske başına naive cutout, birden fazlaysa alt alta birleştirilir."""
+    rgba = im.convert("RGBA")
+    cuts = [Image.composite(rgba, Image.new("RGBA", im.size, 0), m) for m in masks]
+    out = Image.new("RGBA", (im.width, im.height * len(cuts)))
+    for k, c in enumerate(cuts): out.paste(c, (0, im.height * k))
+    return out
+
+def remove_bg_batch(images):
+    """N görsel → N temiz JPEG. Batch destekli modellerde (REMBG_BATCH_SPECS: u2net ailesi 320px, varsayılan
+    u2net_cloth_seg 768px) tek batched ONNX çağrısı: girdiler modelin sabit boyutuna normalize edilip tek
+    tensörde birleştirilir, maskeler görsel başına orijinal boyuta geri ölçeklenir. Batch desteklemeyen
+    export'lar ve diğer modeller tek tek çalışır."""
+    session = get_rembg_session() if HAS_REMBG else None
+    if session is None: return list(images)
+    spec = REMBG_BATCH_SPECS.get(type(session).__name__)
+    if len(images) > 1 and spec and _REMBG["batch"] is not False:
+        try:
+            import numpy as np
+            size, masks_of = spec
+            imgs = [ImageOps.exif_transpose(Image.open(io.BytesIO(b))).convert("RGB") for b in images]  # remove() gibi
+            feeds = [session.normalize(im, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), size) for im in imgs]
+            name = next(iter(feeds[0]))
+            preds = session.inner_session.run(None, {name: np.concatenate([f[name] for f in feeds])})[0]
+            _REMBG["batch"] = True
+            out = []
+            for pred, im, raw in zip(preds, imgs, images):
+                try:
+                    out.append(_white_bg_jpeg(_cutout(im, masks_of(pred, im.size))))
+                except Exception:
+                    out.append(raw)
+            return out
+        except Exception as e:
+            _REMBG["batch"] = False  # Model sabit batch=1 ile export edilmiş → bundan sonra tek tek
+            print(f"⚠️ rembg batch disabled: {e}")
+    return [remove_bg(b) for b in images]
+
 async def remove_bg_api(img_bytes):
     """remove.bg API — hızlı, 0 CPU yükü, auto mode için."""
     if not REMOVEBG_KEY:
         print("  remove.bg: NO API KEY, using raw crop")
         return img_bytes
     try:
-        async with httpx.AsyncClient(timeout=15) as c:
-            r = await c.post("https://api.remove.bg/v1.0/removebg",
-                headers={"X-Api-Key": REMOVEBG_KEY},
-                files={"image_file": ("img.jpg", img_bytes, "image/jpeg")},
-                data={"size": "auto", "bg_color": "FFFFFF", "format": "jpg", "type": "product"})
-            if r.status_code == 200 and len(r.content) > 1000:
-                print(f"  remove.bg OK ({len(r.content)//1024}KB)")
-                return r.content
-            else:
-                print(f"  remove.bg FAIL: status={r.status_code}")
+        r = await http_client("upload").post("https://api.remove.bg/v1.0/removebg",
+            headers={"X-Api-Key": REMOVEBG_KEY},
+            files={"image_file": ("img.jpg", img_bytes, "image/jpeg")},
+            data={"size": "auto", "bg_color": "FFFFFF", "format": "jpg", "type": "product"},
+            timeout=15)
+        if r.status_code == 200 and len(r.content) > 1000:
+            print(f"  remove.bg OK ({len(r.content)//1024}KB)")
+            return r.content
+        else:
+            print(f"  remove.bg FAIL: status={r.status_code}")
     except Exception as e:
         print(f"  remove.bg ERR: {e}")
     return img_bytes
 
 # ─── 🌟 THE MAGIC FIX: KUSURSUZ MATEMATİK MOTORU ───
-def crop_piece(img_obj, box):
-    """Matematiksel bug'ı çözer. Claude 0-1, 0-100 veya 0-1000 verse bile mükemmel keser!"""
+def encode_jpeg(img, quality=95):
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+def crop_region(img_obj, box):
+    """box_2d → padding'li, ≤1024px PIL crop (encode etmeden). Claude 0-1, 0-100 veya 0-1000 verse bile mükemmel keser!"""
+    w, h = img_obj.size
+    t_val, l_val, b_val, r_val = [float(v) for v in box]
+
+    max_val = max(box)
+    if max_val <= 1.0 and sum(box) > 0:
+        scale = 1.0
+    elif max_val <= 100.0:
+        scale = 100.0
+    else:
+        scale = 1000.0
+
+    top_pct, left_pct = max(0.0, t_val / scale), max(0.0, l_val / scale)
+    bottom_pct, right_pct = min(1.0, b_val / scale), min(1.0, r_val / scale)
+
+    # AI sol ve sağı karıştırırsa düzelt (Dyslexia Fix)
+    if left_pct > right_pct: left_pct, right_pct = right_pct, left_pct
+    if top_pct > bottom_pct: top_pct, bottom_pct = bottom_pct, top_pct
+
+    top, left = int(top_pct * h), int(left_pct * w)
+    bottom, right = int(bottom_pct * h), int(right_pct * w)
+
+    # Hata Güvenliği: Kutu çok küçükse %20 minimum'a genişlet
+    min_dim = int(max(w, h) * 0.20)
+    if (right - left) < min_dim:
+        cx = (left + right) // 2
+        left = max(0, cx - min_dim // 2)
+        right = min(w, cx + min_dim // 2)
+    if (bottom - top) < min_dim:
+        cy = (top + bottom) // 2
+        top = max(0, cy - min_dim // 2)
+        bottom = min(h, cy + min_dim // 2)
+
+    # %20 Nefes payı (Lens'e geniş bağlam ver)
+    pad_y, pad_x = int((bottom - top) * 0.20), int((right - left) * 0.20)
+    px1, py1 = max(0, left - pad_x), max(0, top - pad_y)
+    px2, py2 = min(w, right + pad_x), min(h, bottom + pad_y)
+
+    cropped = img_obj.crop((px1, py1, px2, py2))
+    cropped.thumbnail((1024, 1024))
+    return cropped
+
+# ─── IMAGE PIPELINE: upload bir kez decode edilir, türev boyutlar bellekte, her çıktı bir kez encode ───
+# JPEG'de draft() küçültmeyi DCT aşamasında yapar (1/2–1/8): 12MP telefon fotoğrafı 1400px için tam çözülmez.
+class ImagePipeline:
+    def __init__(self, contents, max_side=1400):
+        self.raw = contents
+        self.max_side = max_side
+        self.raw_fallback = False
+        self._views = {}  # max_side → RGB PIL.Image
+        self._jpegs = {}  # (max_side, quality) → bytes
+        try:
+            img = Image.open(io.BytesIO(contents))
+            if img.format == "JPEG":
+                img.draft("RGB", (max_side, max_side))  # Hedefin altına inmez — kalite thumbnail'de
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            img.thumbnail((max_side, max_side))
+        except Exception:
+            # Eski davranış: EXIF/resize olmadan decode, Claude'a ham byte'lar gider
+            img = Image.open(io.BytesIO(contents)).convert("RGB")
+            self.raw_fallback = True
+        self._views[max_side] = img
+
+    @property
+    def image(self):
+        return self._views[self.max_side]
+
+    def view(self, max_side):
+        """≤max_side türevi — bir kez, en küçük uygun büyük görünümden küçültülür."""
+        if max_side >= self.max_side: return self.image
+        if max_side not in self._views:
+            src = self._views[min(s for s in self._views if s > max_side)]
+            v = src.copy()
+            v.thumbnail((max_side, max_side))
+            self._views[max_side] = v
+        return self._views[max_side]
+
+    def jpeg(self, max_side=None, quality=95):
+        key = (max_side or self.max_side, quality)
+        if self.raw_fallback and key[0] == self.max_side: return self.raw
+        if key not in self._jpegs:
+            self._jpegs[key] = encode_jpeg(self.view(key[0]), quality)
+        return self._jpegs[key]
+
+    def crop(self, box, thumbs=()):
+        """Lens crop'u (≤1024px, q95) + thumbs=[(px, quality)] için UI data-URI'leri → (bytes|None, {px: uri}).
+        Crop, thumbnail için yeniden decode edilmez."""
+        try:
+            region = crop_region(self.image, box)
+        except Exception as e:
+            print(f"Crop err: {e}"); return None, {}
+        uris = {}
+        for px, q in thumbs:
+            t = region.copy()
+            t.thumbnail((px, px))
+            uris[px] = "data:image/jpeg;base64," + base64.b64encode(encode_jpeg(t, q)).decode()
+        return encode_jpeg(region, 95), uris
+
+# ─── DECODE GUARD: boyut sınırı pool'a gönderilmeden önce, yalnız header okunarak (piksel çözülmez) ───
+# Büyük PNG/HEIC tam çözülür (100MP RGB ≈ 300MB) — worker'ı OOM'a sokmadan, pipe'a yüklemeden reddedilir.
+# JPEG draft() ile 1/8'e kadar küçültülerek çözülür — ona yalnız PIL'in decompression-bomb tavanı (~179MP) uygulanır.
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", "25")) * 1024 * 1024
+MAX_DECODE_PIXELS = int(float(os.environ.get("MAX_DECODE_MP", "40")) * 1_000_000)
+
+class ImageTooLarge(ValueError):
+    pass
+
+def check_decode_size(contents):
+    """Upload pool'a gitmeden: byte ve header'daki piksel sınırı → aşılırsa ImageTooLarge.
+    Header okunamıyorsa karar decode job'unun (ham byte fallback'i)."""
+    if len(contents) > MAX_UPLOAD_BYTES:
+        raise ImageTooLarge(f"Image too large ({len(contents) // (1024 * 1024)}MB > {MAX_UPLOAD_BYTES // (1024 * 1024)}MB)")
     try:
-        w, h = img_obj.size
-        t_val, l_val, b_val, r_val = [float(v) for v in box]
-
-        max_val = max(box)
-        if max_val <= 1.0 and sum(box) > 0:
-            scale = 1.0
-        elif max_val <= 100.0:
-            scale = 100.0
-        else:
-            scale = 1000.0
-
-        top_pct, left_pct = max(0.0, t_val / scale), max(0.0, l_val / scale)
-        bottom_pct, right_pct = min(1.0, b_val / scale), min(1.0, r_val / scale)
-
-        # AI sol ve sağı karıştırırsa düzelt (Dyslexia Fix)
-        if left_pct > right_pct: left_pct, right_pct = right_pct, left_pct
-        if top_pct > bottom_pct: top_pct, bottom_pct = bottom_pct, top_pct
-
-        top, left = int(top_pct * h), int(left_pct * w)
-        bottom, right = int(bottom_pct * h), int(right_pct * w)
-
-        # Hata Güvenliği: Kutu çok küçükse %20 minimum'a genişlet
-        min_dim = int(max(w, h) * 0.20)
-        if (right - left) < min_dim:
-            cx = (left + right) // 2
-            left = max(0, cx - min_dim // 2)
-            right = min(w, cx + min_dim // 2)
-        if (bottom - top) < min_dim:
-            cy = (top + bottom) // 2
-            top = max(0, cy - min_dim // 2)
-            bottom = min(h, cy + min_dim // 2)
-
-        # %20 Nefes payı (Lens'e geniş bağlam ver)
-        pad_y, pad_x = int((bottom - top) * 0.20), int((right - left) * 0.20)
-        px1, py1 = max(0, left - pad_x), max(0, top - pad_y)
-        px2, py2 = min(w, right + pad_x), min(h, bottom + pad_y)
-
-        cropped = img_obj.crop((px1, py1, px2, py2))
-        cropped.thumbnail((1024, 1024))
-        buf = io.BytesIO()
-        cropped.save(buf, format="JPEG", quality=95)
-        return buf.getvalue()
+        img = Image.open(io.BytesIO(contents))
+    except Image.DecompressionBombError:
+        raise ImageTooLarge("Image too large (pixels)") from None
+    except Exception:
+        return
+    w, h = img.size
+    if img.format != "JPEG" and w * h > MAX_DECODE_PIXELS:
+        raise ImageTooLarge(f"Image too large ({w}x{h})")
+
+# ─── CPU POOL: PIL decode/resize/encode + rembg ayrı process'lerde ───
+# GIL'e takılan to_thread yerine çekirdeklere yayılır; ağır görsel endpoint'leri ucuz JSON endpoint'lerini
+# bekletmez. Job'lar modül seviyesinde, picklable bytes-in/bytes-out fonksiyonlar (worker'lar modülü import eder).
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))  # Container CPU kısıtına saygı
+    except AttributeError:
+        return os.cpu_count() or 1
+
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(min(_cpu_count(), 8))))  # 0 → havuz kapalı (to_thread)
+CPU_QUEUE = int(os.environ.get("CPU_QUEUE", str(max(CPU_WORKERS, 1) * 4)))  # Havuzdaki max iş (çalışan + sırada)
+CPU_QUEUE_WAIT = float(os.environ.get("CPU_QUEUE_WAIT", "10"))  # Havuz doluyken max bekleme → CPUPoolBusy
+# rembg ayrı, boyutu sınırlı havuzda: model (~170MB ONNX + arena) sadece bu worker'larda yüklenir
+REMBG_WORKERS = int(os.environ.get("REMBG_WORKERS", "1"))  # 0 → web process'inde (to_thread)
+REMBG_QUEUE = int(os.environ.get("REMBG_QUEUE", "2"))  # 8GB RAM → aynı anda max 2 rembg işi
+REMBG_WARM = os.environ.get("REMBG_WARM", "") == "1"  # Startup'ta modeli arka planda yükle
+
+class CPUPoolBusy(RuntimeError):
+    pass
+
+class CPUPool:
+    """ProcessPoolExecutor + sınırlı kuyruk. Havuz doluysa istek asyncio'da bekler (payload'lar worker
+    pipe'ına yığılmaz); CPU_QUEUE_WAIT aşılırsa CPUPoolBusy. Ölen worker (OOM vb.) havuzu yeniden kurar.
+    workers=0 → to_thread (aynı kuyruk sınırıyla). Worker'lar ilk işte spawn edilir."""
+
+    def __init__(self, name, workers, queue):
+        self.name = name
+        self.workers = workers
+        self.queue = max(queue, 1)
+        self.slots = asyncio.Semaphore(self.queue)
+        self.executor = None
+        self.inflight = 0
+        self.stats = {"jobs": 0, "errors": 0, "busy": 0, "restarts": 0, "wall_s": 0.0}
+
+    def start(self):
+        if self.workers > 0 and self.executor is None:
+            # spawn: fork, onnxruntime/httpx thread'leri varken güvenli değil
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), CPU_QUEUE_WAIT)
+        except asyncio.TimeoutError:
+            self.stats["busy"] += 1
+            raise CPUPoolBusy(f"{self.name} pool full ({self.inflight} jobs)")
+        ex = self.executor
+        self.inflight += 1
+        t = time.perf_counter()
+        try:
+            if ex is None:
+                return await asyncio.to_thread(fn, *args)
+            return await asyncio.get_running_loop().run_in_executor(ex, fn, *args)
+        except BrokenProcessPool:
+            self.stats["errors"] += 1
+            if self.executor is ex:
+                print(f"⚠️ {self.name} pool broken → restarting")
+                self.stats["restarts"] += 1
+                self.executor = None
+                ex.shutdown(wait=False, cancel_futures=True)
+                self.start()
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+            self.stats["jobs"] += 1
+            self.stats["wall_s"] += time.perf_counter() - t
+
+    def snapshot(self):
+        return {"workers": self.workers if self.executor else 0, "queue": self.queue, "inflight": self.inflight,
+                **{k: round(v, 2) if isinstance(v, float) else v for k, v in self.stats.items()}}
+
+CPU_POOL = CPUPool("cpu", CPU_WORKERS, CPU_QUEUE)
+REMBG_POOL = CPUPool("rembg", REMBG_WORKERS if HAS_REMBG else 0, REMBG_QUEUE)
+# Ana process'in gördüğü model durumu (model rembg worker'ında yaşar; her job sonucu ile güncellenir)
+REMBG_STATE = {"state": "cold" if HAS_REMBG else "unavailable", "model": None, "load_s": None, "error": None}
+
+@app.on_event("startup")
+async def start_cpu_pool():
+    CPU_POOL.start()
+    REMBG_POOL.start()
+    if CPU_POOL.executor:
+        async def warm():
+            # Worker'lar spawn + import maliyetini ilk kullanıcı isteğinden önce ödesin
+            await asyncio.gather(*[CPU_POOL.run(job_ping) for _ in range(CPU_WORKERS)], return_exceptions=True)
+        spawn(warm())
+        print(f"✅ CPU pool: {CPU_WORKERS} workers (queue={CPU_QUEUE})")
+    if HAS_REMBG and REMBG_WARM:
+        spawn(run_rembg(job_rembg_warm))
+
+@app.on_event("shutdown")
+async def stop_cpu_pool():
+    CPU_POOL.shutdown()
+    REMBG_POOL.shutdown()
+
+# ─── CPU JOB'LARI (worker process'te çalışır) ───
+def job_ping():
+    return os.getpid()
+
+def job_decode_upload(contents, max_side=1400, quality=95):
+    """Upload → (Claude JPEG'i, boyut | None (ham byte fallback'i), (dHash, DCT pHash) | None)."""
+    pipe = ImagePipeline(contents, max_side)
+    try:
+        ph = (dhash(pipe.image), phash_dct(pipe.image))
+    except Exception:
+        ph = None
+    return pipe.jpeg(quality=quality), None if pipe.raw_fallback else pipe.image.size, ph
+
+def job_crop_pieces(img_bytes, boxes, thumbs=()):
+    """JPEG byte'ları (tek decode) → her box için (crop_bytes | None, {px: data-URI})."""
+    pipe = ImagePipeline(img_bytes)
+    return [pipe.crop(box, thumbs) for box in boxes]
+
+def job_jpeg_views(img_bytes, max_side, views):
+    """Tek decode → views=[(px | None, quality)] için JPEG byte'ları (None → max_side)."""
+    pipe = ImagePipeline(img_bytes, max_side)
+    return [pipe.jpeg(px, q) for px, q in views]
+
+def job_thumbnail(img_bytes, box, quality):
+    """box içine sığdırılmış JPEG (hof / podyum / url-thumbnail)."""
+    img = Image.open(io.BytesIO(img_bytes))
+    img.draft("RGB", (box[0] * 2, box[1] * 2))  # JPEG: decode sırasında küçült, thumbnail kalitesi korunur
+    img = img.convert("RGB")
+    img.thumbnail(box)
+    return encode_jpeg(img, quality)
+
+def job_upscale(img_bytes, min_side=300, quality=90):
+    """Küçük ürün görselini LANCZOS ile en az min_side'a büyüt → JPEG."""
+    img = Image.open(io.BytesIO(img_bytes))
+    w, h = img.size
+    scale = max(min_side / w, min_side / h)
+    img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
+    return encode_jpeg(img, quality)
+
+def job_remove_bg_batch(images):
+    """rembg worker'ında → ([temiz JPEG], model durumu)."""
+    return remove_bg_batch(images), rembg_state()
+
+def job_rembg_warm():
+    get_rembg_session()
+    return None, rembg_state()
+
+async def run_rembg(job, *args):
+    """REMBG_POOL'da çalıştır, worker'ın model durumunu REMBG_STATE'e yansıt → job'un byte sonucu."""
+    if REMBG_STATE["state"] == "cold": REMBG_STATE["state"] = "loading"
+    try:
+        out, state = await REMBG_POOL.run(job, *args)
     except Exception as e:
-        print(f"Crop err: {e}"); return None
+        # Worker öldüyse yenisi modeli baştan yükleyecek
+        REMBG_STATE.update(state="cold", error=str(e)[:200] or type(e).__name__)
+        print(f"  rembg ERR: {e}")
+        return None
+    REMBG_STATE.update(state)
+    return out
+
+REMBG_BATCH_MAX = int(os.environ.get("REMBG_BATCH_MAX", "4"))  # Batch başına max görsel → sabit bellek tepesi
+REMBG_BATCH_WINDOW = float(os.environ.get("REMBG_BATCH_WINDOW_MS", "15")) / 1000  # İlk istekten sonra toplama penceresi
+
+class RembgBatcher:
+    """Micro-batching: pencere içinde gelen rembg istekleri tek worker job'unda, tek ONNX çağrısında
+    işlenir; sonuçlar bekleyen çağıranlara dağıtılır. Semaphore'un head-of-line beklemesi yerine."""
+
+    def __init__(self):
+        self.pending = []  # [(img_bytes, future)]
+        self.timer = None
+        self.stats = {"batches": 0, "images": 0, "max_batch": 0}
+
+    async def submit(self, img_bytes):
+        """→ temiz JPEG, rembg başarısızsa None."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.append((img_bytes, fut))
+        if len(self.pending) >= REMBG_BATCH_MAX:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(REMBG_BATCH_WINDOW, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch: spawn(self._run(batch))
+
+    async def _run(self, batch):
+        self.stats["batches"] += 1
+        self.stats["images"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        outs = await run_rembg(job_remove_bg_batch, [b for b, _ in batch]) or [None] * len(batch)
+        for (_, fut), out in zip(batch, outs):
+            if not fut.done(): fut.set_result(out)  # Çağıran iptal ettiyse atla
+
+REMBG_BATCHER = RembgBatcher()
+
+async def crop_pieces(img_bytes, boxes, thumbs=()):
+    """Tüm parçaların crop'ları tek CPU job'unda → [(crop_bytes | None, {px: data-URI})]."""
+    if not boxes: return []
+    try:
+        return await CPU_POOL.run(job_crop_pieces, img_bytes, boxes, thumbs)
+    except Exception as e:
+        print(f"  Crop error: {e}")
+        return [(None, {})] * len(boxes)
 
 # ─── Claude Reranker (MANUAL MODE ONLY — auto'da timeout yapar) ───
 async def claude_rerank(original_b64, results, cc="tr", expected_text=""):
     if not ANTHROPIC_API_KEY or len(results) < 2: return results
     candidates = results[:12]
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        async def fetch_thumb(r):
-            url = r.get("thumbnail") or r.get("image") or ""
-            if not url: return None
-            try:
-                if url.startswith("data:image"):
-                    raw = url.split(",", 1)[1] if "," in url else ""
-                    if len(raw) > 100:
-                        raw += "=" * ((4 - len(raw) % 4) % 4)
-                        img_data = base64.b64decode(raw); img = Image.open(io.BytesIO(img_data)).convert("RGB")
-                        img.thumbnail((512, 512)); buf = io.BytesIO(); img.save(buf, format="JPEG", quality=80)
-                        return base64.b64encode(buf.getvalue()).decode()
-                    return None
-                resp = await client.get(url, headers={"User-Agent": "Mozilla/5.0"}, follow_redirects=True)
-                if resp.status_code == 200 and len(resp.content) > 500:
-                    img = Image.open(io.BytesIO(resp.content)).convert("RGB"); img.thumbnail((512, 512))
-                    buf = io.BytesIO(); img.save(buf, format="JPEG", quality=80)
+    client = http_client("fetch")
+    async def fetch_thumb(r):
+        url = r.get("thumbnail") or r.get("image") or ""
+        if not url: return None
+        try:
+            if url.startswith("data:image"):
+                raw = url.split(",", 1)[1] if "," in url else ""
+                if len(raw) > 100:
+                    raw += "=" * ((4 - len(raw) % 4) % 4)
+                    img_data = base64.b64decode(raw); img = Image.open(io.BytesIO(img_data)).convert("RGB")
+                    img.thumbnail((512, 512)); buf = io.BytesIO(); img.save(buf, format="JPEG", quality=80)
                     return base64.b64encode(buf.getvalue()).decode()
-            except Exception: pass
-            return None
-        thumb_data = await asyncio.gather(*[fetch_thumb(r) for r in candidates])
+                return None
+            resp = await client.get(url, headers={"User-Agent": "Mozilla/5.0"}, follow_redirects=True, timeout=10)
+            if resp.status_code == 200 and len(resp.content) > 500:
+                img = Image.open(io.BytesIO(resp.content)).convert("RGB"); img.thumbnail((512, 512))
+                buf = io.BytesIO(); img.save(buf, format="JPEG", quality=80)
+                return base64.b64encode(buf.getvalue()).decode()
+        except Exception: pass
+        return None
+    thumb_data = await asyncio.gather(*[fetch_thumb(r) for r in candidates])
 
     target_info = f'\nUSER IS LOOKING FOR: "{expected_text}"\nCRITICAL WARNING: If Image 0 shows a BACKGROUND object (wall, roof, door, wood) instead of a {expected_text}, REJECT ALL RESULTS (Score 0)!\n' if expected_text else ""
 
@@ -817,27 +1719,27 @@ Explain visual reasoning BEFORE scoring. Return ONLY valid JSON array:
 [{{"idx":1,"reason":"Same zipper...","score":10}}]"""})
 
     try:
-        async with httpx.AsyncClient(timeout=45) as c:
-            r = await c.post("https://api.anthropic.com/v1/messages",
-                headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
-                json={"model": CLAUDE_MODEL, "max_tokens": 800, "messages": [{"role": "user", "content": content}]})
-            text = r.json().get("content", [{}])[0].get("text", "").strip()
-            text = re.sub(r'^```\w*\n?', '', text); text = re.sub(r'\n?```$', '', text)
-            m = re.search(r'\[.*\]', text, re.DOTALL)
-            if m:
-                rankings = json.loads(m.group())
-                reranked, similar, used = [], [], set()
-                for rank in rankings:
-                    idx = rank.get("idx", 0) - 1
-                    score = rank.get("score", 0)
-                    if 0 <= idx < len(candidates) and idx not in used:
-                        item = candidates[idx].copy(); item["match_score"] = score
-                        if score >= 8: item["ai_verified"] = True; reranked.append(item); used.add(idx)
-                        elif score >= 5: item["ai_verified"] = False; similar.append(item); used.add(idx)
-                if reranked or similar: return reranked + similar
-                # Jüri her şeyi çöp buldu → kapı/çatı göstermektense hiç gösterme
-                print(f"  Reranker: tüm sonuçlar <5 puan, çöp elendi")
-                return []
+        r = await http_client("anthropic").post(ANTHROPIC_API_URL,
+            headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
+            json={"model": CLAUDE_MODEL, "max_tokens": 800, "messages": [{"role": "user", "content": content}]},
+            timeout=45)
+        text = r.json().get("content", [{}])[0].get("text", "").strip()
+        text = re.sub(r'^```\w*\n?', '', text); text = re.sub(r'\n?```$', '', text)
+        m = re.search(r'\[.*\]', text, re.DOTALL)
+        if m:
+            rankings = json.loads(m.group())
+            reranked, similar, used = [], [], set()
+            for rank in rankings:
+                idx = rank.get("idx", 0) - 1
+                score = rank.get("score", 0)
+                if 0 <= idx < len(candidates) and idx not in used:
+                    item = candidates[idx].copy(); item["match_score"] = score
+                    if score >= 8: item["ai_verified"] = True; reranked.append(item); used.add(idx)
+                    elif score >= 5: item["ai_verified"] = False; similar.append(item); used.add(idx)
+            if reranked or similar: return reranked + similar
+            # Jüri her şeyi çöp buldu → kapı/çatı göstermektense hiç gösterme
+            print(f"  Reranker: tüm sonuçlar <5 puan, çöp elendi")
+            return []
     except Exception as e: print(f"Reranker err: {e}")
     return results
 
@@ -845,14 +1747,14 @@ async def claude_detect(img_b64, cc="tr"):
     if not ANTHROPIC_API_KEY: return None
     cfg = get_country_config(cc)
     lang, g_m, g_f = cfg["lang"], cfg["gender"]["male"], cfg["gender"]["female"]
-    async with httpx.AsyncClient(timeout=60) as c:
-        try:
-            r = await c.post("https://api.anthropic.com/v1/messages",
-                headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
-                json={"model": CLAUDE_MODEL, "max_tokens": 1500,
-                    "messages": [{"role": "user", "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}},
-                        {"type": "text", "text": f"""You are a fashion product identification expert with EXCEPTIONAL text-reading ability. Your #1 job is reading EVERY piece of text on clothing to help find the exact product in stores.
+    c = http_client("anthropic")
+    try:
+        r = await c.post(ANTHROPIC_API_URL,
+            headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
+            json={"model": CLAUDE_MODEL, "max_tokens": 1500,
+                "messages": [{"role": "user", "content": [
+                    {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}},
+                    {"type": "text", "text": f"""You are a fashion product identification expert with EXCEPTIONAL text-reading ability. Your #1 job is reading EVERY piece of text on clothing to help find the exact product in stores.
 
 Gender: "{g_m}" (male) or "{g_f}" (female).
 
@@ -898,21 +1800,89 @@ For each item return:
 
 Return ONLY valid JSON array:
 [{{"category":"","short_title":"","color":"","brand":"","visible_text":"","style_type":"","search_query_specific":"","search_query_generic":"","box_2d":[0,0,1000,1000]}}]"""}
-                    ]}]})
-            data = r.json()
-            if "error" in data:
-                print(f"Claude API error: {data['error']}")
-                return None
-            text = data.get("content", [{}])[0].get("text", "").strip()
-            text = re.sub(r'^```\w*\n?', '', text); text = re.sub(r'\n?```$', '', text)
-            m = re.search(r'\[.*\]', text, re.DOTALL)
-            if m: return json.loads(m.group())
-        except Exception as e: print(f"Claude err: {e}")
+                ]}]},
+            timeout=60)
+        data = r.json()
+        if "error" in data:
+            print(f"Claude API error: {data['error']}")
+            return None
+        text = data.get("content", [{}])[0].get("text", "").strip()
+        text = re.sub(r'^```\w*\n?', '', text); text = re.sub(r'\n?```$', '', text)
+        m = re.search(r'\[.*\]', text, re.DOTALL)
+        if m: return json.loads(m.group())
+    except Exception as e: print(f"Claude err: {e}")
     return None
 
+# ─── SerpAPI async adapter (GoogleSearch(...).get_dict() yerine, thread hop yok) ───
+async def _serpapi_get(params):
+    eng = params.get("engine", "")
+    t = time.time()
+    r = await http_client("serpapi").get(SERPAPI_BASE_URL.rstrip("/") + "/search",
+        params={**params, "output": "json", "source": "python"}, timeout=SERPAPI_TIMEOUT)
+    d = dict(r.json())
+    SERPAPI_LATENCY.setdefault(eng, deque(maxlen=200)).append(time.time() - t)
+    return d
+
+# ─── HEDGED REQUESTS: Lens p50 ~2 sn ama p99 >10 sn — ilk istek engine'in p{HEDGE_PCT} gecikmesini aşarsa ───
+# aynı isteğin ikinci kopyası gönderilir, önce dönen kazanır, diğeri iptal. HEDGE_MAX_RATIO ek harcamayı sınırlar.
+# Opt-in (hedge=True): yalnız scan / search-piece'in Lens + Shopping çağrıları — arka plan / sayfalama işleri hedge'lenmez.
+HEDGE_PCT = float(os.environ.get("SERPAPI_HEDGE_PCT", "0.9"))
+HEDGE_MIN_SAMPLES = 20  # Bundan az ölçümde sabit gecikme kullan
+HEDGE_DEFAULT_DELAY = float(os.environ.get("SERPAPI_HEDGE_DELAY", "4"))
+HEDGE_MAX_RATIO = float(os.environ.get("SERPAPI_HEDGE_MAX_RATIO", "0.15"))  # engine başına istek/hedge tavanı
+SERPAPI_LATENCY = {}  # engine → deque(son başarılı gecikmeler, sn)
+HEDGE_STATS = {}  # engine → {"requests", "hedged", "hedge_wins"}
+
+def serpapi_latency(engine, q):
+    """engine'in son gecikmelerinden q yüzdeliği (ölçüm yoksa None)."""
+    lat = sorted(SERPAPI_LATENCY.get(engine, ()))
+    if not lat: return None
+    return lat[min(int(len(lat) * q), len(lat) - 1)]
+
+def hedge_delay(engine):
+    if len(SERPAPI_LATENCY.get(engine, ())) < HEDGE_MIN_SAMPLES: return HEDGE_DEFAULT_DELAY
+    return serpapi_latency(engine, HEDGE_PCT)
+
+async def serpapi_search(params, hedge=False):
+    """GoogleSearch(params).get_dict() ile aynı dict'i döndürür — pooled httpx üzerinden, event loop'ta.
+    hedge=True (yalnız gecikme-kritik scan / search-piece Lens + Shopping çağrıları): ilk istek hedge_delay içinde
+    dönmezse hedge kopyası gönderilir; ilk başarılı yanıt döner."""
+    eng = params.get("engine", "")
+    st = HEDGE_STATS.setdefault(eng, {"requests": 0, "hedged": 0, "hedge_wins": 0})
+    st["requests"] += 1
+    t_start = time.time()
+    first = asyncio.ensure_future(_serpapi_get(params))
+    racers = [first]
+    try:
+        if hedge:
+            done, _ = await asyncio.wait(racers, timeout=hedge_delay(eng))
+            if not done and st["hedged"] < st["requests"] * HEDGE_MAX_RATIO:
+                st["hedged"] += 1
+                print(f"  🪁 SerpAPI hedge ({eng}) after {hedge_delay(eng):.1f}s")
+                racers.append(asyncio.ensure_future(_serpapi_get(params)))
+        pending = set(racers)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is not first:
+                        st["hedge_wins"] += 1
+                        # Kaybeden ilk istek ölçülmeden iptal olacak — alt sınırını kaydet, yoksa kuyruk görünmez olur
+                        SERPAPI_LATENCY[eng].append(time.time() - t_start)
+                    return t.result()
+        return first.result()  # Hepsi hata → ilk isteğin hatası
+    finally:
+        for t in racers:
+            if not t.done(): t.cancel()
+
+def budget_exhausted(t_search, engine="google_lens"):
+    """Arama fazının kalan bütçesi engine'in p50 gecikmesinden kısa mı — düşük değerli task'ı hiç başlatma."""
+    p50 = serpapi_latency(engine, 0.5)
+    return t_search is not None and p50 is not None and ANALYZE_DEADLINE - (time.time() - t_search) < p50
+
 DUPE_SITES = ["shein.", "temu.", "aliexpress.", "alibaba.", "cider.", "dhgate.", "wish.", "romwe.", "patpat."]
 
-def _lens(url, cc="tr", lens_type="all"):
+async def _lens(url, cc="tr", lens_type="all", hedge=False):
     """Google Lens API. lens_type: 'all', 'exact_matches', 'visual_matches', 'products'"""
     cfg = get_country_config(cc)
     res, seen = [], set()
@@ -922,7 +1892,7 @@ def _lens(url, cc="tr", lens_type="all"):
         if lens_type != "all":
             params["type"] = lens_type
 
-        d = GoogleSearch(params).get_dict()
+        d = await serpapi_search(params, hedge=hedge)
 
         # 1) EXACT MATCHES — "Tam eşleşmeler" = aynı fotoğraf web'de bulundu
         for m in d.get("exact_matches", []):
@@ -930,7 +1900,7 @@ def _lens(url, cc="tr", lens_type="all"):
             ttl = m.get("title", m.get("source", ""))
             src = m.get("source", "")
             if not lnk or lnk in seen: continue
-            if is_blocked(lnk): continue
+            if is_blocked(lnk, src): continue
             if is_non_fashion_domain(lnk, ttl, src): continue
             # v42: Foreign script filter — TR modunda Kiril/Arapça başlıkları çöpe at
             if cc == "tr" and has_foreign_script(ttl):
@@ -970,7 +1940,7 @@ def _lens(url, cc="tr", lens_type="all"):
         for m in d.get("visual_matches", []):
             lnk, ttl, src = m.get("link", ""), m.get("title", ""), m.get("source", "")
             if not lnk or not ttl or lnk in seen: continue
-            if is_blocked(lnk) or not is_fashion(lnk, ttl, src): continue
+            if is_blocked(lnk, src) or not is_fashion(lnk, ttl, src): continue
             # v42: Skip search/category pages
             if not is_product_url(lnk): continue
             # v42: Foreign script filter
@@ -1009,14 +1979,149 @@ def _lens(url, cc="tr", lens_type="all"):
     res.sort(key=score)
     return res
 
-def _shop(q, cc="tr", limit=6):
+# ─── LENS CACHE: görsel içeriğinin hash'i ile (upload URL'leri tek kullanımlık, key olamaz) ───
+def img_digest(img_bytes):
+    return md5(img_bytes).hexdigest()
+
+def lens_cache_key(digest, cc="tr", lens_type="all"):
+    return f"lens:{cc}:{lens_type}:{digest}"
+
+async def upload_for_lens(img_bytes, cc="tr", lens_type="all", digest=None):
+    """Lens sonucu cache'te olan görseli tekrar yükleme — URL'ye ihtiyaç kalmaz."""
+    digest = digest or img_digest(img_bytes)
+    if cache_get(lens_cache_key(digest, cc, lens_type)): return None
+    return await single_flight(f"upload:{digest}", lambda: publish_img(img_bytes))
+
+async def lens_image(img_bytes, cc="tr", lens_type="all", url=None, upload=True, digest=None, hedge=False):
+    """Görsel byte'ları için cache'li Lens. Hit → upload + SerpAPI atlanır.
+    url verilmişse (önceden yüklenmiş) o kullanılır; upload=False ise yeniden yüklenmez.
+    digest verilmezse byte'ların md5'i kullanılır. hedge: serpapi_search'e."""
+    key = lens_cache_key(digest or img_digest(img_bytes), cc, lens_type)
+    cached = cache_get(key)
+    if cached:
+        print(f"  Lens cache HIT ({lens_type}): {len(cached)} results")
+        return [r.copy() for r in cached]  # Skorlama dict'leri yerinde değiştiriyor
+
+    async def fetch():
+        u = url
+        if not u and upload: u = await single_flight(f"upload:{digest or img_digest(img_bytes)}", lambda: publish_img(img_bytes))
+        if not u: return []
+        res = await _lens(u, cc, lens_type, hedge)
+        if tmpimg_missed(u, not res):
+            # SerpAPI görseli tmpimg'den çekemedi → 3. parti host ile bir kez daha
+            u = await upload_img(img_bytes)
+            res = await _lens(u, cc, lens_type, hedge) if u else []
+        if res: cache_set(key, [r.copy() for r in res])
+        return res
+    res = await single_flight(key, fetch)
+    return [r.copy() for r in res]
+
+# ─── PERCEPTUAL HASH INDEX: aynı fotoğrafın yeniden sıkıştırılmış / boyutlanmış kopyaları ───
+# TikTok'tan aynı kombin onlarca farklı JPEG olarak geliyor — byte hash'i hepsini kaçırır.
+# Yakın kopya bulunursa yalnız ilk upload'ın Claude parça listesi (etiket + sorgular) paylaşılır; crop'lar ve
+# Lens her zaman bu görselin kendi byte'larından (byte md5'i key). Eşleşme için dHash VE DCT pHash yakın olmalı.
+PHASH_INDEX = {}  # dhash(int) → {"digest", "dct", "ts"} (insertion order = yaş)
+PHASH_MAX = 2000
+PHASH_TTL = CACHE_TTL
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", "6"))  # dHash, 128 bit üzerinden Hamming
+PHASH_DCT_MAX_DISTANCE = int(os.environ.get("PHASH_DCT_MAX_DISTANCE", "6"))  # DCT pHash, 64 bit üzerinden
+
+def dhash(img, size=8):
+    """128-bit dHash: (size+1)² grayscale küçültme üzerinde yatay + dikey gradyan bitleri."""
+    g = img.convert("L").resize((size + 1, size + 1), Image.BILINEAR)
+    px = list(g.getdata())
+    w = size + 1
+    h = 0
+    for y in range(size):
+        for x in range(size):
+            h = (h << 1) | (px[y * w + x] > px[y * w + x + 1])
+    for y in range(size):
+        for x in range(size):
+            h = (h << 1) | (px[y * w + x] > px[(y + 1) * w + x])
+    return h
+
+def phash_dct(img, size=8, scale=4):
+    """64-bit DCT pHash: 32×32 grayscale'in en düşük frekanslı 8×8 DCT katsayıları, medyanlarına göre.
+    dHash'ten bağımsız ikinci imza — gradyanı benzeyen farklı fotoğrafları eler."""
+    import numpy as np
+    n = size * scale
+    px = np.asarray(img.convert("L").resize((n, n), Image.BILINEAR), dtype=np.float64)
+    k = np.arange(n)
+    basis = np.cos(np.pi * k[:, None] * (2 * k[None, :] + 1) / (2 * n))  # DCT-II (ölçeksiz)
+    low = (basis @ px @ basis.T)[:size, :size].ravel()
+    h = 0
+    for bit in low > np.median(low):
+        h = (h << 1) | int(bit)
+    return h
+
+def phash_lookup(ph):
+    """ph = (dhash, dct) → iki hash'i de eşik içinde olan en yakın önceki upload: (digest, (d1, d2)) veya (None, None)."""
+    now = time.time()
+    dh, dct = ph
+    best, best_d = None, None
+    for h, e in PHASH_INDEX.items():
+        if now - e["ts"] > PHASH_TTL: continue
+        d1 = bin(h ^ dh).count("1")
+        if d1 > PHASH_MAX_DISTANCE: continue
+        d2 = bin(e["dct"] ^ dct).count("1")
+        if d2 > PHASH_DCT_MAX_DISTANCE: continue
+        if best_d is None or d1 + d2 < sum(best_d):
+            best, best_d = e, (d1, d2)
+            if d1 + d2 == 0: break
+    return (best["digest"], best_d) if best else (None, None)
+
+def phash_register(ph, digest):
+    dh, dct = ph
+    PHASH_INDEX.pop(dh, None)
+    PHASH_INDEX[dh] = {"digest": digest, "dct": dct, "ts": time.time()}
+    while len(PHASH_INDEX) > PHASH_MAX:
+        del PHASH_INDEX[next(iter(PHASH_INDEX))]
+
+def resolve_image_digest(ph, img_bytes):
+    """Upload → (digest, detect_digest). digest: byte md5'i — upload / Lens / crop cache'leri hep gerçek byte'lar.
+    detect_digest: yakın kopya varsa ilk upload'ınki — yalnız Claude parça listesi için.
+    ph: CPU job'unda hesaplanan (dHash, DCT pHash) (None → hesaplanamadı)."""
+    digest = img_digest(img_bytes)
+    if ph is None:
+        return digest, digest
+    canon, dist = phash_lookup(ph)
+    if canon and canon != digest:
+        print(f"  ♻️ Near-duplicate upload (hamming dhash/dct={dist[0]}/{dist[1]}) → reuse pieces of {canon[:10]}")
+    else:
+        canon = digest
+    phash_register(ph, canon)
+    return digest, canon
+
+# ─── CLAUDE DETECT MEMO: görsel digest + ülke → parsed parça listesi ("claude:" namespace, TTL + LRU) ───
+DETECT_CACHE_TTL = int(os.environ.get("DETECT_CACHE_TTL", "86400"))
+
+async def claude_detect_cached(img_b64, digest, cc="tr"):
+    """claude_detect — aynı (veya yakın kopya) fotoğraf için önceki parçaları döndür."""
+    key = f"claude:{cc}:{digest}"
+    cached = cache_get(key)
+    if cached:
+        print(f"  Claude pieces cache HIT ({len(cached)} pieces)")
+        return [dict(p) for p in cached]
+
+    async def fetch():
+        pieces = await claude_detect(img_b64, cc)
+        if pieces: cache_set(key, [dict(p) for p in pieces], DETECT_CACHE_TTL)
+        return pieces
+    pieces = await single_flight(key, fetch)
+    return [dict(p) for p in pieces] if pieces else pieces
+
+async def _shop(q, cc="tr", limit=6, hedge=False):
     cache_key = f"shop:{cc}:{q}"
     cached = cache_get(cache_key)
     if cached: return cached
+    return await single_flight(cache_key, lambda: _shop_fetch(q, cc, limit, cache_key, hedge))
+
+async def _shop_fetch(q, cc, limit, cache_key, hedge=False):
     cfg = get_country_config(cc)
     res, seen = [], set()
     try:
-        d = GoogleSearch({"engine": "google_shopping", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY}).get_dict()
+        d = await serpapi_search({"engine": "google_shopping", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY},
+                                 hedge=hedge)
         for item in d.get("shopping_results", []):
             # Prefer direct store link over Google Shopping comparison page
             direct = item.get("link", "")
@@ -1027,7 +2132,7 @@ def _shop(q, cc="tr", limit=6):
             else:
                 lnk = google_page or direct
             ttl, src = item.get("title", ""), item.get("source", "")
-            if not lnk or not ttl or lnk in seen or is_blocked(lnk): continue
+            if not lnk or not ttl or lnk in seen or is_blocked(lnk, src): continue
             # v42: Skip search/category pages — only direct product links
             if not is_product_url(lnk):
                 print(f"  ⛔ SHOP SKIP (not product URL): {lnk[:80]}")
@@ -1048,22 +2153,25 @@ def _shop(q, cc="tr", limit=6):
 
 
 # ─── Google Regular Search (organic results from fashion sites) ───
-def _google_organic(q, cc="tr", limit=8):
+async def _google_organic(q, cc="tr", limit=8):
     """Normal Google araması — Shopping'de olmayan ürünleri yakalar (Trendyol, Bershka.com, Dolap vs.)"""
     cache_key = f"gorg:{cc}:{q}"
     cached = cache_get(cache_key)
     if cached: return cached
+    return await single_flight(cache_key, lambda: _google_organic_fetch(q, cc, limit, cache_key))
+
+async def _google_organic_fetch(q, cc, limit, cache_key):
     cfg = get_country_config(cc)
     res, seen = [], set()
     try:
-        d = GoogleSearch({"engine": "google", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY, "num": 15}).get_dict()
+        d = await serpapi_search({"engine": "google", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY, "num": 15})
 
         # 1) Inline shopping results (varsa)
         for item in d.get("inline_shopping_results", d.get("shopping_results", [])):
             lnk = item.get("link", "")
             ttl = item.get("title", "")
             src = item.get("source", "")
-            if not lnk or not ttl or lnk in seen or is_blocked(lnk): continue
+            if not lnk or not ttl or lnk in seen or is_blocked(lnk, src): continue
             if not is_fashion(lnk, ttl, src): continue
             seen.add(lnk)
             lnk = localize_url(lnk, cc)
@@ -1079,7 +2187,7 @@ def _google_organic(q, cc="tr", limit=8):
             lnk = item.get("link", "")
             ttl = item.get("title", "")
             src = item.get("displayed_link", item.get("source", ""))
-            if not lnk or not ttl or lnk in seen or is_blocked(lnk): continue
+            if not lnk or not ttl or lnk in seen or is_blocked(lnk, src): continue
             if not is_fashion(lnk, ttl, src): continue
             seen.add(lnk)
             lnk = localize_url(lnk, cc)
@@ -1167,423 +2275,592 @@ def match_lens_to_pieces(lens_results, pieces):
 
 # ─── API ENDPOINTS ───
 
+# ─── FULL-ANALYZE PIPELINE: /api/full-analyze ve /api/full-analyze/stream aynı adımları paylaşır ───
+ALLOWED_CATS = {"jacket", "top", "bottom", "dress", "shoes", "bag", "watch"}
+
+async def decode_upload(contents):
+    """Upload byte'ları → (optimized JPEG, b64, (dHash, DCT pHash)). 1400px: Claude OCR için yüksek çözünürlük.
+    Decode CPU pool'da (önce check_decode_size); crop'lar crop_pieces ile bu JPEG'den kesilir.
+    Havuz dolu/çökmüşse decode web process'inde yapılır — upload bu yüzden reddedilmez."""
+    check_decode_size(contents)
+    try:
+        optimized, size, ph = await CPU_POOL.run(job_decode_upload, contents, 1400)
+    except (CPUPoolBusy, BrokenProcessPool) as e:
+        print(f"  ⚠️ Decode pool {type(e).__name__} → in-process decode")
+        optimized, size, ph = await asyncio.to_thread(job_decode_upload, contents, 1400)
+    if size:
+        print(f"  Image: {size[0]}x{size[1]}, {len(optimized)//1024}KB sent to Claude")
+    return optimized, base64.b64encode(optimized).decode(), ph
+
+def filter_pieces(pieces):
+    pieces = [p for p in pieces if p.get("category", "") in ALLOWED_CATS][:4]
+    print(f"Claude: {len(pieces)} pieces (filtered)")
+    for p in pieces:
+        print(f"  → {p.get('category')} | brand={p.get('brand')} | text='{p.get('visible_text','')}' | style={p.get('style_type','')}")
+        print(f"    q_spec: {p.get('search_query_specific','')}")
+        print(f"    q_gen:  {p.get('search_query_generic','')}")
+    return pieces
+
+async def prepare_pieces(pieces, optimized):
+    """Step 2: Crop each piece + Build search queries → (search_queries, crop_tasks).
+    Thumbnail'ler pieces[i]["_crop_b64"]'e yazılır."""
+    # v42 OPTIMIZED: 1 merged query per piece (specific + OCR keywords)
+    # OLD: specific + ocr + generic = 3 SerpAPI calls per piece
+    # NEW: 1 smart merged query = 1 SerpAPI call per piece
+    search_queries = []  # [(piece_idx, query_str, priority)]
+    crop_tasks = []  # [(piece_idx, crop_bytes, crop_key)]
+    boxed = []  # Crop'lanacak piece index'leri
+
+    for i, p in enumerate(pieces):
+        q_specific = p.get("search_query_specific", "").strip()
+        q_generic = p.get("search_query_generic", "").strip()
+
+        # Merge OCR keywords into specific query (instead of separate call)
+        visible_text = p.get("visible_text", "")
+        if q_specific:
+            # Check if OCR text is already in specific query
+            q_lower = q_specific.lower()
+            extra_ocr = []
+            if visible_text and visible_text.lower() not in ["none", "?", "", "yok"]:
+                for word in visible_text.replace(",", " ").split():
+                    clean = re.sub(r'[^\w]', '', word)
+                    if len(clean) > 2 and clean.lower() not in q_lower and clean.lower() not in ["none", "yok", "the", "and", "for"]:
+                        extra_ocr.append(clean)
+                        if len(extra_ocr) >= 2: break  # Max 2 extra OCR words
+            if extra_ocr:
+                q_merged = q_specific + " " + " ".join(extra_ocr)
+                search_queries.append((i, q_merged, "specific"))
+                print(f"  [{p.get('category')}] Merged OCR into specific: +{extra_ocr}")
+            else:
+                search_queries.append((i, q_specific, "specific"))
+        elif q_generic:
+            search_queries.append((i, q_generic, "generic"))
+
+        box = p.get("box_2d")
+        if box and isinstance(box, list) and len(box) == 4:
+            boxed.append(i)
+
+    # Crop for Lens (simple, no rembg) — tüm parçalar tek CPU job'u
+    crops = await crop_pieces(optimized, [pieces[i]["box_2d"] for i in boxed], ((128, 75),))
+    for i, (cropped_bytes, thumbs) in zip(boxed, crops):
+        p, box = pieces[i], pieces[i]["box_2d"]
+        if cropped_bytes:
+            crop_tasks.append((i, cropped_bytes, img_digest(cropped_bytes)))
+            if 128 in thumbs: p["_crop_b64"] = thumbs[128]
+            print(f"  [{p.get('category')}] Cropped OK ({len(cropped_bytes)//1024}KB) box={box}")
+        else:
+            print(f"  [{p.get('category')}] Crop FAILED")
+
+    serpapi_calls = len(search_queries) + len(crop_tasks) + 1  # +1 for full exact
+    print(f"Search queries: {len(search_queries)} | Crops: {len(crop_tasks)} | SerpAPI calls: {serpapi_calls}")
+    for idx, q, pri in search_queries:
+        print(f"  [{pieces[idx].get('category')}] {pri}: '{q}'")
+    return search_queries, crop_tasks
+
+def build_search_tasks(pieces, search_queries, crop_tasks, optimized, digest, img_url, cc, t_search=None, focus=None):
+    """Step 3: Upload crops + Per-piece Lens + Shopping coroutine'leri → (tasks, task_map).
+    img_url hâlâ yükleniyorsa (stream) await edilebilir bir task da olabilir.
+    t_search (arama fazının başı) verilirse bütçe yetmediğinde en düşük değerli task (full exact Lens) atlanır.
+    focus: tek parça araması (search-piece) — full exact sonuçları sadece o parçaya süzülür."""
+    # v42 OPTIMIZED: Removed full_lens_visual (piece_lens covers it)
+    # v42 OPTIMIZED: Removed Google organic (moved to "load more" button)
+    # v42 OPTIMIZED: 1 shopping query per piece (merged specific+OCR)
+    # Result: 2-piece outfit = 5 SerpAPI calls (was 12)
+
+    # Scan / search-piece kullanıcıyı bekletiyor → Lens + Shopping hedge'li (diğer SerpAPI çağrıları hedge'siz)
+    async def do_shop(q, limit=8):
+        return await _shop(q, cc, limit, hedge=True)
+
+    async def do_piece_lens(crop_bytes, crop_key):
+        """Upload crop → Lens ALL (exact+visual matches for this piece)."""
+        return await lens_image(crop_bytes, cc, "all", digest=crop_key, hedge=True)
+
+    async def do_full_lens_exact():
+        """Full image → Lens EXACT matches (same photo found on Bershka, Instagram etc.)."""
+        if not optimized: return []
+        if budget_exhausted(t_search) and not cache_get(lens_cache_key(digest, cc, "exact_matches")):
+            print("  ⏱️ Budget low → full exact Lens skipped")
+            return []
+        url = (await img_url) if asyncio.isfuture(img_url) else img_url
+        # URL yok (upload hatası / session'da henüz yok) → lens_image kendisi yükler; upload:{digest} single_flight'ı
+        # süren upload'a bağlanır, ikinci kez yüklemez
+        return await lens_image(optimized, cc, "exact_matches", url=url, upload=not url, digest=digest, hedge=True)
+
+    # Build ALL tasks
+    tasks = []
+    task_map = []  # (type, piece_idx, extra_info)
+
+    # 🏆 FULL IMAGE EXACT MATCHES — This is what Google Lens app does!
+    tasks.append(do_full_lens_exact())
+    task_map.append(("full_lens_exact", -1, None) if focus is None else ("piece_exact", focus, None))
+
+    # Per-piece Lens (crop → similar+exact products)
+    for piece_idx, crop_bytes, crop_key in crop_tasks:
+        tasks.append(do_piece_lens(crop_bytes, crop_key))
+        task_map.append(("piece_lens", piece_idx, None))
+
+    # Shopping (1 merged query per piece)
+    for piece_idx, q, pri in search_queries:
+        tasks.append(do_shop(q, 8))
+        task_map.append(("shop", piece_idx, pri))
+    return tasks, task_map
+
+MergeEntry = namedtuple("MergeEntry", "rank channel item rivals ok")  # rank = (task idx, sıra) — kanonik öncelik
+
+class PieceRanker:
+    """Step 6: HYBRID SCORING — tek parçanın kuralları. entry() sonuç başına bir kez, varışta çalışır (rakip bayrakları,
+    filtre, skor); rank() sadece hazır skorları sıralayıp match level çıkarır. Girdi dict'leri kopyalanır —
+    birden fazla parçaya düşen Lens sonucu diğer parçanın skorunu/temizliğini etkilemesin."""
+
+    def __init__(self, p):
+        self.p = p
+        self.brand = p.get("brand", "")
+        self.visible_text = p.get("visible_text", "")
+        self.cat = p.get("category", "")
+        self.color = p.get("color", "")
+        self.style = p.get("style_type", "")
+        self.rivals = rival_patterns(self.brand)
+
+    def admit(self, r, channel):
+        """Sonuç bu parçanın listesine girebilir mi (blok / moda dışı exact / kategori / giyim dışı)."""
+        lnk, ttl, cat = r.get("link", ""), r.get("title", ""), self.cat
+        if channel == "shop":
+            return not is_category_mismatch(ttl, cat) and not is_non_clothing_product(ttl)
+        # Even _exact items must pass domain-level blocks (blogs, social media, news)
+        if is_blocked(lnk):
+            print(f"    ⛔ BLOCKED EXACT: {ttl[:50]} | {lnk[:60]}")
+            return False
+        # Blog/article detection for exact matches
+        if r.get("_exact") and not is_fashion(lnk, ttl, r.get("source", "")):
+            print(f"    ⛔ NON-FASHION EXACT: {ttl[:50]} | {r.get('source','')}")
+            return False
+        if not r.get("_exact"):
+            # v42: Category mismatch filter (çanta ararken bardak gelmesin)
+            if is_category_mismatch(ttl, cat):
+                print(f"    ⛔ CAT MISMATCH [{cat}]: {ttl[:50]}")
+                return False
+            if is_non_clothing_product(ttl):
+                print(f"    ⛔ NON-CLOTHING [{cat}]: {ttl[:50]}")
+                return False
+        return True
+
+    def score(self, r, base_score=0):
+        """Universal scoring function for any channel."""
+        brand, visible_text, cat = self.brand, self.visible_text, self.cat
+        score = base_score
+        combined = (r.get("title", "") + " " + r.get("link", "") + " " + r.get("source", "")).lower()
+        rtitle = r.get("title", "")
+
+        # 🏆 EXACT LENS MATCH — same photo found on web
+        if r.get("_exact"):
+            score += 50
+            r["ai_verified"] = True
+
+        # Tek kanal bonusu — merger bir link'i parçada tek kanala tekilleştirir (Lens > Shopping)
+        score += 5
+
+        # Brand match
+        if brand and brand != "?" and len(brand) > 2 and brand.lower() in combined:
+            score += 8
+        # OCR text match (visible_text on the garment)
+        if visible_text and visible_text.lower() not in ["none", "?", ""]:
+            for vt in visible_text.lower().replace(",", " ").split():
+                if len(vt) > 2 and vt in combined: score += 10; break
+        # Price & local bonus
+        if r.get("price"): score += 2
+        if r.get("is_local"): score += 15
+
+        # v42: COLOR PENALTY — beyaz ararken gri gelirse cezalandır
+        if detect_color_conflict(self.color, rtitle):
+            score -= 30
+            print(f"      🎨 COLOR PENALTY: [{self.color}] vs '{rtitle[:40]}'")
+
+        # v42: SUB-TYPE PENALTY — gömlek ararken süveter gelirse cezalandır
+        if detect_subtype_conflict(self.style, rtitle, cat):
+            score -= 25
+            print(f"      👕 SUBTYPE PENALTY: [{self.style}] vs '{rtitle[:40]}'")
+
+        # v42: CATEGORY RELEVANCE — sonuçta aranan kategorinin kelimesi var mı?
+        has_target_kw = cat in title_features(rtitle).cats
+        if has_target_kw:
+            score += 15  # Bonus: sonuçta "saat/watch" veya "çanta/bag" geçiyor
+        elif cat in ("watch", "bag", "sunglasses", "hat", "scarf", "accessory"):
+            score -= 20  # Aksesuar aramasında kategori kelimesi yoksa penaltı
+
+        # v42: NON-PRODUCT URL penalty — arama/kategori sayfası ise cezalandır
+        if not is_product_url(r.get("link", "")):
+            score -= 40
+
+        return score
+
+    def entry(self, rank, channel, r):
+        """Varışta: kopyala, rakip bayrakları + filtre + skor → MergeEntry."""
+        r = dict(r)
+        ok = self.admit(r, channel)
+        if ok:
+            base = 18 if channel == "lens" else (15 if r.get("_priority") == "specific" else 5)
+            r["_score"] = self.score(r, base)
+        return MergeEntry(rank, channel, r, rival_flags(r, self.rivals), ok)
+
+    def rank(self, entries):
+        """Kanonik sıradaki entry'ler → (all_items, match_level, lens_count). Item'lar kopya — tekrar çağrılabilir."""
+        brand, visible_text, cat = self.brand, self.visible_text, self.cat
+        lens = [e for e in entries if e.channel == "lens"]
+        shop = [e for e in entries if e.channel == "shop"]
+        # Brand filter (hepsi rakipse en iyi hedef-dışı alt küme — filter_rival_brands ile aynı seçim)
+        lens = select_non_rivals(lens, [e.rivals for e in lens])
+        shop = select_non_rivals(shop, [e.rivals for e in shop])
+        all_items = [dict(e.item) for e in lens + shop if e.ok]
+
+        # Sort: _exact items first (regardless of penalty), then by score
+        all_items.sort(key=lambda x: (-int(x.get("_exact", False)), -x.get("_score", 0)))
+
+        # 🇹🇷 TR-FIRST: Local results ALWAYS first, foreign only fills remaining slots
+        local_items = [r for r in all_items if r.get("is_local")]
+        foreign_items = [r for r in all_items if not r.get("is_local")]
+        # Local exact first, then local rest, then foreign exact, then foreign rest
+        local_exact = [r for r in local_items if r.get("_exact")]
+        local_rest = [r for r in local_items if not r.get("_exact")]
+        foreign_exact = [r for r in foreign_items if r.get("_exact")]
+        foreign_rest = [r for r in foreign_items if not r.get("_exact")]
+        all_items = local_exact + local_rest + foreign_exact + foreign_rest
+
+        # ── Match confidence ──
+        top_score = all_items[0].get("_score", 0) if all_items else 0
+        has_brand_match = any(
+            brand and brand != "?" and brand.lower() in (r.get("title","") + " " + r.get("link","")).lower()
+            for r in all_items[:3]
+        ) if brand and brand != "?" else False
+        has_text_match = False
+        if visible_text and visible_text.lower() not in ["none", "?", ""]:
+            vt_words = [w for w in visible_text.lower().replace(",", " ").split() if len(w) > 2]
+            for r in all_items[:3]:
+                t = r.get("title", "").lower()
+                if any(w in t for w in vt_words): has_text_match = True; break
+
+        # Check if any top result has _exact flag (regardless of score penalties)
+        has_exact_flag = any(r.get("_exact") for r in all_items[:5])
+        has_ai_verified = any(r.get("ai_verified") for r in all_items[:3])
+
+        if has_exact_flag or top_score >= 50:
+            match_level = "exact"  # Lens exact match (same photo found online)
+        elif has_ai_verified or (top_score >= 25 and (has_brand_match or has_text_match)):
+            match_level = "exact"
+        elif top_score >= 15 or has_brand_match:
+            match_level = "close"
+        else:
+            match_level = "similar"
+
+        # Log
+        for j, r in enumerate(all_items[:3]):
+            ch = r.get("_channel", r.get("_src", "lens"))
+            print(f"  [{cat}] #{j+1}: score={r.get('_score',0)} ch={ch} {r.get('title','')[:50]}")
+        print(f"  [{cat}] match={match_level} brand={has_brand_match} text={has_text_match}")
+        return all_items, match_level, len(lens)
+
+def finalize_piece(p, ranked, cc, event="scan", query=None):
+    """Sıralanmış parça → API sonucu (iç alanlar temizlenir, popular + analytics kaydı).
+    event / query: analytics kaydı (search-piece kendi event'i ve OCR birleştirilmiş sorgusuyla);
+    event=None → kayıt yok (stream update'i: parça ilk gönderiminde kaydedildi)."""
+    all_items, match_level, lens_count = ranked
+    brand = p.get("brand", "")
+    visible_text = p.get("visible_text", "")
+    cat = p.get("category", "")
+
+    # Clean internal fields
+    for r in all_items:
+        for k in ["_score", "_priority", "_channel", "_src", "_exact"]: r.pop(k, None)
+        # Inject verified/sponsored badges
+        badge = get_verified_badge(r.get("link", ""))
+        if badge: r["_verified"] = badge
+
+    result = {
+        "category": cat,
+        "short_title": p.get("short_title", cat.title()),
+        "color": p.get("color", ""),
+        "style_type": p.get("style_type", ""),
+        "brand": brand if brand != "?" else "",
+        "visible_text": visible_text,
+        "products": all_items[:8],
+        "lens_count": lens_count,
+        "match_level": match_level,
+        "crop_image": p.get("_crop_b64", ""),
+    }
+    if event is None: return result
+    # Record for popular searches
+    if all_items and match_level in ("exact", "close"):
+        record_popular_search(p, all_items[0])
+    # Record analytics
+    q = query if query is not None else p.get("search_query_specific", "").strip() or p.get("search_query_generic", "").strip()
+    record_analytics(event, {"category": cat, "brand": brand, "color": p.get("color", ""), "style_type": p.get("style_type", ""), "query": q, "match_level": match_level, "country": cc, "results_count": len(all_items)})
+    return result
+
+# ─── INCREMENTAL MERGE + DEADLINE: sonuçlar geldikçe skorlanıp katlanır, süre dolunca eldeki en iyi sıralama döner ───
+ANALYZE_DEADLINE = float(os.environ.get("ANALYZE_DEADLINE", "15"))  # sn, arama fazı başından (Claude detect hariç)
+
+async def iter_completed(tasks, deadline=None, label=""):
+    """as_completed ile (task_idx, sonuç) biten sırayla. Hata → []. Deadline'da kalanlar bırakılır —
+    alttaki single-flight çağrıları arka planda sürüp cache'i doldurur."""
+    async def indexed(k, coro):
+        try:
+            return k, await coro
+        except Exception as e:
+            print(f"  Task {k} err: {e}")
+            return k, []
+    futs = [asyncio.ensure_future(indexed(k, t)) for k, t in enumerate(tasks)]
+    n_done = 0
+    try:
+        for nxt in asyncio.as_completed(futs, timeout=deadline):
+            k, res = await nxt
+            n_done += 1
+            yield k, res
+    except asyncio.TimeoutError:
+        print(f"  ⏱️ {label} deadline ({deadline:.1f}s): {len(futs) - n_done}/{len(futs)} task geç kaldı → eldeki sıralama")
+    finally:
+        for f in futs:
+            if not f.done(): f.cancel()
+
+class PieceMerger:
+    """Step 4: Lens/Shopping sonuçlarını geldikçe parçalara dağıtır, tekilleştirir ve skorlar (PieceRanker.entry);
+    final(i) sadece hazır skorları sıralar. Aynı link birden fazla task'tan gelirse kanonik task sırasında önce
+    gelen kalır (full exact > parça Lens > Shopping) → varış sırası çıktıyı değiştirmez.
+    Task tipleri: full_lens_exact (keyword ile parçalara dağıtılır), piece_exact (tek parçaya süzülür —
+    search-piece), piece_lens, shop."""
+
+    def __init__(self, pieces, task_map):
+        self.pieces, self.task_map = pieces, task_map
+        self.rankers = [PieceRanker(p) for p in pieces]
+        self.entries = {i: {} for i in range(len(pieces))}  # parça → link → MergeEntry
+        self.done = set()
+        # Parça i hazır = kendi Lens/Shopping task'ları bitti. Full exact (upload'a bağlı, en yavaş) beklenmez —
+        # stream onu sonradan update event'i ile gönderilmiş parçalara katar
+        self.deps = {i: [k for k, (_, pi, _) in enumerate(task_map) if pi == i] for i in range(len(pieces))}
+
+    def spread(self, k, res):
+        """Task sonucu → {parça: [sonuç]} (parça içindeki sıra = kanonik sıra)."""
+        task_type, piece_idx, extra = self.task_map[k]
+        if task_type == "full_lens_exact":
+            # 🏆 EXACT matches from full image — distribute to pieces by keyword
+            per = {i: [] for i in range(len(self.pieces))}
+            if not res: return per
+            exact_matches = match_lens_to_pieces(res, self.pieces)
+            matched_links = set()
+            for i in per:
+                for r in exact_matches.get(i, []):
+                    per[i].append(r)
+                    matched_links.add(r.get("link", ""))
+            # Unmatched exact results go to first available piece (too good to lose)
+            seen = {i: {r.get("link", "") for r in per[i]} for i in per}
+            for r in res:
+                link = r.get("link", "")
+                if link in matched_links: continue
+                for i in per:
+                    if link not in seen[i]:
+                        seen[i].add(link)
+                        per[i].append(r)
+                        break
+            print(f"  🏆 Full EXACT Lens: {len(res)} results → {sum(map(len, exact_matches.values()))} matched to pieces")
+            for r in res[:5]:
+                print(f"    ✅ {r.get('title','')[:60]} | {r.get('source','')} | exact={r.get('_exact',False)}")
+            return per
+        if task_type == "piece_exact":
+            # Full image exact Lens → sadece bu parça (keyword, _exact ya da tek parça)
+            kws = PIECE_KEYWORDS.get(self.pieces[piece_idx].get("category", ""), [])
+            def matches_piece(r):
+                t = (r.get("title", "") + " " + r.get("source", "")).lower()
+                return any(kw in t for kw in kws)
+            kept = [r for r in res if len(self.pieces) == 1 or r.get("_exact") or matches_piece(r)]
+            for r in kept[:3]:
+                print(f"    ✅ EXACT: {r.get('title','')[:50]} | {r.get('source','')}")
+            return {piece_idx: kept}
+        if task_type == "piece_lens":
+            print(f"  [{self.pieces[piece_idx].get('category')}] Piece Lens: {len(res)} results")
+            return {piece_idx: res}
+        return {piece_idx: [{**r, "_priority": extra, "_channel": "shopping"} for r in res]}
+
+    def add(self, k, res):
+        """Task k'nın sonucu geldi — parçalara dağıt, link başına kanonik olarak önce geleni tut, varışta skorla.
+        → sıralaması değişen parçaların index'leri."""
+        self.done.add(k)
+        channel = "shop" if self.task_map[k][0] == "shop" else "lens"
+        touched = set()
+        for i, rs in self.spread(k, res or []).items():
+            entries, ranker = self.entries[i], self.rankers[i]
+            for pos, r in enumerate(rs):
+                link, rank = r.get("link", ""), (k, pos)
+                cur = entries.get(link)
+                if cur is None or rank < cur.rank:
+                    entries[link] = ranker.entry(rank, channel, r)
+                    touched.add(i)
+        return touched
+
+    def ready(self, i):
+        return all(k in self.done for k in self.deps[i])
+
+    def ranked(self, i):
+        return self.rankers[i].rank(sorted(self.entries[i].values(), key=lambda e: e.rank))
+
+    def final(self, i, cc, **kw):
+        """Parçanın API sonucu — gelmiş sonuçların hazır skorlarıyla sırala + finalize (popular/analytics kaydı)."""
+        return finalize_piece(self.pieces[i], self.ranked(i), cc, **kw)
+
 @app.post("/api/full-analyze")
 async def full_analyze(file: UploadFile = File(...), country: str = Form("tr")):
     """v40: HYBRID — Per-piece Lens (crop) + Shopping + Google Organic, all parallel."""
     if not SERPAPI_KEY: raise HTTPException(500, "No API key")
     cc = country.lower()
     contents = await file.read()
-
-    try:
-        img = Image.open(io.BytesIO(contents)).convert("RGB")
-        img = ImageOps.exif_transpose(img)
-        img_obj = img.copy()  # Keep original for cropping
-        img_obj.thumbnail((1400, 1400))
-        img.thumbnail((1400, 1400))  # High-res for Claude OCR
-        buf = io.BytesIO(); img.save(buf, format="JPEG", quality=95)
-        optimized = buf.getvalue()
-        b64 = base64.b64encode(optimized).decode()
-        print(f"  Image: {img.size[0]}x{img.size[1]}, {len(optimized)//1024}KB sent to Claude")
-    except Exception:
-        img_obj = Image.open(io.BytesIO(contents)).convert("RGB")
-        optimized = contents
-        b64 = base64.b64encode(contents).decode()
-
     print(f"\n{'='*50}\n=== AUTO v40 HYBRID+CROP === country={cc}")
 
     try:
+        optimized, b64, ph = await decode_upload(contents)
+        digest, detect_digest = resolve_image_digest(ph, optimized)
+
         # ── Step 1: Claude detect + Upload full image → PARALLEL ──
-        detect_task = claude_detect(b64, cc)
-        upload_task = upload_img(optimized)
+        detect_task = claude_detect_cached(b64, detect_digest, cc)
+        upload_task = upload_for_lens(optimized, cc, "exact_matches", digest=digest)
         pieces, img_url = await asyncio.gather(detect_task, upload_task)
 
         if not pieces:
             return {"success": True, "pieces": [], "country": cc}
-        ALLOWED_CATS = {"jacket", "top", "bottom", "dress", "shoes", "bag", "watch"}
-        pieces = [p for p in pieces if p.get("category", "") in ALLOWED_CATS][:4]
-        print(f"Claude: {len(pieces)} pieces (filtered)")
-        for p in pieces:
-            print(f"  → {p.get('category')} | brand={p.get('brand')} | text='{p.get('visible_text','')}' | style={p.get('style_type','')}")
-            print(f"    q_spec: {p.get('search_query_specific','')}")
-            print(f"    q_gen:  {p.get('search_query_generic','')}")
-
-        # ── Step 2: Crop each piece + Build search queries ──
-        # v42 OPTIMIZED: 1 merged query per piece (specific + OCR keywords)
-        # OLD: specific + ocr + generic = 3 SerpAPI calls per piece
-        # NEW: 1 smart merged query = 1 SerpAPI call per piece
-        search_queries = []  # [(piece_idx, query_str, priority)]
-        crop_tasks = []  # [(piece_idx, crop_bytes)]
-
-        for i, p in enumerate(pieces):
-            q_specific = p.get("search_query_specific", "").strip()
-            q_generic = p.get("search_query_generic", "").strip()
-
-            # Merge OCR keywords into specific query (instead of separate call)
-            brand = p.get("brand", "")
-            visible_text = p.get("visible_text", "")
-            if q_specific:
-                # Check if OCR text is already in specific query
-                q_lower = q_specific.lower()
-                extra_ocr = []
-                if visible_text and visible_text.lower() not in ["none", "?", "", "yok"]:
-                    for word in visible_text.replace(",", " ").split():
-                        clean = re.sub(r'[^\w]', '', word)
-                        if len(clean) > 2 and clean.lower() not in q_lower and clean.lower() not in ["none", "yok", "the", "and", "for"]:
-                            extra_ocr.append(clean)
-                            if len(extra_ocr) >= 2: break  # Max 2 extra OCR words
-                if extra_ocr:
-                    q_merged = q_specific + " " + " ".join(extra_ocr)
-                    search_queries.append((i, q_merged, "specific"))
-                    print(f"  [{p.get('category')}] Merged OCR into specific: +{extra_ocr}")
-                else:
-                    search_queries.append((i, q_specific, "specific"))
-            elif q_generic:
-                search_queries.append((i, q_generic, "generic"))
+        pieces = filter_pieces(pieces)
 
-            # Crop for Lens (simple, no rembg)
-            box = p.get("box_2d")
-            if box and isinstance(box, list) and len(box) == 4:
-                try:
-                    cropped_bytes = await asyncio.to_thread(crop_piece, img_obj, box)
-                    if cropped_bytes:
-                        crop_tasks.append((i, cropped_bytes))
-                        try:
-                            t_img = Image.open(io.BytesIO(cropped_bytes)).convert("RGB")
-                            t_img.thumbnail((128, 128))
-                            t_buf = io.BytesIO(); t_img.save(t_buf, format="JPEG", quality=75)
-                            pieces[i]["_crop_b64"] = "data:image/jpeg;base64," + base64.b64encode(t_buf.getvalue()).decode()
-                        except: pass
-                        print(f"  [{p.get('category')}] Cropped OK ({len(cropped_bytes)//1024}KB) box={box}")
-                    else:
-                        print(f"  [{p.get('category')}] Crop FAILED")
-                except Exception as e:
-                    print(f"  [{p.get('category')}] Crop error: {e}")
-
-        serpapi_calls = len(search_queries) + len(crop_tasks) + 1  # +1 for full exact
-        print(f"Search queries: {len(search_queries)} | Crops: {len(crop_tasks)} | SerpAPI calls: {serpapi_calls}")
-        for idx, q, pri in search_queries:
-            print(f"  [{pieces[idx].get('category')}] {pri}: '{q}'")
-
-        # ── Step 3: Upload crops + Per-piece Lens + Shopping → ALL PARALLEL ──
-        # v42 OPTIMIZED: Removed full_lens_visual (piece_lens covers it)
-        # v42 OPTIMIZED: Removed Google organic (moved to "load more" button)
-        # v42 OPTIMIZED: 1 shopping query per piece (merged specific+OCR)
-        # Result: 2-piece outfit = 5 SerpAPI calls (was 12)
-
-        async def do_shop(q, limit=8):
-            async with API_SEM:
-                return await asyncio.to_thread(_shop, q, cc, limit)
-
-        async def do_piece_lens(crop_bytes):
-            """Upload crop → Lens ALL (exact+visual matches for this piece)."""
-            url = await upload_img(crop_bytes)
-            if url:
-                async with API_SEM:
-                    return await asyncio.to_thread(_lens, url, cc, "all")
-            return []
+        search_queries, crop_tasks = await prepare_pieces(pieces, optimized)
+        t_search = time.time()  # Deadline arama fazından sayılır — Claude detect süresi bütçeyi yemez
+        tasks, task_map = build_search_tasks(pieces, search_queries, crop_tasks, optimized, digest, img_url, cc, t_search)
 
-        async def do_full_lens_exact():
-            """Full image → Lens EXACT matches (same photo found on Bershka, Instagram etc.)."""
-            if img_url:
-                async with API_SEM:
-                    return await asyncio.to_thread(_lens, img_url, cc, "exact_matches")
-            return []
-
-        # Build ALL tasks
-        tasks = []
-        task_map = []  # (type, piece_idx, extra_info)
-
-        # 🏆 FULL IMAGE EXACT MATCHES — This is what Google Lens app does!
-        tasks.append(do_full_lens_exact())
-        task_map.append(("full_lens_exact", -1, None))
-
-        # Per-piece Lens (crop → similar+exact products)
-        for piece_idx, crop_bytes in crop_tasks:
-            tasks.append(do_piece_lens(crop_bytes))
-            task_map.append(("piece_lens", piece_idx, None))
-
-        # Shopping (1 merged query per piece)
-        for piece_idx, q, pri in search_queries:
-            tasks.append(do_shop(q, 8))
-            task_map.append(("shop", piece_idx, pri))
-
-        # 🚀 FIRE ALL AT ONCE
-        all_results = await asyncio.gather(*tasks)
-
-        # ── Step 4: Distribute results to pieces ──
-        piece_lens = {i: [] for i in range(len(pieces))}
-        piece_shop = {i: [] for i in range(len(pieces))}
-        seen_per_piece = {i: set() for i in range(len(pieces))}
-
-        for task_idx, (task_type, piece_idx, extra) in enumerate(task_map):
-            results = all_results[task_idx] if task_idx < len(all_results) else []
-
-            if task_type == "full_lens_exact":
-                # 🏆 EXACT matches from full image — distribute to pieces by keyword
-                if results:
-                    exact_matches = match_lens_to_pieces(results, pieces)
-                    for i in range(len(pieces)):
-                        for r in exact_matches.get(i, []):
-                            link = r.get("link", "")
-                            if link not in seen_per_piece[i]:
-                                seen_per_piece[i].add(link)
-                                piece_lens[i].append(r)
-                    # Unmatched exact results go to first available piece (too good to lose)
-                    matched_links = set()
-                    for i in range(len(pieces)):
-                        for r in exact_matches.get(i, []):
-                            matched_links.add(r.get("link", ""))
-                    for r in results:
-                        link = r.get("link", "")
-                        if link not in matched_links:
-                            for i in range(len(pieces)):
-                                if link not in seen_per_piece[i]:
-                                    seen_per_piece[i].add(link)
-                                    piece_lens[i].append(r)
-                                    break
-                    exact_total = sum(len(v) for v in exact_matches.values())
-                    print(f"  🏆 Full EXACT Lens: {len(results)} results → {exact_total} matched to pieces")
-                    for r in results[:5]:
-                        print(f"    ✅ {r.get('title','')[:60]} | {r.get('source','')} | exact={r.get('_exact',False)}")
-
-            elif task_type == "piece_lens":
-                # Per-piece Lens results go directly to that piece
-                for r in results:
-                    link = r.get("link", "")
-                    if link not in seen_per_piece[piece_idx]:
-                        seen_per_piece[piece_idx].add(link)
-                        piece_lens[piece_idx].append(r)
-                print(f"  [{pieces[piece_idx].get('category')}] Piece Lens: {len(results)} results")
-
-            elif task_type == "shop":
-                for r in results:
-                    link = r.get("link", "")
-                    if link not in seen_per_piece[piece_idx]:
-                        seen_per_piece[piece_idx].add(link)
-                        r_copy = r.copy()
-                        r_copy["_priority"] = extra
-                        r_copy["_channel"] = "shopping"
-                        piece_shop[piece_idx].append(r_copy)
-
-        # Log Lens results per piece (for debugging)
-        for i in range(len(pieces)):
-            cat = pieces[i].get("category", "")
-            lens_r = piece_lens.get(i, [])
-            if lens_r:
-                print(f"  [{cat}] Lens top 5:")
-                for j, r in enumerate(lens_r[:5]):
-                    print(f"    {j+1}. {r.get('title','')[:60]} | {r.get('source','')}")
-
-        # ── Step 6: Build final results per piece (HYBRID SCORING) ──
-        results = []
-        for i, p in enumerate(pieces):
-            brand = p.get("brand", "")
-            visible_text = p.get("visible_text", "")
-            cat = p.get("category", "")
-            piece_color = p.get("color", "")
-            piece_style = p.get("style_type", "")
+        # 🚀 FIRE ALL AT ONCE — her sonuç geldiği an merger'da skorlanır; deadline'da straggler beklenmez
+        merger = PieceMerger(pieces, task_map)
+        async for k, res in iter_completed(tasks, ANALYZE_DEADLINE, "full-analyze"):
+            merger.add(k, res)
 
-            shop = piece_shop.get(i, [])
-            matched_lens = piece_lens.get(i, [])
-
-            # Brand filter
-            if brand and brand != "?":
-                matched_lens = filter_rival_brands(matched_lens, brand)
-                shop = filter_rival_brands(shop, brand)
-
-            # Collect all links per channel for cross-reference
-            shop_links = {r.get("link", "") for r in shop}
-            lens_links = {r.get("link", "") for r in matched_lens}
+        results = [merger.final(i, cc) for i in range(len(pieces))]
+        return {"success": True, "pieces": results, "country": cc}
+    except Exception as e:
+        print(f"AUTO ANALYZE FAILED: {e}")
+        import traceback; traceback.print_exc()
+        return {"success": False, "message": str(e), "pieces": []}
 
-            def score_result(r, base_score=0):
-                """Universal scoring function for any channel."""
-                score = base_score
-                combined = (r.get("title", "") + " " + r.get("link", "") + " " + r.get("source", "")).lower()
-                rtitle = r.get("title", "")
 
-                # 🏆 EXACT LENS MATCH — same photo found on web
-                if r.get("_exact"):
-                    score += 50
-                    r["ai_verified"] = True
+# ─── FULL-ANALYZE STREAM (SSE): parçalar Claude döner dönmez, her parçanın ürünleri kendi task'ları bitince ───
+# event: pieces → {detect_id, pieces[crop_image...]}   event: piece → {index, piece, _search_query}
+# event: update → {index, piece} (full exact Lens sonradan geldi, gönderilmiş parçaya katıldı)   event: done
+# Frontend'de opt-in: stream her parçayı baştan arar (full exact + parça başına Lens + Shopping → 4 parçada ~9
+# SerpAPI çağrısı), varsayılan akış detect + sadece seçilen parçaya search-piece (~3 çağrı).
+SCAN_STREAM = os.environ.get("SCAN_STREAM", "") == "1"
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _task_result(t):
+    """Upload task'ının sonucu — hata/iptal = boş."""
+    if t.cancelled() or t.exception():
+        if not t.cancelled(): print(f"  Stream upload err: {t.exception()}")
+        return ""
+    return t.result()
+
+@app.post("/api/full-analyze/stream")
+async def full_analyze_stream(file: UploadFile = File(...), country: str = Form("tr")):
+    """/api/full-analyze'ın SSE versiyonu — en yavaş SerpAPI çağrısı ilk sonucu bekletmez."""
+    if not SERPAPI_KEY: raise HTTPException(500, "No API key")
+    cc = country.lower()
+    contents = await file.read()
+    session_cleanup()
 
-                # Cross-channel bonus (same product in both lens + shopping = reliable)
-                link = r.get("link", "")
-                if link in shop_links and link in lens_links:
-                    score += 25; r["ai_verified"] = True
-                elif (link in shop_links) != (link in lens_links):  # in one but not both
-                    score += 5
-
-                # Brand match
-                if brand and brand != "?" and len(brand) > 2 and brand.lower() in combined:
-                    score += 8
-                # OCR text match (visible_text on the garment)
-                if visible_text and visible_text.lower() not in ["none", "?", ""]:
-                    for vt in visible_text.lower().replace(",", " ").split():
-                        if len(vt) > 2 and vt in combined: score += 10; break
-                # Price & local bonus
-                if r.get("price"): score += 2
-                if r.get("is_local"): score += 15
-
-                # v42: COLOR PENALTY — beyaz ararken gri gelirse cezalandır
-                if detect_color_conflict(piece_color, rtitle):
-                    score -= 30
-                    print(f"      🎨 COLOR PENALTY: [{piece_color}] vs '{rtitle[:40]}'")
-
-                # v42: SUB-TYPE PENALTY — gömlek ararken süveter gelirse cezalandır
-                if detect_subtype_conflict(piece_style, rtitle, cat):
-                    score -= 25
-                    print(f"      👕 SUBTYPE PENALTY: [{piece_style}] vs '{rtitle[:40]}'")
-
-                # v42: CATEGORY RELEVANCE — sonuçta aranan kategorinin kelimesi var mı?
-                cat_keywords = PIECE_KEYWORDS.get(cat, [])
-                has_target_kw = any(kw in rtitle.lower() for kw in cat_keywords if len(kw) >= 3)
-                if has_target_kw:
-                    score += 15  # Bonus: sonuçta "saat/watch" veya "çanta/bag" geçiyor
-                elif cat in ("watch", "bag", "sunglasses", "hat", "scarf", "accessory"):
-                    score -= 20  # Aksesuar aramasında kategori kelimesi yoksa penaltı
-
-                # v42: NON-PRODUCT URL penalty — arama/kategori sayfası ise cezalandır
-                if not is_product_url(r.get("link", "")):
-                    score -= 40
-
-                return score
-
-            seen = set()
-            all_items = []
-
-            # Lens results (per-piece crop + full exact = most reliable)
-            for r in matched_lens:
-                if r["link"] in seen: continue
-                lnk = r.get("link", "")
-                ttl = r.get("title", "")
-                # Even _exact items must pass domain-level blocks (blogs, social media, news)
-                if is_blocked(lnk):
-                    print(f"    ⛔ BLOCKED EXACT: {ttl[:50]} | {lnk[:60]}")
-                    continue
-                # Blog/article detection for exact matches
-                if r.get("_exact") and not is_fashion(lnk, ttl, r.get("source", "")):
-                    print(f"    ⛔ NON-FASHION EXACT: {ttl[:50]} | {r.get('source','')}")
-                    continue
-                if not r.get("_exact"):
-                    # v42: Category mismatch filter (çanta ararken bardak gelmesin)
-                    if is_category_mismatch(ttl, cat):
-                        print(f"    ⛔ CAT MISMATCH [{cat}]: {ttl[:50]}")
-                        continue
-                    if is_non_clothing_product(ttl):
-                        print(f"    ⛔ NON-CLOTHING [{cat}]: {ttl[:50]}")
-                        continue
-                seen.add(r["link"])
-                r["_score"] = score_result(r, 18)
-                all_items.append(r)
-
-            # Shopping results
-            for r in shop:
-                if r["link"] in seen: continue
-                if is_category_mismatch(r.get("title", ""), cat): continue
-                if is_non_clothing_product(r.get("title", "")): continue
-                seen.add(r["link"])
-                base = 15 if r.get("_priority") == "specific" else 5
-                r["_score"] = score_result(r, base)
-                all_items.append(r)
-
-            # Sort: _exact items first (regardless of penalty), then by score
-            all_items.sort(key=lambda x: (-int(x.get("_exact", False)), -x.get("_score", 0)))
-
-            # 🇹🇷 TR-FIRST: Local results ALWAYS first, foreign only fills remaining slots
-            local_items = [r for r in all_items if r.get("is_local")]
-            foreign_items = [r for r in all_items if not r.get("is_local")]
-            # Local exact first, then local rest, then foreign exact, then foreign rest
-            local_exact = [r for r in local_items if r.get("_exact")]
-            local_rest = [r for r in local_items if not r.get("_exact")]
-            foreign_exact = [r for r in foreign_items if r.get("_exact")]
-            foreign_rest = [r for r in foreign_items if not r.get("_exact")]
-            all_items = local_exact + local_rest + foreign_exact + foreign_rest
-
-            # ── Match confidence ──
-            top_score = all_items[0].get("_score", 0) if all_items else 0
-            has_brand_match = any(
-                brand and brand != "?" and brand.lower() in (r.get("title","") + " " + r.get("link","")).lower()
-                for r in all_items[:3]
-            ) if brand and brand != "?" else False
-            has_text_match = False
-            if visible_text and visible_text.lower() not in ["none", "?", ""]:
-                vt_words = [w for w in visible_text.lower().replace(",", " ").split() if len(w) > 2]
-                for r in all_items[:3]:
-                    t = r.get("title", "").lower()
-                    if any(w in t for w in vt_words): has_text_match = True; break
-
-            # Check if any top result has _exact flag (regardless of score penalties)
-            has_exact_flag = any(r.get("_exact") for r in all_items[:5])
-            has_ai_verified = any(r.get("ai_verified") for r in all_items[:3])
-
-            if has_exact_flag or top_score >= 50:
-                match_level = "exact"  # Lens exact match (same photo found online)
-            elif has_ai_verified or (top_score >= 25 and (has_brand_match or has_text_match)):
-                match_level = "exact"
-            elif top_score >= 15 or has_brand_match:
-                match_level = "close"
-            else:
-                match_level = "similar"
-
-            # Log
-            for j, r in enumerate(all_items[:3]):
-                ch = r.get("_channel", r.get("_src", "lens"))
-                print(f"  [{cat}] #{j+1}: score={r.get('_score',0)} ch={ch} {r.get('title','')[:50]}")
-            print(f"  [{cat}] match={match_level} brand={has_brand_match} text={has_text_match}")
-
-            # Clean internal fields
-            for r in all_items:
-                for k in ["_score", "_priority", "_channel", "_src", "_exact"]: r.pop(k, None)
-                # Inject verified/sponsored badges
-                badge = get_verified_badge(r.get("link", ""))
-                if badge: r["_verified"] = badge
-
-            results.append({
-                "category": cat,
-                "short_title": p.get("short_title", cat.title()),
+    async def events():
+        print(f"\n{'='*50}\n=== AUTO STREAM === country={cc}")
+        upload_task, tasks, completed = None, [], None
+        try:
+            optimized, b64, ph = await decode_upload(contents)
+            digest, detect_digest = resolve_image_digest(ph, optimized)
+            # Upload arka planda — parçalar onu beklemeden gönderilir, full exact Lens task'ı await eder
+            upload_task = asyncio.ensure_future(upload_for_lens(optimized, cc, "exact_matches", digest=digest))
+            pieces = await claude_detect_cached(b64, detect_digest, cc)
+            pieces = filter_pieces(pieces or [])
+            if not pieces:
+                yield sse("pieces", {"detect_id": "", "pieces": [], "country": cc})
+                yield sse("done", {"country": cc})
+                return
+
+            search_queries, crop_tasks = await prepare_pieces(pieces, optimized)
+
+            # search-piece / load-more fallback'i için detect session'ı da oluştur
+            detect_id = str(uuid.uuid4())[:12]
+            session = DETECT_SESSIONS[detect_id] = {
+                "pieces": pieces, "img_url": "", "img_bytes": optimized, "img_digest": digest,
+                "crop_data": {i: b for i, b, _ in crop_tasks}, "cc": cc, "created_at": time.time(),
+                "crop_thumbs": {i: p["_crop_b64"] for i, p in enumerate(pieces) if p.get("_crop_b64")},
+            }
+            # img_url upload biter bitmez session'a — stream erken biterse / client koparsa da search-piece görür
+            upload_task.add_done_callback(lambda t: session.update(img_url=_task_result(t) or ""))
+            yield sse("pieces", {"detect_id": detect_id, "country": cc, "pieces": [{
+                "category": p.get("category", ""),
+                "short_title": p.get("short_title", p.get("category", "").title()),
+                "brand": p.get("brand", "") if p.get("brand", "") != "?" else "",
+                "visible_text": p.get("visible_text", ""),
                 "color": p.get("color", ""),
                 "style_type": p.get("style_type", ""),
-                "brand": brand if brand != "?" else "",
-                "visible_text": visible_text,
-                "products": all_items[:8],
-                "lens_count": len(matched_lens),
-                "match_level": match_level,
                 "crop_image": p.get("_crop_b64", ""),
-            })
-            # Record for popular searches
-            if all_items and match_level in ("exact", "close"):
-                record_popular_search(p, all_items[0])
-            # Record analytics
-            record_analytics("scan", {"category": cat, "brand": brand, "color": p.get("color", ""), "style_type": p.get("style_type", ""), "query": q_specific or q_generic, "match_level": match_level, "country": cc, "results_count": len(all_items)})
+            } for p in pieces]})
+
+            t_search = time.time()
+            tasks, task_map = build_search_tasks(pieces, search_queries, crop_tasks, optimized, digest, upload_task, cc, t_search)
+            merger = PieceMerger(pieces, task_map)
+            queries = {i: q for i, q, _ in search_queries}
+            pending = set(range(len(pieces)))
+            completed = iter_completed(tasks, ANALYZE_DEADLINE, "stream")
+            async for k, res in completed:
+                sent = set(range(len(pieces))) - pending
+                touched = merger.add(k, res)
+                for i in sorted(pending):
+                    if not merger.ready(i): continue
+                    pending.discard(i)
+                    yield sse("piece", {"index": i, "piece": merger.final(i, cc), "_search_query": queries.get(i, "")})
+                # Full exact (upload + Lens) parçaları bekletmedi — geldiğinde zaten gönderilmiş parçaları güncelle
+                for i in sorted(touched & sent):
+                    yield sse("update", {"index": i, "piece": merger.final(i, cc, event=None)})
+            # Deadline: kalan parçalar eldeki sonuçlarla
+            for i in sorted(pending):
+                yield sse("piece", {"index": i, "piece": merger.final(i, cc), "_search_query": queries.get(i, "")})
+            yield sse("done", {"country": cc})
+        except Exception as e:
+            print(f"AUTO STREAM FAILED: {e}")
+            import traceback; traceback.print_exc()
+            yield sse("error", {"message": str(e)})
+        finally:
+            # Client koptu / erken çıkış / full exact atlandı: arama task'ları ve upload arkada sızmasın
+            if completed is not None:
+                await completed.aclose()
+            else:
+                for c in tasks: c.close()
+            if upload_task is not None and not upload_task.done():
+                upload_task.cancel()
 
-        return {"success": True, "pieces": results, "country": cc}
-    except Exception as e:
-        print(f"AUTO ANALYZE FAILED: {e}")
-        import traceback; traceback.print_exc()
-        return {"success": False, "message": str(e), "pieces": []}
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # ─── Claude identify crop (Manual mode only) ───
-async def claude_identify_crop(img_bytes, cc="tr"):
+async def claude_identify_crop(img_bytes, cc="tr", b64_c=None):
+    """b64_c: çağıran zaten decode ettiyse hazır 400px JPEG (base64) — yeniden decode edilmez."""
     if not ANTHROPIC_API_KEY: return ""
     cfg = get_country_config(cc)
-    try:
-        img_c = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        img_c.thumbnail((400, 400)); buf_c = io.BytesIO(); img_c.save(buf_c, format="JPEG", quality=80)
-        b64_c = base64.b64encode(buf_c.getvalue()).decode()
-    except Exception:
-        b64_c = base64.b64encode(img_bytes).decode()
-    async with httpx.AsyncClient(timeout=30) as client:
+    if b64_c is None:
         try:
-            resp = await client.post("https://api.anthropic.com/v1/messages",
-                headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
-                json={"model": CLAUDE_MODEL, "max_tokens": 100,
-                    "messages": [{"role": "user", "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": b64_c}},
-                        {"type": "text", "text": f"This is a cropped clothing item. Write a 4-6 word {cfg['lang']} shopping search query for this EXACT item. Be ultra specific. Reply with ONLY the query."},
-                    ]}]})
-            return resp.json().get("content", [{}])[0].get("text", "").strip()
-        except Exception: pass
+            b64_c = base64.b64encode((await CPU_POOL.run(job_jpeg_views, img_bytes, 400, ((None, 80),)))[0]).decode()
+        except Exception:
+            b64_c = base64.b64encode(img_bytes).decode()
+    client = http_client("anthropic")
+    try:
+        resp = await client.post(ANTHROPIC_API_URL,
+            headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
+            json={"model": CLAUDE_MODEL, "max_tokens": 100,
+                "messages": [{"role": "user", "content": [
+                    {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": b64_c}},
+                    {"type": "text", "text": f"This is a cropped clothing item. Write a 4-6 word {cfg['lang']} shopping search query for this EXACT item. Be ultra specific. Reply with ONLY the query."},
+                ]}]},
+            timeout=30)
+        return resp.json().get("content", [{}])[0].get("text", "").strip()
+    except Exception: pass
     return ""
 
 
@@ -1592,41 +2869,36 @@ async def manual_search(file: UploadFile = File(...), query: str = Form(""), cou
     if not SERPAPI_KEY: raise HTTPException(500, "No API key")
     cc = country.lower()
     contents = await file.read()
+    try:
+        check_decode_size(contents)  # Decode hatasında ham byte'lar rembg'ye gider — orada da çözülmesin
+    except ImageTooLarge as e:
+        return {"success": False, "message": str(e), "products": []}
 
     try:
-        img = Image.open(io.BytesIO(contents)).convert("RGB")
-        img = ImageOps.exif_transpose(img)
-        img.thumbnail((1024, 1024))
-        buf = io.BytesIO(); img.save(buf, format="JPEG", quality=85)
-        optimized = buf.getvalue()
+        optimized, = await CPU_POOL.run(job_jpeg_views, contents, 1024, ((None, 85),))
     except Exception:
         optimized = contents
 
     # Manual mode: remove.bg API first, local rembg fallback
     clean_bytes = await remove_bg_api(optimized)
     if clean_bytes is optimized and HAS_REMBG:
-        # API failed, try local rembg (tek parça, safe)
-        async with REMBG_SEM:
-            clean_bytes = await asyncio.to_thread(remove_bg, optimized)
+        # API failed, try local rembg (ayrı rembg process'i, model ilk kullanımda yüklenir)
+        clean_bytes = await REMBG_BATCHER.submit(optimized) or optimized
 
-    crop_b64 = ""
+    # UI (256) / Claude identify (400) / rerank (512) görselleri tek decode'dan, tek CPU job'unda
+    crop_b64, b64_c, orig_b64 = "", None, None
     try:
-        t_img = Image.open(io.BytesIO(clean_bytes)).convert("RGB")
-        t_img.thumbnail((256, 256))
-        t_buf = io.BytesIO(); t_img.save(t_buf, format="JPEG", quality=80)
-        crop_b64 = "data:image/jpeg;base64," + base64.b64encode(t_buf.getvalue()).decode()
+        t256, t400, t512 = await CPU_POOL.run(job_jpeg_views, clean_bytes, 512, ((256, 80), (400, 80), (None, 80)))
+        crop_b64 = "data:image/jpeg;base64," + base64.b64encode(t256).decode()
+        b64_c, orig_b64 = base64.b64encode(t400).decode(), base64.b64encode(t512).decode()
     except Exception: pass
 
-    url, smart_query = await asyncio.gather(upload_img(clean_bytes), claude_identify_crop(clean_bytes, cc))
+    lens_res, smart_query = await asyncio.gather(lens_image(clean_bytes, cc), claude_identify_crop(clean_bytes, cc, b64_c))
     search_q = query if query else smart_query
 
-    lens_res = []
-    if url:
-        async with API_SEM: lens_res = await asyncio.to_thread(_lens, url, cc)
-
     shop_res = []
     if len(lens_res) < 3 and search_q:
-        async with API_SEM: shop_res = await asyncio.to_thread(_shop, search_q, cc, 6)
+        shop_res = await _shop(search_q, cc, 6)
 
     seen, combined = set(), []
     for x in lens_res + shop_res:
@@ -1634,20 +2906,17 @@ async def manual_search(file: UploadFile = File(...), query: str = Form(""), cou
             seen.add(x["link"]); combined.append(x)
 
     # Manual mode: rerank is safe here (single piece, has time budget)
-    if len(combined) >= 3:
+    if len(combined) >= 3 and orig_b64:
         try:
-            img_ai = Image.open(io.BytesIO(clean_bytes)).convert("RGB")
-            img_ai.thumbnail((512, 512))
-            buf_ai = io.BytesIO(); img_ai.save(buf_ai, format="JPEG", quality=80)
-            orig_b64 = base64.b64encode(buf_ai.getvalue()).decode()
             combined = await claude_rerank(orig_b64, combined, cc, "clothing item")
         except Exception: pass
 
     return {"success": True, "products": combined[:10], "lens_count": len(lens_res), "query_used": search_q, "country": cc, "bg_removed": HAS_REMBG, "crop_image": crop_b64}
 
 # ─── TRENDING DATA (dynamic + curated) ───
-TRENDING_CACHE = {}  # lang → {brands, products, ts}
-TRENDING_TTL = 86400  # 24 saat cache
+# Trending payload'ı _CACHE'te "trend:{lang}" key'i ile tutulur → {brands, products, ts}
+TRENDING_TTL = 86400  # 24 saat taze
+TRENDING_STALE_TTL = 7 * 86400  # Bu süre boyunca stale payload servis edilebilir (arka planda yenilenirken)
 
 # ─── POPULAR SEARCHES (app-internal tracking) ───
 POPULAR_SEARCHES = []  # [{query, img, title, brand, price, link, ts}]
@@ -1745,72 +3014,96 @@ TRENDING_QUERIES = {
     ],
 }
 
+# ─── Ürün URL sınıflandırıcı — tablolar modül seviyesinde bir kez derlenir ───
+# ❌ Kesinlikle ürün sayfası DEĞİL (arama/kategori sayfaları)
+SEARCH_URL_PATTERNS = [
+    "/sr?", "/search?", "/search/", "/arama?", "/arama/",
+    "?q=", "?query=", "?search=", "?keyword=",
+    "/kategori/", "/category/", "/categories/",
+    "/collection/", "/collections/", "/koleksiyon/",
+    "/list/", "/listing/", "/browse/",
+    "/c/", "/shop/", "/store/",  # generic category paths
+    "?text=", "?term=", "&q=",
+    "/women/", "/men/", "/kadin/", "/erkek/",  # category landing pages
+]
+# Exception: some stores use /shop/ or /c/ in product URLs too → ürün kimliği varsa yine ürün
+PRODUCT_ID_RE = re.compile(r'-p-\d|/dp/|/product/|/urun/|/p\d{4,}|productpage|/t/[A-Z]')
+
+# ✅ Bilinen mağazaların ürün URL pattern'leri — sadece host'a, etiket sınırında son ek olarak bakılır
+# (www2.hm.com → hm.com; shm.com değil). "boyner.com" boyner.com.tr'ye de uyar; "." ile biten key'ler
+# (amazon. / adidas.) marka etiketi + kısa TLD etiketleri: amazon.co.uk, adidas.com.tr
+PRODUCT_URL_PATTERNS = {
+    "trendyol.com": r'-p-\d+',
+    "hepsiburada.com": r'-p[m]?-[A-Za-z0-9]+',
+    "amazon.": r'/dp/[a-zA-Z0-9]+|/gp/product/',
+    "n11.com": r'/urun/',
+    "boyner.com": r'/urun/|/p/',
+    "beymen.com": r'/urun/|/p/',
+    "defacto.com": r'/\w+-\w+-\d+',
+    "lcwaikiki.com": r'/tr-tr/.*\d',
+    "zara.com": r'/tr/.+/p\d+|/p\d{4,}',
+    "bershka.com": r'/tr/.+/\d+|/\d{8,}',
+    "pullandbear.com": r'/tr/.+/\d+|/\d{8,}',
+    "stradivarius.com": r'/tr/.+/\d+|/\d{8,}',
+    "hm.com": r'/productpage\.|/p\.',
+    "nike.com": r'/t/[A-Za-z]',
+    "adidas.": r'/[A-Z]{2}\d{4}|/product/',
+    "mango.com": r'/\d{8,}',
+    "koton.com": r'/product/|/urun/',
+    "flo.com": r'/urun/',
+    "occasion.com.tr": r'/urun/|/product/',
+}
+SEARCH_URL_INDEX = SubstringIndex(SEARCH_URL_PATTERNS)
+_PRODUCT_URL_RES = {d: re.compile(p) for d, p in PRODUCT_URL_PATTERNS.items()}
+_PRODUCT_HOST_PREFIXES = {d[:-1]: _PRODUCT_URL_RES[d] for d in PRODUCT_URL_PATTERNS if d.endswith(".")}
+_URL_HOST_RE = re.compile(r'^(?:[a-z][a-z0-9+.\-]*:)?//(?:[^/?#@]*@)?([^/?#:]*)|^([^/?#:]*)')
+
+@lru_cache(maxsize=4096)
+def product_url_rule(host):
+    """host → mağazanın derlenmiş ürün regex'i, bilinmeyen mağazada None. En uzun son ek kazanır;
+    bulunamazsa .com.XX / .co.XX host'u ülke eki atılarak bir kez daha (boyner.com.tr → boyner.com)."""
+    labels = host.strip(".").split(".")
+    variants = [labels]
+    if len(labels) > 2 and labels[-2] in ("com", "co") and len(labels[-1]) == 2:
+        variants.append(labels[:-1])
+    for ls in variants:
+        for i in range(len(ls) - 1):
+            rule = _PRODUCT_URL_RES.get(".".join(ls[i:]))
+            if rule is not None: return rule
+    for i, label in enumerate(labels[:-1]):
+        rule = _PRODUCT_HOST_PREFIXES.get(label)
+        if rule is not None and all(len(x) <= 3 for x in labels[i + 1:]): return rule
+    return None
+
+@lru_cache(maxsize=16384)
 def is_product_url(url):
-    """URL gerçek bir ürün sayfası mı, yoksa arama/kategori sayfası mı?"""
+    """URL gerçek bir ürün sayfası mı, yoksa arama/kategori sayfası mı? Aynı link'ler Shopping, Lens ve
+    score_result'ta tekrar sorulduğu için karar URL başına memoize edilir."""
     if not url: return False
     u = url.lower()
-
-    # ❌ Kesinlikle ürün sayfası DEĞİL (arama/kategori sayfaları)
-    search_patterns = [
-        "/sr?", "/search?", "/search/", "/arama?", "/arama/",
-        "?q=", "?query=", "?search=", "?keyword=",
-        "/kategori/", "/category/", "/categories/",
-        "/collection/", "/collections/", "/koleksiyon/",
-        "/list/", "/listing/", "/browse/",
-        "/c/", "/shop/", "/store/",  # generic category paths
-        "?text=", "?term=", "&q=",
-        "/women/", "/men/", "/kadin/", "/erkek/",  # category landing pages
-    ]
-    if any(sp in u for sp in search_patterns):
-        # Exception: some stores use /shop/ or /c/ in product URLs too
-        # Check if there's also a product identifier after
-        has_product_id = bool(re.search(r'-p-\d|/dp/|/product/|/urun/|/p\d{4,}|productpage|/t/[A-Z]', u))
-        if not has_product_id:
-            return False
-
-    # ✅ Bilinen mağazaların ürün URL pattern'leri
-    product_patterns = {
-        "trendyol.com": r'-p-\d+',
-        "hepsiburada.com": r'-p[m]?-[A-Za-z0-9]+',
-        "amazon.": r'/dp/[a-zA-Z0-9]+|/gp/product/',
-        "n11.com": r'/urun/',
-        "boyner.com": r'/urun/|/p/',
-        "beymen.com": r'/urun/|/p/',
-        "defacto.com": r'/\w+-\w+-\d+',
-        "lcwaikiki.com": r'/tr-tr/.*\d',
-        "zara.com": r'/tr/.+/p\d+|/p\d{4,}',
-        "bershka.com": r'/tr/.+/\d+|/\d{8,}',
-        "pullandbear.com": r'/tr/.+/\d+|/\d{8,}',
-        "stradivarius.com": r'/tr/.+/\d+|/\d{8,}',
-        "hm.com": r'/productpage\.|/p\.',
-        "nike.com": r'/t/[A-Za-z]',
-        "adidas.": r'/[A-Z]{2}\d{4}|/product/',
-        "mango.com": r'/\d{8,}',
-        "koton.com": r'/product/|/urun/',
-        "flo.com": r'/urun/',
-        "occasion.com.tr": r'/urun/|/product/',
-    }
-
-    for domain, pattern in product_patterns.items():
-        if domain in u:
-            return bool(re.search(pattern, u))
-
+    if SEARCH_URL_INDEX.search(u) and not PRODUCT_ID_RE.search(u):
+        return False
+    m = _URL_HOST_RE.match(u)
+    rule = product_url_rule(m.group(1) if m.group(1) is not None else m.group(2))
+    if rule is not None:
+        return rule.search(u) is not None
     # Bilinmeyen domain: arama pattern'i yoksa ürün kabul et
     return True
 
 
-def _fetch_trending_products(lang="tr"):
+async def _fetch_trending_products(lang="tr"):
     """Google organic + Shopping'den trending ürünleri çek — SADECE DOĞRUDAN ÜRÜN SAYFALARI."""
     cc = "tr" if lang == "tr" else "us"
     cfg = get_country_config(cc)
-    products = []
     queries = TRENDING_QUERIES.get(lang, TRENDING_QUERIES["en"])
-    for q in queries:
+
+    async def fetch_query(q):
+        products = []
         try:
             found = False
 
             # 1) Google Shopping — direct link + ürün sayfası kontrolü
-            d = GoogleSearch({"engine": "google_shopping", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY, "num": 5}).get_dict()
+            d = await serpapi_search({"engine": "google_shopping", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY, "num": 5})
             for item in d.get("shopping_results", [])[:8]:
                 direct_link = item.get("link", "")
                 ttl = item.get("title", "")
@@ -1840,7 +3133,7 @@ def _fetch_trending_products(lang="tr"):
 
             # 2) Google organic — fashion domain'lerden ürün sayfası bul
             if not found:
-                d2 = GoogleSearch({"engine": "google", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY, "num": 10}).get_dict()
+                d2 = await serpapi_search({"engine": "google", "q": q, "gl": cfg["gl"], "hl": cfg["hl"], "api_key": SERPAPI_KEY, "num": 10})
 
                 for item in d2.get("organic_results", [])[:8]:
                     lnk = item.get("link", "")
@@ -1879,24 +3172,46 @@ def _fetch_trending_products(lang="tr"):
 
         except Exception as e:
             print(f"Trending fetch err ({q}): {e}")
-    return products
-
-def _get_trending(lang="tr"):
-    """Trending data al — cache varsa cache'den, yoksa SerpAPI'den çek."""
-    now = time.time()
-    cached = TRENDING_CACHE.get(lang)
-    if cached and (now - cached["ts"]) < TRENDING_TTL:
+        return products
+
+    # Sorgular paralel (serpapi limiter'ı altında) — sıra gather ile korunur
+    per_query = await asyncio.gather(*[fetch_query(q) for q in queries])
+    return [p for ps in per_query for p in ps]
+
+_TRENDING_INFLIGHT = {}  # lang → asyncio.Task (aynı dil için tek refresh)
+
+def _refresh_trending(lang):
+    """Coalesced refresh: aynı dil için zaten uçuşta bir job varsa onu döndür."""
+    task = _TRENDING_INFLIGHT.get(lang)
+    if task is None or task.done():
+        task = spawn(_build_trending(lang))
+        _TRENDING_INFLIGHT[lang] = task
+        task.add_done_callback(lambda t: _TRENDING_INFLIGHT.pop(lang, None) if _TRENDING_INFLIGHT.get(lang) is t else None)
+    return task
+
+async def _get_trending(lang="tr", refresh=False):
+    """Trending data al — stale-while-revalidate: TTL dolmuşsa eski payload hemen döner,
+    yenileme arka planda (dil başına tek job). Cache hiç yoksa ilk refresh beklenir."""
+    cached = cache_get(f"trend:{lang}")
+    if cached and not refresh:
+        if time.time() - cached["ts"] >= TRENDING_TTL:
+            _refresh_trending(lang)
         return cached
+    # shield: istek iptal olsa da paylaşılan refresh devam etsin
+    return await asyncio.shield(_refresh_trending(lang))
 
+async def _build_trending(lang="tr"):
+    now = time.time()
     brands = BRAND_DATA.get(lang, BRAND_DATA["en"])
     labels = {"tr": ("🏷️ Popüler Markalar", "🔥 Bu Hafta Trend"), "en": ("🏷️ Popular Brands", "🔥 Trending This Week")}
     lb = labels.get(lang, labels["en"])
 
     # SerpAPI'den gerçek ürünleri çek
-    products = _fetch_trending_products(lang)
+    products = await _fetch_trending_products(lang)
     if not products:
-        # Fallback — SerpAPI yoksa boş göster
-        products = []
+        # Fallback — SerpAPI boş/hatalı: eldeki (stale) ürünleri koru, bir sonraki TTL'de tekrar dene
+        stale = cache_get(f"trend:{lang}")
+        products = stale["products"] if stale else []
 
     data = {
         "brands": brands,
@@ -1905,7 +3220,7 @@ def _get_trending(lang="tr"):
         "section_trending": lb[1],
         "ts": now,
     }
-    TRENDING_CACHE[lang] = data
+    cache_set(f"trend:{lang}", data, TRENDING_STALE_TTL)
     print(f"🔥 Trending refreshed ({lang}): {len(products)} products, {len(brands)} brands")
     return data
 
@@ -1982,10 +3297,42 @@ async def brand_logo(name: str = ""):
                     headers={"Cache-Control": "public, max-age=604800"})
 
 @app.get("/api/health")
-async def health(): return {"status": "ok", "version": "v42-fitchy", "serpapi": bool(SERPAPI_KEY), "anthropic": bool(ANTHROPIC_API_KEY), "rembg": HAS_REMBG}
+async def health():
+    return {"status": "ok", "version": "v42-fitchy", "serpapi": bool(SERPAPI_KEY), "anthropic": bool(ANTHROPIC_API_KEY), "rembg": HAS_REMBG,
+            "rembg_model": {**REMBG_STATE, "workers": REMBG_POOL.workers if REMBG_POOL.executor else 0}}
+
+# ─── ADMIN: X-Admin-Token header'ı şart; ADMIN_TOKEN set değilse endpoint'ler kapalı ───
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def require_admin(request):
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(403, "Forbidden")
+
+# ─── CACHE STATS (Claude / SerpAPI harcamasının ne kadarı cache'den karşılanıyor) — admin ───
+@app.get("/api/cache-stats")
+async def cache_stats(request: Request):
+    require_admin(request)
+    # claude = claude_detect, lens = Google Lens, shop/gorg = Shopping/organic, trend = trending
+    return {"namespaces": _CACHE.snapshot(), "img": IMG_CACHE.snapshot().get("img", {}),
+            "img_disk": {**IMG_DISK_STATS, "enabled": bool(IMG_DISK_DIR), "budget": IMG_DISK_MAX_BYTES},
+            "single_flight": {**SF_STATS, "inflight": len(_INFLIGHT)},
+            "tmpimg": {**TMPIMG_STORE.snapshot().get("tmpimg", {}), "enabled": TMPIMG["enabled"], "misses": TMPIMG["misses"]},
+            "serpapi": {eng: {**st, "p50": serpapi_latency(eng, 0.5), "p90": serpapi_latency(eng, 0.9),
+                              "p99": serpapi_latency(eng, 0.99), "hedge_delay": hedge_delay(eng)}
+                        for eng, st in HEDGE_STATS.items()}}
+
+# ─── ADMIN: upstream limiter durumu ───
+
+@app.get("/api/admin/limits")
+async def admin_limits(request: Request):
+    require_admin(request)
+    return {"limiters": {name: lim.snapshot() for name, lim in LIMITERS.items()},
+            "latency_tolerance": LIMIT_LATENCY_TOLERANCE,
+            "upload_hosts": {"order": upload_host_order(), "stats": {h: _host_stat(h) for h in UPLOAD_HOSTS}},
+            "cpu_pool": CPU_POOL.snapshot(), "rembg_pool": {**REMBG_POOL.snapshot(), **REMBG_BATCHER.stats}}
 
 # ─── SESSION STORE (detect → search-piece) ───
-DETECT_SESSIONS = {}  # detect_id → {pieces, img_url, crop_data, cc, created_at}
+DETECT_SESSIONS = {}  # detect_id → {pieces, img_url, img_bytes, img_digest, crop_data, crop_thumbs, cc, created_at}
 SESSION_TTL = 600  # 10 minutes
 
 def session_cleanup():
@@ -2001,28 +3348,15 @@ async def detect_pieces(file: UploadFile = File(...), country: str = Form("tr"))
     cc = country.lower()
     contents = await file.read()
     session_cleanup()
-
-    try:
-        img = Image.open(io.BytesIO(contents)).convert("RGB")
-        img = ImageOps.exif_transpose(img)
-        img_obj = img.copy()
-        img_obj.thumbnail((1400, 1400))
-        img.thumbnail((1400, 1400))
-        buf = io.BytesIO(); img.save(buf, format="JPEG", quality=95)
-        optimized = buf.getvalue()
-        b64 = base64.b64encode(optimized).decode()
-        print(f"  Image: {img.size[0]}x{img.size[1]}, {len(optimized)//1024}KB sent to Claude")
-    except Exception:
-        img_obj = Image.open(io.BytesIO(contents)).convert("RGB")
-        optimized = contents
-        b64 = base64.b64encode(contents).decode()
-
     print(f"\n{'='*50}\n=== DETECT v41 === country={cc}")
 
     try:
+        optimized, b64, ph = await decode_upload(contents)
+        digest, detect_digest = resolve_image_digest(ph, optimized)
+
         # Claude detect + Upload full image → PARALLEL
-        detect_task = claude_detect(b64, cc)
-        upload_task = upload_img(optimized)
+        detect_task = claude_detect_cached(b64, detect_digest, cc)
+        upload_task = upload_for_lens(optimized, cc, "exact_matches", digest=digest)
         pieces, img_url = await asyncio.gather(detect_task, upload_task)
 
         if not pieces:
@@ -2036,24 +3370,20 @@ async def detect_pieces(file: UploadFile = File(...), country: str = Form("tr"))
 
         # Crop each piece + generate thumbnails
         crop_data = {}  # piece_idx → crop_bytes
+        crop_thumbs = {}  # piece_idx → 128px data-URI (search-piece kartı; crop yeniden decode edilmez)
+        boxed = [i for i, p in enumerate(pieces) if isinstance(p.get("box_2d"), list) and len(p["box_2d"]) == 4]
+        # 200px picker UI thumbnail + 128px sonuç kartı thumbnail'i aynı crop'tan, tüm parçalar tek CPU job'u
+        crops = dict(zip(boxed, await crop_pieces(optimized, [pieces[i]["box_2d"] for i in boxed], ((200, 80), (128, 75)))))
         piece_results = []
         for i, p in enumerate(pieces):
             print(f"  → {p.get('category')} | brand={p.get('brand')} | text='{p.get('visible_text','')}' | box={p.get('box_2d')}")
             crop_b64 = ""
-            box = p.get("box_2d")
-            if box and isinstance(box, list) and len(box) == 4:
-                try:
-                    cropped_bytes = await asyncio.to_thread(crop_piece, img_obj, box)
-                    if cropped_bytes:
-                        crop_data[i] = cropped_bytes
-                        # Generate 200px thumbnail for picker UI
-                        t_img = Image.open(io.BytesIO(cropped_bytes)).convert("RGB")
-                        t_img.thumbnail((200, 200))
-                        t_buf = io.BytesIO(); t_img.save(t_buf, format="JPEG", quality=80)
-                        crop_b64 = "data:image/jpeg;base64," + base64.b64encode(t_buf.getvalue()).decode()
-                        print(f"    Cropped OK ({len(cropped_bytes)//1024}KB)")
-                except Exception as e:
-                    print(f"    Crop error: {e}")
+            cropped_bytes, thumbs = crops.get(i, (None, {}))
+            if cropped_bytes:
+                crop_data[i] = cropped_bytes
+                crop_b64 = thumbs.get(200, "")
+                if 128 in thumbs: crop_thumbs[i] = thumbs[128]
+                print(f"    Cropped OK ({len(cropped_bytes)//1024}KB)")
 
             piece_results.append({
                 "category": p.get("category", ""),
@@ -2071,7 +3401,10 @@ async def detect_pieces(file: UploadFile = File(...), country: str = Form("tr"))
         DETECT_SESSIONS[detect_id] = {
             "pieces": pieces,
             "img_url": img_url,
+            "img_bytes": optimized,  # Cache miss'te upload için
+            "img_digest": digest,  # Lens cache key (görselin byte md5'i)
             "crop_data": crop_data,
+            "crop_thumbs": crop_thumbs,
             "cc": cc,
             "created_at": time.time(),
         }
@@ -2101,6 +3434,8 @@ async def search_piece(detect_id: str = Form(""), piece_index: int = Form(0), co
 
     p = pieces[piece_index]
     img_url = session.get("img_url", "")
+    img_bytes = session.get("img_bytes", b"")
+    digest = session.get("img_digest") or img_digest(img_bytes)
     crop_bytes = session.get("crop_data", {}).get(piece_index)
     cfg = get_country_config(cc)
 
@@ -2135,205 +3470,27 @@ async def search_piece(detect_id: str = Form(""), piece_index: int = Form(0), co
         print(f"  {pri}: '{q}'")
 
     try:
-        # ── ALL searches in parallel (v42: no google organic) ──
-        async def do_shop(q, limit=8):
-            async with API_SEM:
-                return await asyncio.to_thread(_shop, q, cc, limit)
-
-        async def do_piece_lens():
-            if not crop_bytes: return []
-            url = await upload_img(crop_bytes)
-            if url:
-                async with API_SEM:
-                    return await asyncio.to_thread(_lens, url, cc, "all")
-            return []
-
-        async def do_full_lens_exact():
-            if img_url:
-                async with API_SEM:
-                    return await asyncio.to_thread(_lens, img_url, cc, "exact_matches")
-            return []
-
-        # v42 OPTIMIZED: removed full_lens_visual + google organic
-        tasks = []
-        task_labels = []
-
-        # 1. Full image exact Lens
-        tasks.append(do_full_lens_exact()); task_labels.append("exact_lens")
-        # 2. Per-piece crop Lens (exact+visual)
-        tasks.append(do_piece_lens()); task_labels.append("piece_lens")
-        # 3. Shopping (1 merged query)
-        for q, pri in queries:
-            tasks.append(do_shop(q)); task_labels.append(f"shop_{pri}")
-
-        serpapi_calls = len(tasks)
-        print(f"  v42 optimized: {serpapi_calls} SerpAPI calls")
-
-        all_results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        # ── Collect results ──
-        exact_lens_results = all_results[0] if not isinstance(all_results[0], Exception) else []
-        piece_lens_results = all_results[1] if not isinstance(all_results[1], Exception) else []
-
-        shop_results = []
-        for idx in range(2, len(all_results)):
-            r = all_results[idx] if not isinstance(all_results[idx], Exception) else []
-            label = task_labels[idx]
-            if label.startswith("shop_"): shop_results.extend(r)
-
-        # ── Filter full-image Lens results to THIS piece using keywords ──
-        piece_kws = PIECE_KEYWORDS.get(cat, [])
-        def matches_piece(r):
-            t = (r.get("title", "") + " " + r.get("source", "")).lower()
-            return any(kw in t for kw in piece_kws)
-
-        # Exact lens: filter to this piece (or include all if only 1 piece)
-        filtered_exact = []
-        for r in exact_lens_results:
-            if len(pieces) == 1 or matches_piece(r) or r.get("_exact"):
-                filtered_exact.append(r)
-
-        # Combine all lens results (no more full_lens_visual backup)
-        all_lens = filtered_exact + piece_lens_results
-
-        print(f"  Results: exact={len(filtered_exact)} piece_lens={len(piece_lens_results)} shop={len(shop_results)}")
-        if filtered_exact:
-            for r in filtered_exact[:3]:
-                print(f"    ✅ EXACT: {r.get('title','')[:50]} | {r.get('source','')}")
-
-        # ── Score everything (v42: 2 channels — lens + shopping) ──
-        shop_links = {r.get("link", "") for r in shop_results}
-        lens_links = {r.get("link", "") for r in all_lens}
-
-        piece_color = p.get("color", "")
-        piece_style = p.get("style_type", "")
-
-        def score_result(r, base_score=0):
-            score = base_score
-            combined = (r.get("title", "") + " " + r.get("link", "") + " " + r.get("source", "")).lower()
-            rtitle = r.get("title", "")
-            if r.get("_exact"): score += 50; r["ai_verified"] = True
-            link = r.get("link", "")
-            if link in shop_links and link in lens_links:
-                score += 25; r["ai_verified"] = True
-            if brand and brand != "?" and len(brand) > 2 and brand.lower() in combined: score += 8
-            if visible_text and visible_text.lower() not in ["none", "?", ""]:
-                for vt in visible_text.lower().replace(",", " ").split():
-                    if len(vt) > 2 and vt in combined: score += 10; break
-            if r.get("price"): score += 2
-            if r.get("is_local"): score += 15
-            # v42: COLOR PENALTY
-            if detect_color_conflict(piece_color, rtitle):
-                score -= 30
-            # v42: SUB-TYPE PENALTY
-            if detect_subtype_conflict(piece_style, rtitle, cat):
-                score -= 25
-            # v42: CATEGORY RELEVANCE
-            cat_keywords = PIECE_KEYWORDS.get(cat, [])
-            has_target_kw = any(kw in rtitle.lower() for kw in cat_keywords if len(kw) >= 3)
-            if has_target_kw:
-                score += 15
-            elif cat in ("watch", "bag", "sunglasses", "hat", "scarf", "accessory"):
-                score -= 20
-            # v42: NON-PRODUCT URL penalty
-            if not is_product_url(r.get("link", "")):
-                score -= 40
-            return score
-
-        seen = set()
-        all_items = []
-
-        # Lens (highest priority)
-        for r in all_lens:
-            if r.get("link") and r["link"] not in seen:
-                lnk = r.get("link", "")
-                ttl = r.get("title", "")
-                if is_blocked(lnk): continue
-                if r.get("_exact") and not is_fashion(lnk, ttl, r.get("source", "")): continue
-                if not r.get("_exact"):
-                    if is_category_mismatch(ttl, cat): continue
-                    if is_non_clothing_product(ttl): continue
-                seen.add(lnk)
-                r["_score"] = score_result(r, 18)
-                all_items.append(r)
-
-        # Shopping
-        for r in shop_results:
-            if r.get("link") and r["link"] not in seen:
-                if is_category_mismatch(r.get("title", ""), cat): continue
-                if is_non_clothing_product(r.get("title", "")): continue
-                seen.add(r["link"])
-                r["_score"] = score_result(r, 15)
-                all_items.append(r)
-
-        all_items.sort(key=lambda x: (-int(x.get("_exact", False)), -x.get("_score", 0)))
-
-        # 🇹🇷 TR-FIRST: Local results ALWAYS first
-        local_items = [r for r in all_items if r.get("is_local")]
-        foreign_items = [r for r in all_items if not r.get("is_local")]
-        local_exact = [r for r in local_items if r.get("_exact")]
-        local_rest = [r for r in local_items if not r.get("_exact")]
-        foreign_exact = [r for r in foreign_items if r.get("_exact")]
-        foreign_rest = [r for r in foreign_items if not r.get("_exact")]
-        all_items = local_exact + local_rest + foreign_exact + foreign_rest
-
-        # Match confidence
-        top_score = all_items[0].get("_score", 0) if all_items else 0
-        has_brand = any(brand and brand != "?" and brand.lower() in (r.get("title","")+" "+r.get("link","")).lower() for r in all_items[:3]) if brand and brand != "?" else False
-        has_text = False
-        if visible_text and visible_text.lower() not in ["none", "?", ""]:
-            vt_words = [w for w in visible_text.lower().replace(",", " ").split() if len(w) > 2]
-            for r in all_items[:3]:
-                if any(w in r.get("title", "").lower() for w in vt_words): has_text = True; break
-
-        has_exact_flag = any(r.get("_exact") for r in all_items[:5])
-        has_ai_verified = any(r.get("ai_verified") for r in all_items[:3])
-
-        if has_exact_flag or top_score >= 50: match_level = "exact"
-        elif has_ai_verified or (top_score >= 25 and (has_brand or has_text)): match_level = "exact"
-        elif top_score >= 15 or has_brand: match_level = "close"
-        else: match_level = "similar"
-
-        for j, r in enumerate(all_items[:3]):
-            print(f"  #{j+1}: score={r.get('_score',0)} {r.get('title','')[:50]}")
-        print(f"  match={match_level} brand={has_brand} text={has_text}")
-
-        # Clean internal fields
-        for r in all_items:
-            for k in ["_score", "_priority", "_channel", "_src", "_exact"]: r.pop(k, None)
-            # Inject verified badges
-            badge = get_verified_badge(r.get("link", ""))
-            if badge: r["_verified"] = badge
-
-        crop_b64 = ""
-        if crop_bytes:
-            try:
-                t_img = Image.open(io.BytesIO(crop_bytes)).convert("RGB")
-                t_img.thumbnail((128, 128))
-                t_buf = io.BytesIO(); t_img.save(t_buf, format="JPEG", quality=75)
-                crop_b64 = "data:image/jpeg;base64," + base64.b64encode(t_buf.getvalue()).decode()
-            except: pass
-
-        # Record for popular searches
-        if all_items and match_level in ("exact", "close"):
-            record_popular_search(p, all_items[0])
-        # Record analytics
-        record_analytics("search_piece", {"category": cat, "brand": brand, "color": p.get("color", ""), "style_type": p.get("style_type", ""), "query": queries[0][0] if queries else "", "match_level": match_level, "country": cc, "results_count": len(all_items)})
+        # ── ALL searches in parallel (v42: no google organic) — full-analyze ile aynı task'lar ve merger ──
+        # 1. Full image exact Lens (bu parçaya süzülür) 2. Per-piece crop Lens 3. Shopping (1 merged query)
+        crop_tasks = [(piece_index, crop_bytes, img_digest(crop_bytes))] if crop_bytes else []
+        search_queries = [(piece_index, q, pri) for q, pri in queries]
+        t_search = time.time()
+        tasks, task_map = build_search_tasks(pieces, search_queries, crop_tasks, img_bytes, digest, img_url, cc,
+                                             t_search, focus=piece_index)
+        print(f"  v42 optimized: {len(tasks)} SerpAPI calls")
+
+        # ── Collect results (biten sırayla, varışta skorlanır; deadline'da geç kalan task = boş) ──
+        merger = PieceMerger(pieces, task_map)
+        async for k, res in iter_completed(tasks, ANALYZE_DEADLINE, "search-piece"):
+            merger.add(k, res)
+        piece = merger.final(piece_index, cc, event="search_piece", query=queries[0][0] if queries else "")
+
+        # Thumbnail detect sırasında crop'la birlikte üretildi — burada yeniden decode yok
+        piece["crop_image"] = session.get("crop_thumbs", {}).get(piece_index, "") if crop_bytes else ""
 
         return {
             "success": True,
-            "piece": {
-                "category": cat,
-                "short_title": p.get("short_title", cat.title()),
-                "brand": brand if brand != "?" else "",
-                "visible_text": visible_text,
-                "color": p.get("color", ""),
-                "style_type": p.get("style_type", ""),
-                "products": all_items[:8],
-                "lens_count": len(all_lens),
-                "match_level": match_level,
-                "crop_image": crop_b64,
-            },
+            "piece": piece,
             "country": cc,
             "_search_query": queries[0][0] if queries else "",  # For "load more" button
         }
@@ -2353,8 +3510,7 @@ async def load_more(query: str = Form(""), country: str = Form("tr"), exclude: s
     exclude_links = set(json.loads(exclude)) if exclude else set()
 
     print(f"\n=== LOAD MORE === q='{query}' cc={cc}")
-    async with API_SEM:
-        results = await asyncio.to_thread(_google_organic, query, cc, 10)
+    results = await _google_organic(query, cc, 10)
 
     # Filter out already-shown results
     products = []
@@ -2443,53 +3599,123 @@ async def icon_512():
                     headers={"Cache-Control": "public, max-age=604800"})
 
 # ─── IMAGE PROXY (bypass hotlink protection for trending images) ───
-IMG_CACHE = {}  # url_hash → (content_type, bytes)
+# RAM: byte bütçeli LRU ("img:{url_hash}" → (content_type, bytes)) — rembg ile aynı 8GB kutuda sınırsız büyümesin
+IMG_CACHE_MAX_BYTES = int(os.environ.get("IMG_CACHE_MAX_MB", "64")) * 1024 * 1024
+IMG_CACHE_TTL = 86400
+IMG_CACHE = TTLCache({"img": IMG_CACHE_MAX_BYTES}, default_budget=IMG_CACHE_MAX_BYTES, ttl=IMG_CACHE_TTL)
+
+# Opsiyonel disk katmanı (IMG_DISK_DIR boşsa kapalı) — restart sonrası sıcak thumbnail'ler RAM'e alınmadan servis edilir.
+# Layout: blobs/ab/<sha1(bytes)> = ham görsel (header yok → mmap/sendfile dostu, aynı içerik tek kopya)
+#         refs/cd/<url_hash>      = "<sha1>\n<content-type>"
+IMG_DISK_DIR = os.environ.get("IMG_DISK_DIR", "")
+IMG_DISK_MAX_BYTES = int(os.environ.get("IMG_DISK_MAX_MB", "512")) * 1024 * 1024
+IMG_DISK_STATS = {"hits": 0, "writes": 0, "evictions": 0, "bytes": 0}
+
+def _img_disk_paths(kind, name):
+    return os.path.join(IMG_DISK_DIR, kind, name[:2], name)
+
+def _img_disk_get(url_hash):
+    """Disk'teki görsel → (content_type, blob_path) veya None."""
+    ref = _img_disk_paths("refs", url_hash)
+    try:
+        with open(ref) as f: sha, ct = f.read().split("\n", 1)
+    except (OSError, ValueError):
+        return None
+    blob = _img_disk_paths("blobs", sha)
+    if not os.path.exists(blob):
+        try: os.remove(ref)  # Sweep blob'u silmiş
+        except OSError: pass
+        return None
+    return ct, blob
+
+def _img_disk_put(url_hash, ct, data):
+    sha = sha1(data).hexdigest()
+    blob = _img_disk_paths("blobs", sha)
+    ref = _img_disk_paths("refs", url_hash)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    os.makedirs(os.path.dirname(ref), exist_ok=True)
+    if not os.path.exists(blob):
+        tmp = f"{blob}.{uuid.uuid4().hex[:6]}.tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, blob)  # Atomik — yarım dosya servis edilmez
+        IMG_DISK_STATS["bytes"] += len(data)
+    tmp = f"{ref}.{uuid.uuid4().hex[:6]}.tmp"
+    with open(tmp, "w") as f: f.write(f"{sha}\n{ct}")
+    os.replace(tmp, ref)
+    IMG_DISK_STATS["writes"] += 1
+    if IMG_DISK_STATS["bytes"] > IMG_DISK_MAX_BYTES: _img_disk_sweep()
+
+def _img_disk_sweep(target=0.8):
+    """Disk bütçesi aşıldı → en eski blob'ları sil (mtime), bütçenin %80'ine in. Yetim ref'ler okunurken temizlenir."""
+    blobs, total = [], 0
+    for root, _, files in os.walk(os.path.join(IMG_DISK_DIR, "blobs")):
+        for fn in files:
+            p = os.path.join(root, fn)
+            try: st = os.stat(p)
+            except OSError: continue
+            blobs.append((st.st_mtime, st.st_size, p)); total += st.st_size
+    blobs.sort()
+    for _, size, p in blobs:
+        if total <= IMG_DISK_MAX_BYTES * target: break
+        try: os.remove(p); total -= size; IMG_DISK_STATS["evictions"] += 1
+        except OSError: pass
+    IMG_DISK_STATS["bytes"] = total
+
+def img_cache_put(url_hash, ct, data):
+    IMG_CACHE.set(f"img:{url_hash}", (ct, data))
+    if IMG_DISK_DIR:
+        spawn(asyncio.to_thread(_img_disk_put, url_hash, ct, data))
+
+@app.on_event("startup")
+async def init_img_disk():
+    if IMG_DISK_DIR:
+        await asyncio.to_thread(_img_disk_sweep, 1.0)  # Mevcut boyutu ölç (bütçe aşılmışsa kırp)
+        print(f"✅ IMG disk cache: {IMG_DISK_DIR} ({IMG_DISK_STATS['bytes']//1024}KB)")
 
 @app.get("/api/img")
 async def proxy_img(url: str = ""):
     if not url: return Response(content=b"", status_code=400)
     url_hash = md5(url.encode()).hexdigest()
-    if url_hash in IMG_CACHE:
-        ct, data = IMG_CACHE[url_hash]
+    cached = IMG_CACHE.get(f"img:{url_hash}")
+    if cached:
+        ct, data = cached
         return Response(content=data, media_type=ct, headers={"Cache-Control": "public, max-age=86400"})
+    if IMG_DISK_DIR:
+        on_disk = await asyncio.to_thread(_img_disk_get, url_hash)
+        if on_disk:
+            IMG_DISK_STATS["hits"] += 1
+            return FileResponse(on_disk[1], media_type=on_disk[0], headers={"Cache-Control": "public, max-age=86400"})
     try:
         # Extract domain for Referer/Origin spoof
         parsed = urllib.parse.urlparse(url)
         origin = f"{parsed.scheme}://{parsed.netloc}"
-        async with httpx.AsyncClient(timeout=15, follow_redirects=True) as client:
-            r = await client.get(url, headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-                "Accept-Language": "tr-TR,tr;q=0.9,en;q=0.8",
-                "Referer": origin + "/",
-                "Origin": origin,
-                "Sec-Fetch-Dest": "image",
-                "Sec-Fetch-Mode": "no-cors",
-                "Sec-Fetch-Site": "same-origin",
-            })
-            if r.status_code == 200 and len(r.content) > 500:
-                ct = r.headers.get("content-type", "image/jpeg")
-                if "image" in ct or "octet" in ct:
-                    # Upscale small images for better display quality
-                    try:
-                        from PIL import Image
-                        img_pil = Image.open(io.BytesIO(r.content))
-                        w, h = img_pil.size
-                        if w < 300 or h < 300:
-                            # Upscale to at least 300px with LANCZOS
-                            scale = max(300/w, 300/h)
-                            new_w, new_h = int(w*scale), int(h*scale)
-                            img_pil = img_pil.resize((new_w, new_h), Image.LANCZOS)
-                            buf = io.BytesIO()
-                            img_pil.save(buf, format="JPEG", quality=90)
-                            enhanced = buf.getvalue()
-                            IMG_CACHE[url_hash] = ("image/jpeg", enhanced)
-                            return Response(content=enhanced, media_type="image/jpeg",
-                                          headers={"Cache-Control": "public, max-age=86400"})
-                    except:
-                        pass
-                    IMG_CACHE[url_hash] = (ct, r.content)
-                    return Response(content=r.content, media_type=ct, headers={"Cache-Control": "public, max-age=86400"})
+        client = http_client("fetch")
+        r = await client.get(url, headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+            "Accept-Language": "tr-TR,tr;q=0.9,en;q=0.8",
+            "Referer": origin + "/",
+            "Origin": origin,
+            "Sec-Fetch-Dest": "image",
+            "Sec-Fetch-Mode": "no-cors",
+            "Sec-Fetch-Site": "same-origin",
+        }, timeout=15, follow_redirects=True)
+        if r.status_code == 200 and len(r.content) > 500:
+            ct = r.headers.get("content-type", "image/jpeg")
+            if "image" in ct or "octet" in ct:
+                # Upscale small images for better display quality
+                try:
+                    w, h = Image.open(io.BytesIO(r.content)).size  # Sadece header — decode yok
+                    if w < 300 or h < 300:
+                        # Upscale to at least 300px with LANCZOS (CPU pool)
+                        enhanced = await CPU_POOL.run(job_upscale, r.content, 300, 90)
+                        img_cache_put(url_hash, "image/jpeg", enhanced)
+                        return Response(content=enhanced, media_type="image/jpeg",
+                                      headers={"Cache-Control": "public, max-age=86400"})
+                except:
+                    pass
+                img_cache_put(url_hash, ct, r.content)
+                return Response(content=r.content, media_type=ct, headers={"Cache-Control": "public, max-age=86400"})
     except Exception as e:
         print(f"Proxy img err: {e}")
     return Response(content=b"", status_code=404)
@@ -2511,53 +3737,49 @@ async def url_thumbnail(request: Request):
         if not url.startswith("http"):
             url = "https://" + url
         
-        async with httpx.AsyncClient(timeout=15, follow_redirects=True) as client:
-            # Fetch the page HTML to extract og:image
-            r = await client.get(url, headers={
-                "User-Agent": "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
-                "Accept": "text/html,application/xhtml+xml",
-            })
-            
-            if r.status_code != 200:
-                return {"success": False, "message": "Sayfa yüklenemedi"}
-            
-            html = r.text[:50000]  # Limit parse size
-            
-            # Extract og:image
-            og_match = re.search(r'<meta\s+(?:property|name)=["\']og:image["\']\s+content=["\']([^"\']+)["\']', html, re.I)
-            if not og_match:
-                og_match = re.search(r'content=["\']([^"\']+)["\']\s+(?:property|name)=["\']og:image["\']', html, re.I)
-            
-            if not og_match:
-                # Try twitter:image
-                og_match = re.search(r'<meta\s+(?:property|name)=["\']twitter:image["\']\s+content=["\']([^"\']+)["\']', html, re.I)
-            
-            if not og_match:
-                return {"success": False, "message": "Görsel bulunamadı"}
-            
-            img_url = og_match.group(1)
-            if img_url.startswith("//"):
-                img_url = "https:" + img_url
-            
-            # Download the image
-            img_r = await client.get(img_url, headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-                "Accept": "image/*",
-            })
-            
-            if img_r.status_code != 200 or len(img_r.content) < 1000:
-                return {"success": False, "message": "Görsel indirilemedi"}
-            
-            # Resize if too large, convert to JPEG
-            from PIL import Image
-            img_pil = Image.open(io.BytesIO(img_r.content)).convert("RGB")
-            img_pil.thumbnail((1200, 1200))
-            buf = io.BytesIO()
-            img_pil.save(buf, format="JPEG", quality=85)
-            b64 = base64.b64encode(buf.getvalue()).decode()
-            
-            print(f"URL THUMBNAIL OK: {url[:60]} → {img_url[:60]} ({len(b64)//1024}KB)")
-            return {"success": True, "image_b64": b64}
+        client = http_client("fetch")
+        # Fetch the page HTML to extract og:image
+        r = await client.get(url, headers={
+            "User-Agent": "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+            "Accept": "text/html,application/xhtml+xml",
+        }, timeout=15, follow_redirects=True)
+        
+        if r.status_code != 200:
+            return {"success": False, "message": "Sayfa yüklenemedi"}
+        
+        html = r.text[:50000]  # Limit parse size
+        
+        # Extract og:image
+        og_match = re.search(r'<meta\s+(?:property|name)=["\']og:image["\']\s+content=["\']([^"\']+)["\']', html, re.I)
+        if not og_match:
+            og_match = re.search(r'content=["\']([^"\']+)["\']\s+(?:property|name)=["\']og:image["\']', html, re.I)
+        
+        if not og_match:
+            # Try twitter:image
+            og_match = re.search(r'<meta\s+(?:property|name)=["\']twitter:image["\']\s+content=["\']([^"\']+)["\']', html, re.I)
+        
+        if not og_match:
+            return {"success": False, "message": "Görsel bulunamadı"}
+        
+        img_url = og_match.group(1)
+        if img_url.startswith("//"):
+            img_url = "https:" + img_url
+        
+        # Download the image
+        img_r = await client.get(img_url, headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+            "Accept": "image/*",
+        }, timeout=15, follow_redirects=True)
+        
+        if img_r.status_code != 200 or len(img_r.content) < 1000:
+            return {"success": False, "message": "Görsel indirilemedi"}
+        
+        # Resize if too large, convert to JPEG (CPU pool)
+        check_decode_size(img_r.content)
+        b64 = base64.b64encode(await CPU_POOL.run(job_thumbnail, img_r.content, (1200, 1200), 85)).decode()
+        
+        print(f"URL THUMBNAIL OK: {url[:60]} → {img_url[:60]} ({len(b64)//1024}KB)")
+        return {"success": True, "image_b64": b64}
     
     except Exception as e:
         print(f"URL THUMBNAIL ERR: {e}")
@@ -2591,24 +3813,24 @@ Suggest 3 complementary pieces to complete an outfit. For each piece give:
 Return ONLY a JSON array:
 [{{"category":"bottom","description":"koyu gri kargo","search_query":"koyu gri kargo pantolon erkek","why":"..."}}]"""
 
-        async with httpx.AsyncClient(timeout=30) as client:
-            resp = await client.post("https://api.anthropic.com/v1/messages",
-                headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
-                json={"model": CLAUDE_MODEL, "max_tokens": 800, "messages": [{"role": "user", "content": prompt}]})
-            text = resp.json().get("content", [{}])[0].get("text", "").strip()
-            text = re.sub(r'^```\w*\n?', '', text)
-            text = re.sub(r'\n?```$', '', text)
-            m = re.search(r'\[.*\]', text, re.DOTALL)
-            if not m:
-                return {"success": False, "message": "AI parse error"}
-            suggestions = json.loads(m.group())
+        client = http_client("anthropic")
+        resp = await client.post(ANTHROPIC_API_URL,
+            headers={"Content-Type": "application/json", "x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01"},
+            json={"model": CLAUDE_MODEL, "max_tokens": 800, "messages": [{"role": "user", "content": prompt}]},
+            timeout=30)
+        text = resp.json().get("content", [{}])[0].get("text", "").strip()
+        text = re.sub(r'^```\w*\n?', '', text)
+        text = re.sub(r'\n?```$', '', text)
+        m = re.search(r'\[.*\]', text, re.DOTALL)
+        if not m:
+            return {"success": False, "message": "AI parse error"}
+        suggestions = json.loads(m.group())
 
         # Her öneri için shopping arama yap (parallel)
         async def search_suggestion(s):
             q = s.get("search_query", "")
             if not q: return {**s, "products": []}
-            async with API_SEM:
-                results = await asyncio.to_thread(_shop, q, cc, 3)
+            results = await _shop(q, cc, 3)
             return {**s, "products": results[:3]}
 
         combo_results = await asyncio.gather(*[search_suggestion(s) for s in suggestions[:3]])
@@ -2715,8 +3937,7 @@ async def sponsored_search(request: Request):
 
         results = []
         for dupe in dupes[:2]:
-            async with API_SEM:
-                products = await asyncio.to_thread(_shop, dupe["query"], cc, 2)
+            products = await _shop(dupe["query"], cc, 2)
             if products:
                 p = products[0]
                 p["_sponsored"] = True
@@ -2848,8 +4069,8 @@ async def fit_check(request: Request):
 
         prompt = FITCHECK_PROMPT if lang == "tr" else FITCHECK_PROMPT_EN
 
-        resp = httpx.post(
-            "https://api.anthropic.com/v1/messages",
+        resp = await http_client("anthropic").post(
+            ANTHROPIC_API_URL,
             headers={"x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01", "content-type": "application/json"},
             json={
                 "model": CLAUDE_MODEL,
@@ -2904,11 +4125,11 @@ async def hof_submit(request: Request):
         else:
             raw = image_data
         try:
-            img = Image.open(io.BytesIO(base64.b64decode(raw))).convert("RGB")
-            img.thumbnail((300, 400))
-            buf = io.BytesIO()
-            img.save(buf, format="JPEG", quality=70)
-            thumb_b64 = base64.b64encode(buf.getvalue()).decode()
+            img_bytes = base64.b64decode(raw)
+            check_decode_size(img_bytes)
+            thumb_b64 = base64.b64encode(await CPU_POOL.run(job_thumbnail, img_bytes, (300, 400), 70)).decode()
+        except ImageTooLarge as e:
+            return {"success": False, "message": str(e)}
         except:
             thumb_b64 = raw[:50000]  # Fallback: truncate
 
@@ -2972,11 +4193,11 @@ async def podyum_submit(request: Request):
         else:
             raw = image_data
         try:
-            img = Image.open(io.BytesIO(base64.b64decode(raw))).convert("RGB")
-            img.thumbnail((400, 550))
-            buf = io.BytesIO()
-            img.save(buf, format="JPEG", quality=75)
-            thumb_b64 = base64.b64encode(buf.getvalue()).decode()
+            img_bytes = base64.b64decode(raw)
+            check_decode_size(img_bytes)
+            thumb_b64 = base64.b64encode(await CPU_POOL.run(job_thumbnail, img_bytes, (400, 550), 75)).decode()
+        except ImageTooLarge as e:
+            return {"success": False, "message": str(e)}
         except:
             thumb_b64 = raw[:80000]
 
@@ -3580,8 +4801,8 @@ RESPONSE FORMAT (JSON only):
         if garment_b64:
             content.insert(1, {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": garment_b64}})
 
-        resp = httpx.post(
-            "https://api.anthropic.com/v1/messages",
+        resp = await http_client("anthropic").post(
+            ANTHROPIC_API_URL,
             headers={"x-api-key": ANTHROPIC_API_KEY, "anthropic-version": "2023-06-01", "content-type": "application/json"},
             json={
                 "model": CLAUDE_MODEL,
@@ -4590,7 +5811,7 @@ function openCamera(){
   document.getElementById('kesfScreen').style.display='none';
   document.getElementById('rScreen').style.display='none';
   if(cropper){cropper.destroy();cropper=null}
-  cF=null;cPrev=null;_detectId='';_detectedPieces=[];
+  cF=null;cPrev=null;_detectId='';_detectedPieces=[];_streamSeq++;_streamRes={};_streamWait=-1;_streamDone=true;
   document.getElementById('linkInputArea').style.display='none';
   document.getElementById('linkPasteBtn').style.borderColor='var(--border)';
   document.getElementById('linkInput').value='';
@@ -5191,7 +6412,69 @@ function loadTrendAlarm_kesf(){
 }
 var _detectId='',_detectedPieces=[],_lastSearchQuery='',_lastShownLinks=[],_ldTimer=null,_busy=false,_currentPiece=null;
 
+// Stream (opt-in, SCAN_STREAM=1): parçalar Claude döner dönmez picker'da, her parçanın ürünleri hazır oldukça _streamRes'e düşer;
+// full-image exact Lens sonradan 'update' ile gelir.
+// Varsayılan detect + seçilen parçaya search-piece (~3 SerpAPI); stream tüm parçaları baştan arar (4 parçada ~9).
+var SCAN_STREAM=__SCAN_STREAM__;
+var _streamRes={},_streamWait=-1,_streamDone=true,_streamSeq=0;
 function autoScan(){
+  if(_busy)return;
+  if(!SCAN_STREAM||!window.ReadableStream||!window.TextDecoder)return autoScanDetect();
+  document.getElementById('actionBtns').style.display='none';
+  showLoading(t('loading'),[t('step_detect'),t('step_lens'),t('step_verify'),t('step_done')]);
+  var seq=++_streamSeq,gotPieces=false;_streamRes={};_streamWait=-1;_streamDone=false;
+  var fd=new FormData();fd.append('file',cF);fd.append('country',getCC());
+  function onEvent(ev,d){
+    if(seq!==_streamSeq)return;
+    if(ev==='pieces'){
+      gotPieces=true;hideLoading();
+      if(!d.pieces||d.pieces.length===0){_streamDone=true;document.getElementById('actionBtns').style.display='flex';return showErr(t('noDetect'))}
+      _detectId=d.detect_id;_detectedPieces=d.pieces;
+      showPiecePicker(d.pieces);
+    }else if(ev==='piece'){
+      _streamRes[d.index]=d;
+      var c=document.getElementById('pc'+d.index);if(c)c.style.borderColor='var(--cyan)';
+      if(_streamWait===d.index){_streamWait=-1;hideLoading();showStreamPiece(d.index)}
+    }else if(ev==='update'){
+      // Full-image exact Lens geldi: parçanın sıralaması güncel — o parça ekrandaysa yeniden çiz
+      var cur=_streamRes[d.index];if(!cur)return;
+      var shown=_currentPiece===cur.piece&&document.getElementById('piecePicker').style.display==='none';
+      cur.piece=d.piece;
+      if(shown)showStreamPiece(d.index);
+    }else if(ev==='error'){
+      if(!gotPieces){_streamDone=true;hideLoading();showErr(d.message||'Error')}
+    }else if(ev==='done'){streamEnd()}
+  }
+  function streamEnd(){
+    if(seq!==_streamSeq||_streamDone)return;
+    _streamDone=true;
+    // Beklenen parça stream'de gelmediyse klasik search-piece'e düş
+    if(_streamWait>-1){var i=_streamWait;_streamWait=-1;hideLoading();searchPiece(i)}
+  }
+  fetch('/api/full-analyze/stream',{method:'POST',body:fd}).then(function(r){
+    if(!r.ok||!r.body)throw new Error('stream '+r.status);
+    var rd=r.body.getReader(),dec=new TextDecoder(),buf='';
+    function pump(){return rd.read().then(function(x){
+      if(x.done){streamEnd();return}
+      buf+=dec.decode(x.value,{stream:true});
+      var blocks=buf.split('\n\n');buf=blocks.pop();
+      blocks.forEach(function(b){var ev='message',data='';b.split('\n').forEach(function(ln){if(ln.indexOf('event:')===0)ev=ln.slice(6).trim();else if(ln.indexOf('data:')===0)data+=ln.slice(5).trim()});if(data)onEvent(ev,JSON.parse(data))});
+      return pump()})}
+    return pump();
+  }).catch(function(e){
+    if(seq!==_streamSeq)return;
+    if(!gotPieces){_streamDone=true;hideLoading();autoScanDetect()}else{streamEnd()}
+  })
+}
+
+function showStreamPiece(idx){
+  var d=_streamRes[idx];
+  _lastSearchQuery=d._search_query||'';
+  _lastShownLinks=(d.piece&&d.piece.products||[]).map(function(p){return p.link});
+  renderPieceResult(d.piece);
+}
+
+function autoScanDetect(){
   if(_busy)return;
   document.getElementById('actionBtns').style.display='none';
   showLoading(t('loading'),[t('step_detect'),t('step_lens'),t('step_verify'),t('step_done')]);
@@ -5214,7 +6497,7 @@ function showPiecePicker(pieces){
   h+='<div class="piece-grid">';
   for(var i=0;i<pieces.length;i++){
     var p=pieces[i];var icon=IC[p.category]||'\uD83D\uDC55';
-    h+='<div class="glass piece-card" onclick="searchPiece('+i+')" style="animation-delay:'+(i*.08)+'s">';
+    h+='<div class="glass piece-card" id="pc'+i+'" onclick="searchPiece('+i+')" style="animation-delay:'+(i*.08)+'s'+(_streamRes[i]?';border-color:var(--cyan)':'')+'">';
     if(p.crop_image){h+='<img src="'+p.crop_image+'">'}else{h+='<div class="pc-noimg">'+icon+'</div>'}
     h+='<div class="pc-info"><div class="pc-cat">'+icon+' '+(p.short_title||p.category)+'</div>';
     if(p.brand)h+='<div class="pc-brand">'+p.brand+'</div>';
@@ -5227,8 +6510,10 @@ function showPiecePicker(pieces){
 
 function searchPiece(idx){
   if(_busy)return;
+  if(_streamRes[idx]){document.getElementById('piecePicker').style.display='none';return showStreamPiece(idx)}
   document.getElementById('piecePicker').style.display='none';
   showLoading(t('searchingPiece'),[t('step_lens'),t('step_verify'),t('step_done')]);
+  if(!_streamDone){_streamWait=idx;return}  // Stream'den gelecek
   var fd=new FormData();fd.append('detect_id',_detectId);fd.append('piece_index',idx);fd.append('country',getCC());
   fetch('/api/search-piece',{method:'POST',body:fd}).then(function(r){return r.json()}).then(function(d){
     hideLoading();
@@ -6591,6 +7876,7 @@ function loadMoreResults(){
 </script>
 </body>
 </html>"""
+HTML_PAGE = HTML_PAGE.replace("__SCAN_STREAM__", "true" if SCAN_STREAM else "false")
 
 if __name__ == "__main__":
     import uvicorn
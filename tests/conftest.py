@@ -0,0 +1,7 @@
+import os
+import sys
+
+# server.py import edilirken CPU/rembg havuzu kurulmasın — job'lar test process'inde (to_thread) çalışır
+os.environ.setdefault("CPU_WORKERS", "0")
+os.environ.setdefault("REMBG_WORKERS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
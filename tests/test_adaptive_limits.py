@@ -0,0 +1,73 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+
+
+class SlowUpstream(httpx.AsyncBaseTransport):
+    """`delay` sn sonra 200 döner, eşzamanlı istek tepe değerini sayar."""
+
+    def __init__(self, delay=0.05):
+        self.delay, self.inflight, self.peak, self.calls = delay, 0, 0, 0
+
+    async def handle_async_request(self, request):
+        self.calls += 1
+        self.inflight += 1
+        self.peak = max(self.peak, self.inflight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.inflight -= 1
+        return httpx.Response(200, json={})
+
+
+def _client(upstream, lim, timeout=30):
+    return httpx.AsyncClient(transport=server.LimitedTransport(upstream, lambda req: lim), timeout=timeout)
+
+
+def test_overlapping_requests_respect_limit():
+    lim = server.AIMDLimiter("t", 3, 3)
+    upstream = SlowUpstream()
+
+    async def go():
+        async with _client(upstream, lim) as c:
+            return await asyncio.gather(*(c.get("http://u/") for _ in range(9)))
+
+    rs = asyncio.run(go())
+    assert all(r.status_code == 200 for r in rs)
+    assert upstream.calls == 9
+    assert upstream.peak == 3  # Limit kadar paralel, fazlası sırada bekler
+    assert lim.inflight == 0 and not lim._waiters
+    assert lim.stats["max_queue"] >= 9 - 3
+
+
+def test_queue_wait_is_bounded_by_pool_timeout():
+    lim = server.AIMDLimiter("t", 1, 1)
+    upstream = SlowUpstream(delay=0.3)
+
+    async def go():
+        async with _client(upstream, lim, timeout=httpx.Timeout(5, pool=0.05)) as c:
+            first = asyncio.ensure_future(c.get("http://u/"))
+            await asyncio.sleep(0.01)
+            with pytest.raises(httpx.PoolTimeout):
+                await c.get("http://u/")
+            assert lim.inflight == 1 and not lim._waiters  # Zaman aşımına uğrayan bekleyici kuyrukta kalmaz
+            return await first
+
+    assert asyncio.run(go()).status_code == 200
+    assert upstream.calls == 1
+    assert lim.inflight == 0 and lim.stats["overloads"] == 0  # Slot beklemesi upstream yükü sayılmaz
+
+
+def test_no_pool_timeout_waits_for_a_slot():
+    lim = server.AIMDLimiter("t", 1, 1)
+    upstream = SlowUpstream(delay=0.1)
+
+    async def go():
+        async with _client(upstream, lim, timeout=httpx.Timeout(5, pool=None)) as c:
+            return await asyncio.gather(c.get("http://u/"), c.get("http://u/"))
+
+    assert [r.status_code for r in asyncio.run(go())] == [200, 200]
+    assert upstream.peak == 1 and lim.inflight == 0
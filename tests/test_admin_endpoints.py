@@ -0,0 +1,26 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+ADMIN_PATHS = ["/api/cache-stats", "/api/admin/limits"]
+
+
+@pytest.fixture
+def client():
+    return TestClient(server.app)
+
+
+@pytest.mark.parametrize("path", ADMIN_PATHS)
+def test_closed_without_configured_token(client, monkeypatch, path):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "")
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={"x-admin-token": ""}).status_code == 403
+
+
+@pytest.mark.parametrize("path", ADMIN_PATHS)
+def test_requires_matching_token(client, monkeypatch, path):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "s3cret")
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={"x-admin-token": "wrong"}).status_code == 403
+    assert client.get(path, headers={"x-admin-token": "s3cret"}).status_code == 200
@@ -0,0 +1,64 @@
+import asyncio
+import io
+import pickle
+
+import pytest
+from PIL import Image
+
+import server
+
+
+def encode(size, fmt):
+    b = io.BytesIO()
+    Image.new("RGB", size, (120, 60, 30)).save(b, fmt)
+    return b.getvalue()
+
+
+@pytest.fixture
+def no_pool(monkeypatch):
+    calls = []
+
+    async def run(fn, *args):
+        calls.append(fn)
+        return fn(*args)
+
+    monkeypatch.setattr(server.CPU_POOL, "run", run)
+    return calls
+
+
+def test_oversize_bytes_rejected_before_pool(monkeypatch, no_pool):
+    monkeypatch.setattr(server, "MAX_UPLOAD_BYTES", 1000)
+    with pytest.raises(server.ImageTooLarge):
+        asyncio.run(server.decode_upload(encode((400, 400), "PNG") + b"\0" * 1000))
+    assert no_pool == []
+
+
+def test_pixel_limit_read_from_header_for_full_decode_formats(monkeypatch, no_pool):
+    monkeypatch.setattr(server, "MAX_DECODE_PIXELS", 300 * 300)
+    with pytest.raises(server.ImageTooLarge, match="400x400"):
+        asyncio.run(server.decode_upload(encode((400, 400), "PNG")))
+    assert no_pool == []
+    # JPEG draft() ile küçültülerek çözülür → bu sınır uygulanmaz
+    optimized, b64, ph = asyncio.run(server.decode_upload(encode((400, 400), "JPEG")))
+    assert no_pool == [server.job_decode_upload] and optimized and b64
+
+
+def test_decompression_bomb_header_rejected(monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100 * 100)
+    with pytest.raises(server.ImageTooLarge):
+        server.check_decode_size(encode((300, 300), "JPEG"))
+
+
+def test_unreadable_header_left_to_decode_job():
+    server.check_decode_size(b"not an image")
+
+
+def test_pool_jobs_exchange_encoded_bytes_only():
+    upload = encode((2000, 1500), "JPEG")
+    out = server.job_decode_upload(upload, 1400)
+    jpeg, size, (dh, dct) = out
+    assert size == (1400, 1050) and isinstance(dh, int) and isinstance(dct, int)
+    assert len(pickle.dumps(out)) < len(jpeg) + 1024  # Ham piksel taşınmaz
+    crops = server.job_crop_pieces(jpeg, [[100, 100, 900, 900]], ((128, 75),))
+    (crop, thumbs), = crops
+    assert crop[:2] == b"\xff\xd8" and thumbs[128].startswith("data:image/jpeg;base64,")
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+import server
+
+HEALTH_BOUND = 0.25  # sn — fit-check'ler beklerken ucuz endpoint'in tavanı
+
+
+class StubAnthropic(httpx.AsyncBaseTransport):
+    """Claude yerine: `release` set edilene kadar yanıt vermez, skoru görsel verisinden türetir."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.inflight, self.calls = 0, 0
+
+    async def handle_async_request(self, request):
+        self.calls += 1
+        self.inflight += 1
+        try:
+            await self.release.wait()
+        finally:
+            self.inflight -= 1
+        image = json.loads(request.content)["messages"][0]["content"][0]["source"]["data"]
+        if image == "bad":
+            text = '{"rejected": true, "reason": "no outfit"}'
+        else:
+            text = "```json\n" + json.dumps({"rejected": False, "score": int(image), "emoji": "🔥",
+                                              "roast": f"fit {image}", "tips": []}) + "\n```"
+        return httpx.Response(200, json={"content": [{"type": "text", "text": text}]})
+
+
+async def _fire(monkeypatch, bodies, limit, held):
+    """Gövdeleri aynı anda /api/fit-check'e gönder; `held` Claude çağrısı askıdayken /api/health'i ölç, sonra bırak.
+    Stub prod'daki LimitedTransport'un arkasında (limiter sabit `limit`'te)."""
+    stub = StubAnthropic()
+    client = httpx.AsyncClient(transport=server.LimitedTransport(stub, server.HTTP_CLIENT_OPTS["anthropic"]["limiter"]))
+    monkeypatch.setitem(server.LIMITERS, "anthropic", server.AIMDLimiter("anthropic", limit, limit))
+    monkeypatch.setitem(server._HTTP_CLIENTS, "anthropic", client)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://t") as c:
+            fits = asyncio.gather(*(c.post("/api/fit-check", json=b) for b in bodies))
+            for _ in range(200):
+                if stub.inflight == held: break
+                await asyncio.sleep(0.01)
+            assert stub.inflight == held
+            health = []
+            for _ in range(5):
+                t = time.perf_counter()
+                r = await c.get("/api/health")
+                health.append(time.perf_counter() - t)
+                assert r.status_code == 200 and r.json()["status"] == "ok"
+            assert stub.inflight == held  # Ölçüm boyunca fit-check'ler hâlâ askıda
+            stub.release.set()
+            rs = await fits
+    finally:
+        stub.release.set()
+        await client.aclose()
+    return [r.json() for r in rs], stub, max(health)
+
+
+def test_health_stays_fast_while_fit_checks_are_pending(monkeypatch):
+    images = [str(60 + i) for i in range(8)] + ["bad"]
+    bodies = [{"image": "data:image/jpeg;base64," + im} for im in images]
+    results, stub, worst = asyncio.run(_fire(monkeypatch, bodies, limit=3, held=3))
+
+    assert worst < HEALTH_BOUND, f"/api/health {worst:.3f}s while fit-checks pending"
+    assert stub.calls == len(images)
+    for im, res in zip(images[:-1], results):
+        assert res["success"] is True and res["rejected"] is False
+        assert (res["score"], res["roast"]) == (int(im), f"fit {im}")
+    assert results[-1] == {"success": True, "rejected": True, "reason": "no outfit"}
+
+
+def test_missing_image_skips_claude(monkeypatch):
+    bodies = [{"image": ""}, {"lang": "en"}, {"image": "70", "lang": "en"}]
+    results, stub, worst = asyncio.run(_fire(monkeypatch, bodies, limit=1, held=1))
+    assert worst < HEALTH_BOUND
+    assert stub.calls == 1
+    assert results[0] == results[1] == {"success": False, "message": "No image"}
+    assert results[2]["score"] == 70
@@ -0,0 +1,93 @@
+import os
+import random
+import timeit
+import unicodedata
+
+import pytest
+
+import server
+
+
+def old_has_foreign_script(text, threshold=0.3):
+    """Codepoint tablosu öncesi implementasyon: her harf için unicodedata.name."""
+    if not text: return False
+    non_latin = 0
+    total = 0
+    for ch in text:
+        if ch.isalpha():
+            total += 1
+            name = unicodedata.name(ch, "")
+            if "LATIN" not in name and "TURKISH" not in name:
+                non_latin += 1
+    if total < 3: return False
+    return (non_latin / total) > threshold
+
+
+MIXED_TITLES = [
+    ("Siyah Deri Ceket Bershka", False),
+    ("Çok şık gömlek – Ğ Ü Ş İ Ö Ç ı", False),
+    ("Кожаная куртка черная", True),
+    ("Куртка Zara black leather jacket men", False),
+    ("Zara куртка кожаная", True),
+    ("حقيبة يد جلد سوداء", True),
+    ("Nike Air Max 90 — نایک", False),
+    ("کیف چرم زنانه Mango", True),
+    ("黑色皮夹克 Leather Jacket", False),
+    ("黑色皮夹克 Zara", True),
+    ("Ζάρα δερμάτινο jacket", True),
+    ("Crème brûlée façade naïve ﬁt", False),
+    ("Ǆ ǅ ǆ ȸ ɐ ʯ ᴀ ᵫ ꜰ ꭒ", False),
+    ("Jean 2024 %50 indirim!!! ✨👖", False),
+    ("ab", False),
+    ("жк", False),
+    ("жкт", True),
+    ("x ж", False),
+    ("", False),
+]
+
+
+@pytest.mark.parametrize("title,expected", MIXED_TITLES)
+def test_mixed_script_titles(title, expected):
+    assert server.has_foreign_script(title) is expected
+    assert old_has_foreign_script(title) is expected
+
+
+@pytest.mark.parametrize("threshold", [0.0, 0.3, 0.5, 0.99])
+def test_matches_old_check_on_random_mixed_titles(threshold):
+    rnd = random.Random(22)
+    pools = ["abcçdefgğhıijklmnoöprsştuüvyz ABCÇĞİÖŞÜ", "абвгдежзийклмнопрстуфхцчшщыэюя", "ابتثجحخدذرزسشصضطظعغفقكلمنهوي",
+             "αβγδεζηθικλμνξοπρστυφχψω", "黑色皮夹克女款", "0123456789 -_/%!✨👖", "ǅɐʯᴀᵫꜰꭒﬁÅéñøß"]
+    for _ in range(3000):
+        title = "".join(rnd.choice(rnd.choice(pools)) for _ in range(rnd.randint(0, 24)))
+        assert server.has_foreign_script(title, threshold) == old_has_foreign_script(title, threshold), title
+
+
+def test_every_alphabetic_codepoint_classified_as_before():
+    # Tek harf × 3 → oran ya 0 ya 1; her harf için Latin/Latin-dışı kararı eski unicodedata.name kontrolüyle aynı
+    for cp in range(0x30000):
+        ch = chr(cp)
+        if ch.isalpha():
+            assert server.has_foreign_script(ch * 3) == old_has_foreign_script(ch * 3), hex(cp)
+
+
+BENCH_TITLES = [t for t, _ in MIXED_TITLES] + [
+    "Bershka Kadın Siyah Suni Deri Biker Ceket",
+    "Mavi Jeans Erkek Slim Fit Koyu İndigo Jean Pantolon",
+    "Nike Air Force 1 '07 Beyaz Sneaker Ayakkabı",
+    "Zara Oversize Yün Karışımlı Kaban – Camel",
+    "Massimo Dutti Hakiki Deri Omuz Çantası Taba",
+    "Кожаная куртка мужская черная Zara",
+    "Pull&Bear Kapüşonlu Sweatshirt %100 Pamuk",
+    "حقيبة كتف نسائية من الجلد الأسود",
+]
+
+
+@pytest.mark.skipif(os.environ.get("BENCH") != "1", reason="benchmark — BENCH=1 ile çalıştır (CI'da bloklamaz)")
+def test_benchmark_against_old_check():
+    def run(fn):
+        return min(timeit.repeat(lambda: [fn(t) for t in BENCH_TITLES], number=200, repeat=5))
+
+    old, new = run(old_has_foreign_script), run(server.has_foreign_script)
+    per = 200 * len(BENCH_TITLES) / 1e6
+    print(f"\nhas_foreign_script: old {old / per:.2f}µs  new {new / per:.2f}µs  ({old / new:.1f}x)")
+    assert new < old
@@ -0,0 +1,106 @@
+import pytest
+
+import server
+
+PRODUCT_URLS = [
+    "https://www.trendyol.com/bershka/siyah-deri-ceket-p-123456789",
+    "https://m.trendyol.com/koton/jean-p-987654",
+    "https://www.hepsiburada.com/mavi-jean-pm-HBC00001ABCD",
+    "https://www.hepsiburada.com/nike-ayakkabi-p-HBV0000XYZ",
+    "https://www.amazon.com.tr/dp/B0ABC12345",
+    "https://www.amazon.de/gp/product/B01XYZ",
+    "https://www.n11.com/urun/deri-ceket-1234",
+    "https://www.boyner.com.tr/urun/mavi-jean-5678",
+    "https://www.beymen.com/p/ceket-1234",
+    "https://www.defacto.com.tr/erkek-ceket-12345",
+    "https://www.lcwaikiki.com/tr-tr/TR/urun/jean/4567",
+    "https://www.zara.com/tr/tr/deri-ceket/p01234567.html",
+    "https://www.bershka.com/tr/deri-ceket/12345678.html",
+    "https://www.pullandbear.com/tr/jean/12345678",
+    "https://www.stradivarius.com/tr/ceket/98765432.html",
+    "https://www2.hm.com/tr_tr/productpage.0123456789.html",
+    "https://www.nike.com/tr/t/air-max-90-ayakkabi-abc123",
+    "https://www.adidas.com.tr/tr/product/superstar",
+    "https://shop.mango.com/tr/ceket/12345678",
+    "https://www.koton.com/product/deri-ceket-123",
+    "https://www.flo.com.tr/urun/nike-ayakkabi-1234",
+    "https://www.occasion.com.tr/urun/ceket-1",
+    # Bilinmeyen mağaza, arama kalıbı yok → ürün kabul edilir
+    "https://www.vakko.com/erkek-ceket-12345",
+    # Kategori gibi görünen yol ama ürün kimliği var
+    "https://www.trendyol.com/erkek/deri-ceket-p-555",
+    "https://www.example-shop.com/shop/product/123",
+]
+
+NON_PRODUCT_URLS = [
+    "",
+    "https://www.trendyol.com/sr?q=deri+ceket",
+    "https://www.trendyol.com/erkek-deri-ceket-x-g2-c118",
+    "https://www.hepsiburada.com/ara?q=ceket",
+    "https://www.amazon.com.tr/s?k=ceket",
+    "https://www.n11.com/arama?q=ceket",
+    "https://www.boyner.com.tr/kadin-ceket-c-1001",
+    "https://www.zara.com/tr/tr/kadin-ceketler-l1114.html",
+    "https://www.bershka.com/tr/kadin/ceketler.html",
+    "https://www.zara.com/tr/tr/deri-ceket-p01234567.html",
+    "https://www2.hm.com/tr_tr/kadin/urune-gore-satin-al/ceketler.html",
+    "https://www.nike.com/tr/w/erkek-ayakkabi-nik1zy7ok",
+    "https://shop.mango.com/tr/kadin/ceketler",
+    "https://www.koton.com/kadin-ceket",
+    "https://www.vakko.com/search?q=ceket",
+    "https://www.example-shop.com/collections/jackets",
+    "https://www.example-shop.com/kategori/ceket",
+    "https://www.example-shop.com/women/jackets",
+]
+
+
+@pytest.mark.parametrize("url", PRODUCT_URLS)
+def test_product_urls(url):
+    assert server.is_product_url(url) is True
+
+
+@pytest.mark.parametrize("url", NON_PRODUCT_URLS)
+def test_non_product_urls(url):
+    assert server.is_product_url(url) is False
+
+
+def test_case_and_port_insensitive_host():
+    assert server.is_product_url("HTTPS://WWW.ZARA.COM/TR/P01234567")
+    assert server.is_product_url("https://www.trendyol.com:443/a-p-2")
+    assert server.is_product_url("trendyol.com/x-p-1")
+
+
+def test_store_rule_follows_host_only():
+    # Mağaza domain'i sadece host'ta aranır: query / redirect parametresinde geçmesi o mağazanın kuralını uygulatmaz
+    # (eskiden ikisi de False dönüyordu: URL içinde "trendyol.com" / "zara.com" geçtiği için o kural uygulanıyordu)
+    assert server.is_product_url("https://www.vakko.com/urun/x?ref=trendyol.com")
+    assert server.is_product_url("https://click.example.com/r?u=https://www.zara.com/tr/ceket-p01234567.html")
+    # Host'taki mağazanın kuralı geçerli (boyner.com → boyner.com.tr, amazon. → her TLD)
+    assert not server.is_product_url("https://www.boyner.com.tr/x/deri-ceket-p-12345")
+    assert not server.is_product_url("https://www.amazon.co.uk/deri-ceket-12345")
+
+
+@pytest.mark.parametrize("host,store", [
+    ("www.zara.com", "zara.com"), ("zara.com", "zara.com"), ("www2.hm.com", "hm.com"), ("shop.mango.com", "mango.com"),
+    ("www.boyner.com.tr", "boyner.com"), ("www.occasion.com.tr", "occasion.com.tr"), ("zara.com.", "zara.com"),
+    ("www.amazon.com.tr", "amazon."), ("smile.amazon.co.uk", "amazon."), ("www.adidas.com.tr", "adidas."),
+    # Benzer görünen host'lar mağaza kuralını almaz
+    ("shm.com", None), ("xnike.com.tr", None), ("nike.com.evil.io", None), ("xamazon.de", None),
+    ("amazon.evil.com", None), ("adidas-outlet.com", None), ("myzara.com", None), ("zara.community", None),
+])
+def test_product_url_rule_matches_whole_labels(host, store):
+    rule = server.product_url_rule(host)
+    assert rule is (server._PRODUCT_URL_RES[store] if store else None)
+
+
+def test_lookalike_hosts_are_unknown_stores():
+    # Bilinmeyen domain → arama kalıbı yoksa ürün; hm.com'un /productpage kuralı shm.com'a uygulanmaz
+    assert server.is_product_url("https://shm.com/siyah-ceket-123")
+    assert server.is_product_url("https://xnike.com.tr/ayakkabi-1")
+
+
+def test_memoized():
+    server.is_product_url.cache_clear()
+    server.is_product_url("https://www.trendyol.com/x-p-1")
+    server.is_product_url("https://www.trendyol.com/x-p-1")
+    assert server.is_product_url.cache_info().hits == 1
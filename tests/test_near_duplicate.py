@@ -0,0 +1,69 @@
+import io
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+import server
+
+
+def photo(seed, size=(600, 800)):
+    rnd = random.Random(seed)
+    im = Image.new("RGB", size, tuple(rnd.randrange(256) for _ in range(3)))
+    d = ImageDraw.Draw(im)
+    for _ in range(25):
+        x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+        d.ellipse((x, y, x + rnd.randrange(40, 300), y + rnd.randrange(40, 300)), fill=tuple(rnd.randrange(256) for _ in range(3)))
+    return im
+
+
+def jpeg(im, q=90):
+    b = io.BytesIO()
+    im.save(b, "JPEG", quality=q)
+    return b.getvalue()
+
+
+def hashes(im):
+    return server.dhash(im), server.phash_dct(im)
+
+
+@pytest.fixture(autouse=True)
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(server, "PHASH_INDEX", {})
+
+
+def test_recompressed_copy_reuses_pieces_but_keeps_own_digest():
+    im = photo(1)
+    orig = jpeg(im)
+    dup_im = im.resize((480, 640))
+    dup = jpeg(dup_im, 60)
+    d0, det0 = server.resolve_image_digest(hashes(im), orig)
+    d1, det1 = server.resolve_image_digest(hashes(Image.open(io.BytesIO(dup))), dup)
+    assert det0 == d0 == server.img_digest(orig)
+    assert d1 == server.img_digest(dup) != d0  # Lens / crop cache'leri kendi byte'ları
+    assert det1 == d0  # Claude parça listesi paylaşılır
+
+
+@pytest.mark.parametrize("variant", [
+    lambda im: im.crop((0, 0, im.width, int(im.height * 0.85))),  # Kırpılmış: Claude kutuları tutmaz
+    lambda im: im.transpose(Image.FLIP_LEFT_RIGHT),
+    lambda im: photo(2),
+])
+def test_different_framing_or_photo_is_not_a_duplicate(variant):
+    im = photo(1)
+    orig = jpeg(im)
+    server.resolve_image_digest(hashes(im), orig)
+    other = variant(im)
+    data = jpeg(other)
+    digest, detect_digest = server.resolve_image_digest(hashes(other), data)
+    assert digest == detect_digest == server.img_digest(data)
+
+
+def test_both_hashes_must_agree():
+    im = photo(3)
+    dh, dct = hashes(im)
+    server.resolve_image_digest((dh, dct), b"a")
+    _, det = server.resolve_image_digest((dh ^ 0b11, dct ^ 0xFFFF), b"b")  # dHash yakın, DCT 16 bit farklı
+    assert det == server.img_digest(b"b")
+    _, det = server.resolve_image_digest((dh ^ 1, dct ^ 1), b"c")
+    assert det == server.img_digest(b"a")
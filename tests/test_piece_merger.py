@@ -0,0 +1,77 @@
+import itertools
+
+import server
+
+PIECES = [
+    {"category": "jacket", "brand": "Bershka", "color": "siyah", "style_type": "deri ceket", "visible_text": ""},
+    {"category": "bottom", "brand": "?", "color": "mavi", "style_type": "jean pantolon", "visible_text": ""},
+]
+TASK_MAP = [("full_lens_exact", -1, None), ("piece_lens", 0, None), ("shop", 0, "specific"), ("shop", 1, "specific")]
+
+
+def r(title, link, **kw):
+    return {"title": title, "link": link, "source": kw.pop("source", "Trendyol"), "price": "999 TL", "is_local": True, **kw}
+
+
+RESULTS = [
+    [r("Bershka siyah deri ceket", "https://www.bershka.com/tr/ceket/12345678.html", source="Bershka", _exact=True),
+     r("Mavi slim jean pantolon", "https://www.trendyol.com/mavi/jean-p-1", _exact=True)],
+    [r("Siyah deri ceket", "https://www.trendyol.com/a/ceket-p-2"),
+     r("Bershka siyah deri ceket", "https://www.bershka.com/tr/ceket/12345678.html", source="Bershka")],
+    [r("Siyah deri ceket erkek", "https://www.trendyol.com/a/ceket-p-2"),
+     r("Siyah deri ceket biker", "https://www.trendyol.com/a/ceket-p-3"),
+     r("Siyah kupa bardak", "https://www.trendyol.com/a/bardak-p-4")],
+    [r("Mavi jean pantolon", "https://www.trendyol.com/b/jean-p-5")],
+]
+
+
+def run(order):
+    m = server.PieceMerger([dict(p) for p in PIECES], TASK_MAP)
+    for k in order:
+        m.add(k, [dict(x) for x in RESULTS[k]])
+    return m
+
+
+def links(piece):
+    return [x["link"] for x in piece["products"]]
+
+
+def test_arrival_order_does_not_change_result():
+    outs = [[run(o).final(i, "tr") for i in range(2)] for o in itertools.permutations(range(len(TASK_MAP)))]
+    assert all(o == outs[0] for o in outs)
+    jacket, bottom = outs[0]
+    assert links(jacket) == ["https://www.bershka.com/tr/ceket/12345678.html", "https://www.trendyol.com/a/ceket-p-2",
+                             "https://www.trendyol.com/a/ceket-p-3"]
+    assert links(bottom) == ["https://www.trendyol.com/mavi/jean-p-1", "https://www.trendyol.com/b/jean-p-5"]
+    assert jacket["match_level"] == bottom["match_level"] == "exact"
+
+
+def test_results_are_scored_on_arrival_and_deduplicated_by_task_rank():
+    m = run([2, 1])  # Shopping önce gelir, sonra aynı link'i taşıyan parça Lens'i
+    e = m.entries[0]["https://www.trendyol.com/a/ceket-p-2"]
+    assert (e.channel, e.rank, e.ok) == ("lens", (1, 0), True) and "_score" in e.item
+    assert not m.entries[0]["https://www.trendyol.com/a/bardak-p-4"].ok  # Kategori dışı: varışta elendi
+    assert m.ready(0) and not m.ready(1)  # Full exact (task 0) beklenmez, parça 1'in Shopping'i yok
+
+
+def test_late_full_exact_reports_the_pieces_it_changes():
+    m = run([1, 2, 3])
+    assert m.ready(0) and m.ready(1)
+    assert links(m.final(1, "tr", event=None)) == ["https://www.trendyol.com/b/jean-p-5"]
+    assert m.add(0, [dict(x) for x in RESULTS[0]]) == {0, 1}
+    assert links(m.final(1, "tr", event=None)) == ["https://www.trendyol.com/mavi/jean-p-1", "https://www.trendyol.com/b/jean-p-5"]
+    assert m.add(3, [dict(x) for x in RESULTS[3]]) == set()  # Aynı link daha düşük rank'la zaten var
+
+
+def test_final_can_be_called_repeatedly():
+    m = run(range(len(TASK_MAP)))
+    assert m.final(0, "tr") == m.final(0, "tr")
+
+
+def test_piece_exact_keeps_only_the_focused_piece():
+    tm = [("piece_exact", 1, None), ("shop", 1, "specific")]
+    m = server.PieceMerger([dict(p) for p in PIECES], tm)
+    m.add(0, [r("Deri ceket", "https://www.trendyol.com/a/ceket-p-9"), r("Mavi jean", "https://www.trendyol.com/b/jean-p-8")])
+    m.add(1, RESULTS[3])
+    assert sorted(links(m.final(1, "tr"))) == ["https://www.trendyol.com/b/jean-p-5", "https://www.trendyol.com/b/jean-p-8"]
+    assert m.entries[0] == {}
@@ -0,0 +1,48 @@
+import server
+
+
+def r(title, source=""):
+    return {"title": title, "source": source}
+
+
+def sources(results):
+    return [x["source"] for x in results]
+
+
+def test_rivals_are_removed():
+    res = [r("Bershka siyah ceket", "Bershka"), r("Zara siyah ceket", "Zara"), r("Siyah deri ceket", "Trendyol")]
+    assert sources(server.filter_rival_brands(res, "Bershka")) == ["Bershka", "Trendyol"]
+
+
+def test_marketplace_source_is_not_a_rival():
+    res = [r("Deri ceket", "Trendyol"), r("Deri ceket", "Hepsiburada"), r("Deri ceket", "Boyner")]
+    assert server.filter_rival_brands(res, "Mavi") == res
+
+
+def test_extended_rivals_from_brand_map():
+    res = [r("LC Waikiki slim jean", "LC Waikiki"), r("Mavi slim jean", "Mavi")]
+    assert sources(server.filter_rival_brands(res, "Mavi")) == ["Mavi"]
+
+
+def test_all_rivals_keeps_best_non_target_subset():
+    # Hepsi genişletilmiş listede rakip → çekirdek RIVAL_BRANDS ile filtrele (eski davranış), hepsini döndürme
+    res = [r("LC Waikiki slim jean", "LC Waikiki"), r("H&M slim jean", "www2.hm.com"),
+           r("Nike jogger", "Nike"), r("Zara jean", "Zara")]
+    assert sources(server.filter_rival_brands(res, "Mavi")) == ["LC Waikiki"]
+
+
+def test_all_core_rivals_falls_back_to_everything():
+    res = [r("Nike jogger", "Nike"), r("Zara jean", "Zara")]
+    assert server.filter_rival_brands(res, "Mavi") == res
+
+
+def test_unknown_or_short_brand_is_a_no_op():
+    res = [r("Nike jogger", "Nike")]
+    for brand in ("", "?", "ab"):
+        assert server.filter_rival_brands(res, brand) == res
+
+
+def test_word_boundaries():
+    # "hm" rakip ama "hmm" / "zaraa" kelime içinde geçmiyor
+    res = [r("hmm ceket"), r("zaraa ceket"), r("pull&bear ceket")]
+    assert [x["title"] for x in server.filter_rival_brands(res, "Mavi")] == ["hmm ceket", "zaraa ceket"]
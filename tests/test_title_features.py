@@ -0,0 +1,89 @@
+import pytest
+
+import server
+
+# Sabit başlık korpusu → (kategori filtresinden geçen kategoriler, çelişen parça renkleri).
+# Beklenen değerler title_features öncesi döngüsel implementasyondan alındı; substring eşleşmesinin
+# tuhaflıkları da (ör. "sweatshirt" ⊃ "shirt", "erkek" ⊃ kategori kelimesi) bilinçli olarak sabitleniyor.
+CATS = ["top", "jacket", "bottom", "shoes", "bag", "watch", "hat", "accessory", "dress"]
+COLORS = ["beyaz", "white", "siyah", "black", "bej", "krem", "lacivert", "?", ""]
+CORPUS = {
+    "Bershka Siyah Deri Ceket": (["jacket"], ["beyaz", "white", "bej", "krem"]),
+    "Erkek Beyaz Oxford Gömlek Slim Fit": (["top", "bottom", "shoes"], ["siyah", "black"]),
+    "Kadın Bej Trençkot": (["top", "jacket", "bottom", "shoes", "dress"], ["siyah"]),
+    "Mavi Jean Pantolon Regular Fit": (["bottom"], []),
+    "Nike Air Max 90 Beyaz Sneaker Ayakkabı": (["shoes"], ["siyah", "black"]),
+    "Siyah Deri Omuz Çantası": (["bag"], ["beyaz", "white", "bej", "krem"]),
+    "Lacivert Örgü Kazak Oversize": (["top"], ["beyaz", "bej", "krem"]),
+    "Gri Kapüşonlu Sweatshirt Hoodie": (["top"], ["beyaz", "white", "bej", "krem"]),
+    "Krem Triko Hırka": (["top", "jacket"], ["siyah", "lacivert"]),
+    "Black Leather Biker Jacket": (["jacket"], ["beyaz", "white", "bej", "krem"]),
+    "White Cotton T-Shirt Crew Neck": (["top"], ["siyah", "black"]),
+    "Navy Wool Blazer": (["jacket"], ["beyaz", "white", "bej", "krem"]),
+    "Kahverengi Süet Bot": (["shoes"], ["beyaz"]),
+    "Altın Kaplama Kol Saati": (["watch"], []),
+    "Yeni Sezon Kadın Giyim Koleksiyonu": (["top", "jacket", "bottom", "shoes", "dress"], []),
+    "Unisex Outfit Modelleri": (["top", "jacket", "bottom", "shoes", "dress"], []),
+    "Pembe Mini Etek": (["bottom"], ["siyah", "lacivert"]),
+    "Bordo Polo Yaka Tişört": (["top"], ["beyaz"]),
+    "Hasır Şapka Bej": (["hat"], ["siyah"]),
+    "Kemer Deri Siyah": (["accessory"], ["beyaz", "white", "bej", "krem"]),
+    "": (CATS, []),
+    "GÖMLEK": (["top"], []),
+}
+
+# (parça stili, kategori) → alt-tip çelişkisi veren korpus başlıkları; listede olmayan çiftler çelişki vermez
+SUBTYPE_CONFLICTS = {
+    ("oxford gömlek", "top"): ["Lacivert Örgü Kazak Oversize", "Krem Triko Hırka", "Bordo Polo Yaka Tişört"],
+    ("oxford gömlek", "shoes"): ["Nike Air Max 90 Beyaz Sneaker Ayakkabı", "Kahverengi Süet Bot"],
+    ("örgü kazak", "top"): ["Erkek Beyaz Oxford Gömlek Slim Fit", "Gri Kapüşonlu Sweatshirt Hoodie",
+                           "White Cotton T-Shirt Crew Neck", "Bordo Polo Yaka Tişört", "GÖMLEK"],
+    ("hoodie", "top"): ["Erkek Beyaz Oxford Gömlek Slim Fit", "Lacivert Örgü Kazak Oversize",
+                        "Gri Kapüşonlu Sweatshirt Hoodie", "Krem Triko Hırka", "White Cotton T-Shirt Crew Neck",
+                        "Bordo Polo Yaka Tişört", "GÖMLEK"],
+    ("deri ceket", "jacket"): ["Kadın Bej Trençkot", "Krem Triko Hırka"],
+    ("blazer", "jacket"): ["Kadın Bej Trençkot", "Krem Triko Hırka"],
+    ("trençkot", "jacket"): ["Bershka Siyah Deri Ceket", "Krem Triko Hırka", "Navy Wool Blazer"],
+    ("sneaker", "shoes"): ["Erkek Beyaz Oxford Gömlek Slim Fit", "Kahverengi Süet Bot"],
+    ("bot", "shoes"): ["Erkek Beyaz Oxford Gömlek Slim Fit", "Nike Air Max 90 Beyaz Sneaker Ayakkabı"],
+    ("jean pantolon", "bottom"): ["Pembe Mini Etek"],
+}
+STYLES = ["oxford gömlek", "örgü kazak", "hoodie", "deri ceket", "blazer", "trençkot", "sneaker", "bot",
+          "jean pantolon", ""]
+
+
+@pytest.mark.parametrize("title", list(CORPUS))
+def test_category_mismatch(title):
+    allowed, _ = CORPUS[title]
+    assert [c for c in CATS if not server.is_category_mismatch(title, c)] == allowed
+
+
+@pytest.mark.parametrize("title", list(CORPUS))
+def test_color_conflict(title):
+    _, conflicts = CORPUS[title]
+    assert [c for c in COLORS if server.detect_color_conflict(c, title)] == conflicts
+
+
+@pytest.mark.parametrize("style", STYLES)
+@pytest.mark.parametrize("category", CATS)
+def test_subtype_conflict(style, category):
+    hits = [t for t in CORPUS if server.detect_subtype_conflict(style, t, category)]
+    assert hits == SUBTYPE_CONFLICTS.get((style, category), [])
+
+
+def test_title_features_record():
+    f = server.title_features("Bershka Siyah Deri Ceket")
+    assert (f.cats, f.generic, f.subtypes, f.colors) == ({"jacket": 1}, False, {"jacket": "blazer"}, {"siyah"})
+    f = server.title_features("Erkek Beyaz Oxford Gömlek Slim Fit")
+    assert (f.cats, f.generic, f.subtypes, f.colors) == (
+        {"top": 1, "bottom": 1, "shoes": 1}, True, {"top": "shirt", "shoes": "loafer"}, {"beyaz"})
+    f = server.title_features("Gri Kapüşonlu Sweatshirt Hoodie")
+    assert (f.cats, f.generic, f.subtypes, f.colors) == ({"top": 3}, False, {"top": "shirt"}, {"gri"})
+    f = server.title_features("Yeni Sezon Kadın Giyim Koleksiyonu")
+    assert (f.cats, f.generic, f.subtypes, f.colors) == ({}, True, {}, set())
+
+
+def test_title_features_case_insensitive_and_memoized():
+    assert server.title_features("SIYAH DERI ÇANTASI") == server.title_features("siyah deri çantası")
+    assert server.title_features("GÖMLEK").cats == server.title_features("gömlek").cats
+    assert server.title_features("Navy Wool Blazer") is server.title_features("Navy Wool Blazer")